@@ -0,0 +1,127 @@
+import functools
+import logging
+import socket
+import time
+import uuid
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Admits a lease if the worker's live leases plus its cost fit the budget.
+# A job larger than the whole budget is still admitted when nothing else holds
+# budget, otherwise it could never run. Expired leases (from crashed jobs) are dropped.
+ACQUIRE_SCRIPT = """
+local leases = redis.call('HGETALL', KEYS[1])
+local now = tonumber(ARGV[4])
+local used = 0
+for i = 1, #leases, 2 do
+    local cost, expires = string.match(leases[i + 1], '(%d+):(%d+)')
+    if tonumber(expires) < now then
+        redis.call('HDEL', KEYS[1], leases[i])
+    else
+        used = used + tonumber(cost)
+    end
+end
+local cost = tonumber(ARGV[2])
+if used > 0 and used + cost > tonumber(ARGV[3]) then
+    return -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ':' .. ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return used + cost
+"""
+
+KEY_PREFIX = 'admission:'
+
+
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def _key(worker):
+    return f"{KEY_PREFIX}{worker or socket.gethostname()}"
+
+
+def acquire(worker, lease, cost):
+    """
+    Try to reserve cost bytes of the worker's memory budget under the given lease id.
+    Returns True if admitted. Fails open (admits) when Redis is unavailable.
+    """
+    now = int(time.time())
+    timeout = settings.ADMISSION_LEASE_TIMEOUT
+    try:
+        used = _redis().eval(
+            ACQUIRE_SCRIPT, 1, _key(worker),
+            lease, int(cost), settings.WORKER_MEMORY_BUDGET, now, now + timeout, timeout,
+        )
+    except Exception as e:
+        logger.warning(f"Admission control unavailable, admitting {lease}: {e}")
+        return True
+    if used < 0:
+        return False
+    logger.info(f"Admitted {lease} ({cost / 2**20:.0f} MB); budget in use {used / 2**20:.0f} MB")
+    return True
+
+
+def release(worker, lease):
+    """
+    Return a lease's budget to the worker.
+    """
+    try:
+        _redis().hdel(_key(worker), lease)
+    except Exception as e:
+        logger.warning(f"Could not release admission lease {lease}: {e}")
+
+
+def budget_usage():
+    """
+    Current memory budget usage of every worker holding leases, for monitoring.
+    """
+    now = int(time.time())
+    connection = _redis()
+    usage = []
+    for key in connection.scan_iter(f"{KEY_PREFIX}*"):
+        live = [
+            int(cost) for cost, expires in (
+                value.decode().split(':') for value in connection.hvals(key)
+            )
+            if int(expires) >= now
+        ]
+        usage.append({
+            'worker': key.decode()[len(KEY_PREFIX):],
+            'jobs': len(live),
+            'used_bytes': sum(live),
+            'budget_bytes': settings.WORKER_MEMORY_BUDGET,
+        })
+    return usage
+
+
+def memory_admission(estimate):
+    """
+    Decorator for bound Celery tasks that must reserve memory before heavy work.
+    estimate(*args) returns the job's expected peak memory in bytes. If it does not
+    fit in the worker's remaining budget the job is not started; it is requeued with
+    a delay instead, so a burst of huge jobs cannot OOM-kill the worker.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(task, *args, **kwargs):
+            try:
+                cost = estimate(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"Could not estimate memory for {task.name}{args}: {e}")
+                cost = 0
+            worker = task.request.hostname
+            lease = f"{task.name}:{uuid.uuid4().hex}"
+            if not acquire(worker, lease, cost):
+                logger.info(f"Deferring {task.name}{args}: {cost / 2**20:.0f} MB does not fit the memory budget")
+                raise task.retry(countdown=settings.ADMISSION_RETRY_DELAY, max_retries=None)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                release(worker, lease)
+        return wrapper
+    return decorator
@@ -1,7 +1,12 @@
 from __future__ import absolute_import, unicode_literals
 import os
+import logging
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import celeryd_init
+from kombu import Queue
+
+logger = logging.getLogger(__name__)
 
 # Setting the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MetaSqueeze.settings')
@@ -15,6 +20,8 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Automatically discover tasks from all registered Django apps.
 app.autodiscover_tasks()
+# Task modules outside the apps
+app.conf.imports = ('MetaSqueeze.fairshare',)
 
 app.conf.beat_schedule = {
     'cleanup-old-optimized-images': {
@@ -25,4 +32,97 @@ app.conf.beat_schedule = {
         'task': 'accounts.tasks.cleanup_blacklisted_tokens',
         'schedule': crontab(hour=0, minute=0),  # Runs daily at midnight
     },
+    'fair-share-dispatch': {
+        'task': 'MetaSqueeze.fairshare.dispatch_jobs',
+        'schedule': 60.0,  # Runs every minute
+    },
+}
+
+# Two lanes, so a long conversion never queues in front of quick image jobs.
+# A worker started without -Q consumes both; production runs a worker per lane.
+LIGHT_QUEUE = 'light'
+HEAVY_QUEUE = 'heavy'
+app.conf.task_queues = (Queue(LIGHT_QUEUE), Queue(HEAVY_QUEUE))
+app.conf.task_default_queue = LIGHT_QUEUE
+
+# Tasks routed by their cost: the expected CPU-seconds, estimated once at upload and
+# stored on the job's row, travel in the COST_HEADER message header
+COSTED_TASKS = {
+    'base.tasks.optimize_image',
+    'fileconvert.tasks.document_convert',
+}
+COST_HEADER = 'cost'
+# Tasks that always take the heavy lane: long by nature, and nobody is waiting on them
+HEAVY_TASKS = {
+    'fileconvert.tasks.word_to_pdf_batch',
+    'base.tasks.cleanup_old_images',
+    'accounts.tasks.cleanup_blacklisted_tokens',
 }
+
+
+def lane_for(cost):
+    """
+    The queue for a job expected to take cost CPU-seconds.
+    """
+    from django.conf import settings
+    return HEAVY_QUEUE if cost > settings.TASK_LIGHT_MAX_SECONDS else LIGHT_QUEUE
+
+
+def route_by_cost(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery router: send a task to the light or the heavy queue.
+    The cost is read from the message headers only, so publishing never queries the
+    database; a job published without one goes to the light queue. Retries keep
+    the headers, and with them the lane.
+    Only the queue is returned: the options end up as keyword arguments of the
+    message, where time limits would clash with Celery's own (the lane workers apply them).
+    """
+    if name in HEAVY_TASKS:
+        lane = HEAVY_QUEUE
+    elif name in COSTED_TASKS:
+        cost = (options.get('headers') or {}).get(COST_HEADER)
+        if cost is None:
+            logger.warning(f"{name}{tuple(args or ())} was published without a cost")
+            lane = LIGHT_QUEUE
+        else:
+            lane = lane_for(cost)
+    else:
+        lane = LIGHT_QUEUE
+    return {'queue': lane}
+
+
+app.conf.task_routes = (route_by_cost,)
+
+
+def worker_consumes(queue):
+    """
+    Whether this worker consumes the queue: it was started with it in -Q, or without -Q.
+    """
+    return queue in app.amqp.queues.consume_from
+
+
+@celeryd_init.connect
+def configure_lane_worker(conf=None, options=None, **kwargs):
+    """
+    Give a worker that consumes a single lane (celery worker -Q heavy) that lane's
+    concurrency, prefetch and time limits. A worker on both lanes gets the heavy
+    lane's time limits, so it never kills a long job. Values given on the command line win.
+    """
+    from django.conf import settings
+    queues = options.get('queues') or []
+    if isinstance(queues, str):
+        queues = queues.split(',')
+    single_lane = len(queues) == 1 and queues[0] in settings.TASK_LANES
+    lane = settings.TASK_LANES[queues[0] if single_lane else HEAVY_QUEUE]
+    if options.get('time_limit') is None:
+        conf.task_time_limit = lane['time_limit']
+    if options.get('soft_time_limit') is None:
+        conf.task_soft_time_limit = lane['soft_time_limit']
+    if not single_lane:
+        return
+    if options.get('concurrency') is None:
+        conf.worker_concurrency = lane['concurrency']
+    if options.get('prefetch_multiplier') is None:
+        conf.worker_prefetch_multiplier = lane['prefetch_multiplier']
+    logger.info(f"Worker on the {queues[0]} lane: concurrency {conf.worker_concurrency}, "
+                f"prefetch {conf.worker_prefetch_multiplier}, time limit {conf.task_time_limit}s")
@@ -0,0 +1,277 @@
+import functools
+import json
+import logging
+import time
+from celery import shared_task
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+# Tenants with queued jobs, in round-robin order, and the same tenants as a set
+RING_KEY = 'fairshare:ring'
+TENANTS_KEY = 'fairshare:tenants'
+# Each tenant's queued jobs
+QUEUE_PREFIX = 'fairshare:queue:'
+# Released jobs that have not finished: job key -> 'tenant|lease expiry'
+RUNNING_KEY = 'fairshare:running'
+
+# Functions that start released jobs, by job type; each takes the object ids of
+# the jobs released together, so bulk uploads still go out as one Celery group
+JOB_STARTERS = {
+    'image': 'base.tasks.start_optimizations',
+    'document': 'fileconvert.tasks.start_conversions',
+}
+# Functions run by dispatch_jobs before it dispatches, that re-queue the jobs of dead workers
+STALE_JOB_SWEEPS = (
+    'fileconvert.tasks.requeue_stale_batches',
+)
+
+SUBMIT_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[3], ARGV[i])
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+end
+return redis.call('LLEN', KEYS[3])
+"""
+
+# Releases queued jobs while fewer than the global limit run: one job per tenant
+# per turn round the ring, skipping tenants at their own limit, until a full turn
+# releases nothing. Expired leases (jobs of crashed workers) are dropped first.
+DISPATCH_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_running = tonumber(ARGV[2])
+local default_cap = tonumber(ARGV[3])
+local caps = cjson.decode(ARGV[4])
+local expires = ARGV[5]
+local queue_prefix = ARGV[6]
+
+local running, total = {}, 0
+local leases = redis.call('HGETALL', KEYS[3])
+for i = 1, #leases, 2 do
+    local tenant, expiry = string.match(leases[i + 1], '^(.*)|(%d+)$')
+    if tonumber(expiry) < now then
+        redis.call('HDEL', KEYS[3], leases[i])
+    else
+        running[tenant] = (running[tenant] or 0) + 1
+        total = total + 1
+    end
+end
+
+local released = {}
+local skipped = 0
+while total < max_running do
+    local tenants = redis.call('LLEN', KEYS[1])
+    if tenants == 0 or skipped >= tenants then
+        break
+    end
+    local tenant = redis.call('RPOPLPUSH', KEYS[1], KEYS[1])
+    local queue = queue_prefix .. tenant
+    local job = false
+    if (running[tenant] or 0) < (caps[tenant] or default_cap) then
+        job = redis.call('LPOP', queue)
+    end
+    if job then
+        running[tenant] = (running[tenant] or 0) + 1
+        total = total + 1
+        skipped = 0
+        redis.call('HSET', KEYS[3], cjson.decode(job)['key'], tenant .. '|' .. expires)
+        table.insert(released, job)
+    else
+        skipped = skipped + 1
+    end
+    if redis.call('LLEN', queue) == 0 then
+        redis.call('LREM', KEYS[1], 0, tenant)
+        redis.call('SREM', KEYS[2], tenant)
+    end
+end
+return released
+"""
+
+# Pushes a released job's lease expiry forward, keeping its tenant; 0 if it has no lease
+RENEW_SCRIPT = """
+local lease = redis.call('HGET', KEYS[1], ARGV[1])
+if not lease then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], string.match(lease, '^(.*)|%d+$') .. '|' .. ARGV[2])
+return 1
+"""
+
+
+def _redis():
+    return get_redis_connection('default')
+
+
+def tenant_for(request):
+    """
+    The fair-share tenant of a request: its user, or for anonymous uploads the client address.
+    X-Forwarded-For is trusted only as far as REST_FRAMEWORK['NUM_PROXIES'] says;
+    otherwise a client could rotate it to become any number of tenants.
+    """
+    if request.user and request.user.is_authenticated:
+        return user_tenant(request.user.pk)
+    if api_settings.NUM_PROXIES is None:
+        return f"anon:{request.META.get('REMOTE_ADDR')}"
+    return f"anon:{BaseThrottle().get_ident(request)}"
+
+
+def user_tenant(user_id):
+    """
+    The fair-share tenant of a user's jobs.
+    """
+    return f"user:{user_id}"
+
+
+def _job(job_type, object_id):
+    return {'type': job_type, 'id': str(object_id), 'key': f"{job_type}:{object_id}"}
+
+
+def _start(job_type, object_ids):
+    try:
+        import_string(JOB_STARTERS[job_type])(object_ids)
+    except Exception as e:
+        logger.error(f"Could not start {len(object_ids)} {job_type} jobs: {e}", exc_info=True)
+        for object_id in object_ids:
+            job_finished(job_type, object_id, dispatch_next=False)
+
+
+def submit(tenant, job_type, object_ids):
+    """
+    Queue jobs of one tenant and release whatever the limits allow.
+    Without fair share (FAIR_SHARE_ENABLED off, or Redis unavailable) the jobs start at once.
+    """
+    jobs = [_job(job_type, object_id) for object_id in object_ids]
+    if not jobs:
+        return
+    if not settings.FAIR_SHARE_ENABLED:
+        _start(job_type, [job['id'] for job in jobs])
+        return
+    try:
+        queued = _redis().eval(
+            SUBMIT_SCRIPT, 3, RING_KEY, TENANTS_KEY, f"{QUEUE_PREFIX}{tenant}",
+            tenant, *(json.dumps(job) for job in jobs),
+        )
+    except Exception as e:
+        logger.warning(f"Fair-share queue unavailable, starting {len(jobs)} jobs of {tenant} at once: {e}")
+        _start(job_type, [job['id'] for job in jobs])
+        return
+    logger.info(f"Queued {len(jobs)} {job_type} jobs for {tenant}; {queued} waiting")
+    try:
+        dispatch()
+    except Exception as e:
+        # Queued jobs go out on the next dispatch (a finishing job, or dispatch_jobs)
+        logger.warning(f"Could not dispatch fair-share jobs: {e}")
+
+
+def dispatch():
+    """
+    Release queued jobs to the workers, round-robin over tenants, within
+    FAIR_SHARE_MAX_RUNNING jobs at once and each tenant's concurrency cap.
+    Returns the number of jobs released.
+    """
+    now = int(time.time())
+    released = _redis().eval(
+        DISPATCH_SCRIPT, 3, RING_KEY, TENANTS_KEY, RUNNING_KEY,
+        now, settings.FAIR_SHARE_MAX_RUNNING, settings.FAIR_SHARE_USER_CONCURRENCY,
+        json.dumps(settings.FAIR_SHARE_USER_CAPS), now + settings.FAIR_SHARE_LEASE_TIMEOUT, QUEUE_PREFIX,
+    )
+    # Jobs released together start together, one call per job type
+    by_type = {}
+    for job in map(json.loads, released):
+        by_type.setdefault(job['type'], []).append(job['id'])
+    for job_type, object_ids in by_type.items():
+        _start(job_type, object_ids)
+    return len(released)
+
+
+def job_started(job_type, object_id):
+    """
+    Renew a released job's lease when it starts, or is deferred to start later: a
+    lease must only expire once the job's worker is gone, never while the job is
+    still waiting for a worker or for memory, or its place would be handed out twice.
+    """
+    if not settings.FAIR_SHARE_ENABLED:
+        return
+    try:
+        renewed = _redis().eval(
+            RENEW_SCRIPT, 1, RUNNING_KEY,
+            f"{job_type}:{object_id}", int(time.time()) + settings.FAIR_SHARE_LEASE_TIMEOUT,
+        )
+    except Exception as e:
+        logger.warning(f"Could not renew fair-share lease of {job_type}:{object_id}: {e}")
+        return
+    if not renewed:
+        # Expired while queued, or started at once because the fair-share queue was down
+        logger.info(f"{job_type}:{object_id} runs without a fair-share lease")
+
+
+def fair_share_job(job_type):
+    """
+    Decorator for bound Celery tasks that run a fair-share job, the object id being
+    their first argument: every attempt renews the job's lease, including one that
+    memory admission defers. Place it above memory_admission.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(task, object_id, *args, **kwargs):
+            job_started(job_type, object_id)
+            return func(task, object_id, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def job_finished(job_type, object_id, dispatch_next=True):
+    """
+    Free a finished job's place and release the next queued jobs.
+    Jobs that were not dispatched by fair share are ignored.
+    """
+    try:
+        if _redis().hdel(RUNNING_KEY, f"{job_type}:{object_id}") and dispatch_next:
+            dispatch()
+    except Exception as e:
+        logger.warning(f"Could not release fair-share place of {job_type}:{object_id}: {e}")
+
+
+def queue_depths():
+    """
+    Queued and running jobs of every tenant with work in the system, with its cap, for monitoring.
+    """
+    connection = _redis()
+    now = int(time.time())
+    running = {}
+    for value in connection.hvals(RUNNING_KEY):
+        tenant, _, expiry = value.decode().rpartition('|')
+        if int(expiry) >= now:
+            running[tenant] = running.get(tenant, 0) + 1
+    tenants = set(running) | {tenant.decode() for tenant in connection.smembers(TENANTS_KEY)}
+    depths = [
+        {
+            'tenant': tenant,
+            'queued': connection.llen(f"{QUEUE_PREFIX}{tenant}"),
+            'running': running.get(tenant, 0),
+            'cap': settings.FAIR_SHARE_USER_CAPS.get(tenant, settings.FAIR_SHARE_USER_CONCURRENCY),
+        }
+        for tenant in tenants
+    ]
+    return sorted(depths, key=lambda depth: (-depth['queued'], depth['tenant']))
+
+
+@shared_task
+def dispatch_jobs():
+    """
+    Periodic safety net: re-queue jobs of workers that died, and release jobs held
+    back only by leases that have since expired.
+    """
+    for sweep in STALE_JOB_SWEEPS:
+        try:
+            import_string(sweep)()
+        except Exception as e:
+            logger.warning(f"Stale job sweep {sweep} failed: {e}")
+    if settings.FAIR_SHARE_ENABLED:
+        dispatch()
@@ -69,6 +69,47 @@ CELERY_TASK_SERIALIZER = "json"
 # Optional: Store task results in Redis (if needed)
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
 
+# Task lanes (see MetaSqueeze.celery): jobs estimated to need more CPU-seconds than this go to the heavy queue
+TASK_LIGHT_MAX_SECONDS = float(os.getenv("TASK_LIGHT_MAX_SECONDS", 2))
+# Worker pool settings of each lane, used by workers started on that lane alone (celery worker -Q heavy).
+# Time limits apply to every task the lane's workers run; a worker on both lanes uses the heavy lane's
+TASK_LANES = {
+    'light': {
+        'concurrency': int(os.getenv("LIGHT_WORKER_CONCURRENCY", os.cpu_count() or 1)),
+        'prefetch_multiplier': int(os.getenv("LIGHT_WORKER_PREFETCH", 4)),
+        'soft_time_limit': int(os.getenv("LIGHT_TASK_SOFT_TIME_LIMIT", 300)),
+        'time_limit': int(os.getenv("LIGHT_TASK_TIME_LIMIT", 360)),
+    },
+    'heavy': {
+        'concurrency': int(os.getenv("HEAVY_WORKER_CONCURRENCY", 2)),
+        # One job at a time per process, so a long job never holds others back in its prefetch
+        'prefetch_multiplier': 1,
+        'soft_time_limit': int(os.getenv("HEAVY_TASK_SOFT_TIME_LIMIT", 3600)),
+        'time_limit': int(os.getenv("HEAVY_TASK_TIME_LIMIT", 3900)),
+    },
+}
+
+# Fair-share dispatch of uploaded jobs (see MetaSqueeze.fairshare): jobs are queued per user and
+# released round-robin, at most FAIR_SHARE_MAX_RUNNING at once over all users
+FAIR_SHARE_ENABLED = os.getenv("FAIR_SHARE_ENABLED", "True").lower() == "true"
+FAIR_SHARE_MAX_RUNNING = int(os.getenv("FAIR_SHARE_MAX_RUNNING", 32))
+# Jobs one user (or anonymous client address) may have running at once, and per-user exceptions
+# as "user:<id>=<cap>,anon:<address>=<cap>"
+FAIR_SHARE_USER_CONCURRENCY = int(os.getenv("FAIR_SHARE_USER_CONCURRENCY", 4))
+FAIR_SHARE_USER_CAPS = {
+    tenant.strip(): int(cap)
+    for tenant, _, cap in (entry.rpartition('=') for entry in os.getenv("FAIR_SHARE_USER_CAPS", "").split(',') if entry)
+}
+# Seconds before the place of a job that never reported back (a crashed worker) is freed
+FAIR_SHARE_LEASE_TIMEOUT = int(os.getenv("FAIR_SHARE_LEASE_TIMEOUT", 4000))
+
+# Memory admission control: estimated peak memory each worker node may commit to jobs at once
+WORKER_MEMORY_BUDGET = int(os.getenv("WORKER_MEMORY_BUDGET_MB", 2048)) * 1024 * 1024
+# Seconds before a lease held by a crashed job stops counting against the budget
+ADMISSION_LEASE_TIMEOUT = int(os.getenv("ADMISSION_LEASE_TIMEOUT", 3600))
+# Seconds a deferred job waits before it is retried
+ADMISSION_RETRY_DELAY = int(os.getenv("ADMISSION_RETRY_DELAY", 10))
+
 
 
 
@@ -102,6 +143,8 @@ REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': (
         'rest_framework.renderers.JSONRenderer',
     ),
+    # '?format=' picks a rendition format (image_list_view), not a renderer
+    'URL_FORMAT_OVERRIDE': None,
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.AnonRateThrottle',
         'rest_framework.throttling.UserRateThrottle',
@@ -115,6 +158,7 @@ REST_FRAMEWORK = {
         'login': '2/minute',
         'logout': '20/minute',
         'ip': '5/minute',
+        'derivatives': '600/minute',
     }
 }
 
@@ -240,6 +284,58 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 
+# IMAGE PROCESSING
+# Uploads are hashed while they stream in (the content hash deduplicates identical uploads)
+FILE_UPLOAD_HANDLERS = [
+    'base.uploadhandler.HashingMemoryFileUploadHandler',
+    'base.uploadhandler.HashingTemporaryFileUploadHandler',
+]
+# PNGs whose decoded bitmap would exceed this many bytes are decoded band by band
+IMAGE_TILED_RESIZE_THRESHOLD = int(os.getenv("IMAGE_TILED_RESIZE_THRESHOLD", 256 * 1024 * 1024))
+# Memory ceiling for one band of a tiled decode
+IMAGE_TILED_BAND_BYTES = int(os.getenv("IMAGE_TILED_BAND_BYTES", 16 * 1024 * 1024))
+# Resampler for the optimized image, renditions and derivatives:
+# 'pillow-lanczos', 'pillow-reducing-gap' or 'opencv-area' (see base.resize)
+IMAGE_RESIZE_ENGINE = os.getenv("IMAGE_RESIZE_ENGINE", 'pillow-lanczos')
+# On-demand derivatives (/image/<id>/w_<n>,f_<fmt>/): disk location (shared between app
+# servers, like MEDIA_ROOT) and byte budget before least recently used files are evicted
+DERIVATIVE_CACHE_ROOT = os.getenv("DERIVATIVE_CACHE_ROOT", os.path.join(BASE_DIR, 'derivative_cache'))
+DERIVATIVE_CACHE_MAX_BYTES = int(os.getenv("DERIVATIVE_CACHE_MAX_MB", 1024)) * 1024 * 1024
+# Largest decode a derivative request may run in the web process; larger originals get a 422
+DERIVATIVE_MAX_DECODE_BYTES = int(os.getenv("DERIVATIVE_MAX_DECODE_MB", 512)) * 1024 * 1024
+
+
+# DOCUMENT CONVERSION
+# Word to PDF runs on long-lived headless LibreOffice processes, OFFICE_POOL_SIZE per
+# worker process, each with its own profile under OFFICE_PROFILE_ROOT (see fileconvert.office)
+OFFICE_BINARY = os.getenv("OFFICE_BINARY", 'soffice')
+OFFICE_POOL_SIZE = int(os.getenv("OFFICE_POOL_SIZE", 1))
+OFFICE_PROFILE_ROOT = os.getenv("OFFICE_PROFILE_ROOT", os.path.join(BASE_DIR, 'office_profiles'))
+# Start the pool when a Celery worker process boots instead of on its first conversion
+OFFICE_POOL_WARM = os.getenv("OFFICE_POOL_WARM", "True").lower() == "true"
+# Conversions before a process is replaced, which bounds LibreOffice's memory growth
+OFFICE_RECYCLE_AFTER = int(os.getenv("OFFICE_RECYCLE_AFTER", 200))
+# Seconds allowed for a process to start accepting connections, and for one conversion
+OFFICE_STARTUP_TIMEOUT = int(os.getenv("OFFICE_STARTUP_TIMEOUT", 60))
+OFFICE_CONVERSION_TIMEOUT = int(os.getenv("OFFICE_CONVERSION_TIMEOUT", 300))
+# Uploaded word_to_pdf documents are converted in micro-batches of up to this many,
+# flushed at the latest this many milliseconds after the first one arrives
+WORD_TO_PDF_BATCH_SIZE = int(os.getenv("WORD_TO_PDF_BATCH_SIZE", 10))
+WORD_TO_PDF_BATCH_WINDOW_MS = int(os.getenv("WORD_TO_PDF_BATCH_WINDOW_MS", 500))
+# PDFs with at least this many pages are converted to Word on PDF_TO_WORD_WORKERS
+# processes, each parsing a range of pages
+PDF_TO_WORD_PARALLEL_PAGES = int(os.getenv("PDF_TO_WORD_PARALLEL_PAGES", 30))
+PDF_TO_WORD_WORKERS = int(os.getenv("PDF_TO_WORD_WORKERS", os.cpu_count() or 1))
+# PDF to text extractor: 'pymupdf' (fast) or 'pdfminer' (full layout analysis), see fileconvert.text
+PDF_TEXT_ENGINE = os.getenv("PDF_TEXT_ENGINE", 'pymupdf')
+# Word to text extractor: 'stream' (flat memory) or 'mammoth', see fileconvert.text
+WORD_TEXT_ENGINE = os.getenv("WORD_TEXT_ENGINE", 'stream')
+# Reuse the converted file of identical content converted by the same converter version.
+# Bump the generation to stop reusing everything converted before (e.g. after changing converter options)
+CONVERSION_CACHE_ENABLED = os.getenv("CONVERSION_CACHE_ENABLED", "True").lower() == "true"
+CONVERSION_CACHE_GENERATION = int(os.getenv("CONVERSION_CACHE_GENERATION", 1))
+
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
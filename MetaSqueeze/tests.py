@@ -0,0 +1,196 @@
+from types import SimpleNamespace
+from unittest import mock
+import fakeredis
+from celery import Celery
+from celery.exceptions import Retry
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from .celery import app, configure_lane_worker, COST_HEADER, HEAVY_QUEUE, LIGHT_QUEUE
+from . import admission, fairshare
+from .fairshare import tenant_for
+
+
+class TaskLaneTests(SimpleTestCase):
+    def setUp(self):
+        # The project's queues and router on an in-memory broker
+        self.app = Celery('lanes', broker='memory://', set_as_current=False)
+        self.app.conf.task_queues = app.conf.task_queues
+        self.app.conf.task_default_queue = app.conf.task_default_queue
+        self.app.conf.task_routes = app.conf.task_routes
+
+    def received(self, queue):
+        with self.app.connection_for_read() as connection:
+            with connection.SimpleQueue(queue) as simple_queue:
+                message = simple_queue.get(timeout=1)
+                message.ack()
+                return message.headers['task']
+
+    def test_router_publishes_to_the_lane_of_each_task(self):
+        # A SimpleTestCase: routing that touched the database would fail here
+        self.app.send_task('base.tasks.cleanup_old_images')
+        self.app.send_task('fileconvert.tasks.document_convert', args=(0,),
+                           headers={COST_HEADER: settings.TASK_LIGHT_MAX_SECONDS + 1})
+        # Published without a cost, so the light lane
+        self.app.send_task('base.tasks.optimize_image', args=(0,))
+        self.app.send_task('base.tasks.optimize_image', args=(0,), headers={COST_HEADER: 0.5})
+
+        self.assertEqual(self.received(HEAVY_QUEUE), 'base.tasks.cleanup_old_images')
+        self.assertEqual(self.received(HEAVY_QUEUE), 'fileconvert.tasks.document_convert')
+        self.assertEqual(self.received(LIGHT_QUEUE), 'base.tasks.optimize_image')
+        self.assertEqual(self.received(LIGHT_QUEUE), 'base.tasks.optimize_image')
+
+    def test_lane_workers_apply_their_time_limits(self):
+        for queues, lane in (('light', 'light'), ('heavy', 'heavy'), ('light,heavy', 'heavy'), (None, 'heavy')):
+            with self.subTest(queues=queues):
+                conf = SimpleNamespace(worker_concurrency=None, worker_prefetch_multiplier=None)
+                configure_lane_worker(conf=conf, options={'queues': queues, 'concurrency': None})
+                self.assertEqual(conf.task_time_limit, settings.TASK_LANES[lane]['time_limit'])
+                self.assertEqual(conf.task_soft_time_limit, settings.TASK_LANES[lane]['soft_time_limit'])
+
+        conf = SimpleNamespace(task_time_limit=None, worker_concurrency=1, worker_prefetch_multiplier=1)
+        configure_lane_worker(conf=conf, options={'queues': 'light', 'time_limit': 30, 'soft_time_limit': 20,
+                                                  'concurrency': 1, 'prefetch_multiplier': 1})
+        self.assertIsNone(conf.task_time_limit)
+
+
+class FairShareTenantTests(SimpleTestCase):
+    def request(self, forwarded_for):
+        request = RequestFactory().post('/', REMOTE_ADDR='203.0.113.5', HTTP_X_FORWARDED_FOR=forwarded_for)
+        request.user = AnonymousUser()
+        return request
+
+    def test_anonymous_tenant_ignores_forwarded_for_without_proxies(self):
+        self.assertEqual(tenant_for(self.request('10.0.0.1')), 'anon:203.0.113.5')
+        self.assertEqual(tenant_for(self.request('10.0.0.2')), 'anon:203.0.113.5')
+
+    def test_anonymous_tenant_from_trusted_proxy(self):
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            self.assertEqual(tenant_for(self.request('198.51.100.7, 10.0.0.1')), 'anon:10.0.0.1')
+
+
+@override_settings(FAIR_SHARE_ENABLED=True, FAIR_SHARE_MAX_RUNNING=4, FAIR_SHARE_USER_CONCURRENCY=2,
+                   FAIR_SHARE_USER_CAPS={'user:vip': 3}, FAIR_SHARE_LEASE_TIMEOUT=60)
+class FairShareQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        patcher = mock.patch.object(fairshare, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Each call to a job starter, as (job type, object ids)
+        self.started = []
+        starters = {
+            path: (lambda job_type: lambda object_ids: self.started.append((job_type, list(object_ids))))(job_type)
+            for job_type, path in fairshare.JOB_STARTERS.items()
+        }
+        patcher = mock.patch.object(fairshare, 'import_string', side_effect=starters.__getitem__)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def started_ids(self):
+        return [object_id for _, object_ids in self.started for object_id in object_ids]
+
+    def test_tenants_take_turns_within_their_caps(self):
+        fairshare.submit('user:bulk', 'image', range(10))
+        # The bulk tenant is at its cap of 2; one call for the jobs released together
+        self.assertEqual(self.started, [('image', ['0', '1'])])
+
+        fairshare.submit('user:small', 'document', ['d0'])
+        fairshare.submit('user:vip', 'image', ['v0', 'v1', 'v2'])
+        self.assertEqual(self.started_ids(), ['0', '1', 'd0', 'v0'])
+        depths = {depth['tenant']: depth for depth in fairshare.queue_depths()}
+        self.assertEqual((depths['user:bulk']['queued'], depths['user:bulk']['running']), (8, 2))
+        self.assertEqual(depths['user:vip']['cap'], 3)
+
+        # A freed place goes round the ring, not back to the tenant with the most jobs
+        fairshare.job_finished('document', 'd0')
+        fairshare.job_finished('image', '0')
+        self.assertEqual(self.started_ids()[4:], ['v1', '2'])
+
+    def test_expired_leases_free_their_places(self):
+        fairshare.submit('user:bulk', 'image', range(4))
+        self.assertEqual(fairshare.dispatch(), 0)
+        # The workers holding jobs 0 and 1 died without reporting back
+        with mock.patch.object(fairshare.time, 'time', return_value=fairshare.time.time() + 3600):
+            self.assertEqual(fairshare.dispatch(), 2)
+        self.assertEqual(self.started_ids(), ['0', '1', '2', '3'])
+
+    def test_started_jobs_keep_their_places_past_the_lease_timeout(self):
+        def deferred(task, image_id):
+            raise Retry()
+
+        fairshare.submit('user:bulk', 'image', range(4))
+        start = fairshare.time.time()
+        # Job 0 starts late, and memory admission defers it; job 1's worker died
+        with mock.patch.object(fairshare.time, 'time', return_value=start + 50):
+            with self.assertRaises(Retry):
+                fairshare.fair_share_job('image')(deferred)(None, '0')
+        with mock.patch.object(fairshare.time, 'time', return_value=start + 100):
+            self.assertEqual(fairshare.dispatch(), 1)
+        self.assertEqual(self.started_ids(), ['0', '1', '2'])
+        self.assertEqual(self.redis.hlen(fairshare.RUNNING_KEY), 2)
+
+        # Finishing releases the renewed lease once
+        fairshare.job_finished('image', '0')
+        fairshare.job_finished('image', '0')
+        self.assertEqual(self.started_ids(), ['0', '1', '2', '3'])
+
+    def test_jobs_start_at_once_without_fair_share(self):
+        with override_settings(FAIR_SHARE_ENABLED=False):
+            fairshare.submit('user:bulk', 'image', range(5))
+        self.assertEqual(self.started, [('image', ['0', '1', '2', '3', '4'])])
+
+        with mock.patch.object(self.redis, 'eval', side_effect=ConnectionError('down')):
+            fairshare.submit('user:bulk', 'document', ['d0', 'd1', 'd2'])
+        self.assertEqual(self.started[1], ('document', ['d0', 'd1', 'd2']))
+        self.assertEqual(self.redis.hlen(fairshare.RUNNING_KEY), 0)
+
+    def test_jobs_that_fail_to_start_give_back_their_places(self):
+        with mock.patch.object(fairshare, 'import_string', side_effect=ImportError('no starter')):
+            fairshare.submit('user:bulk', 'image', range(3))
+        self.assertEqual(self.redis.hlen(fairshare.RUNNING_KEY), 0)
+        self.assertEqual(self.redis.llen(f"{fairshare.QUEUE_PREFIX}user:bulk"), 1)
+
+
+@override_settings(WORKER_MEMORY_BUDGET=100 * 2**20, ADMISSION_RETRY_DELAY=7)
+class MemoryAdmissionTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        patcher = mock.patch.object(admission, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # A bound task as Celery passes it: retry() returns the exception to raise
+        self.task = SimpleNamespace(
+            name='tests.job', request=SimpleNamespace(hostname='worker1'),
+            retry=mock.Mock(side_effect=lambda **options: Retry()),
+        )
+
+    def used_bytes(self):
+        return sum(usage['used_bytes'] for usage in admission.budget_usage())
+
+    def test_job_over_the_remaining_budget_is_retried(self):
+        self.assertTrue(admission.acquire('worker1', 'running', 80 * 2**20))
+        job = mock.Mock()
+
+        with self.assertRaises(Retry):
+            admission.memory_admission(lambda: 40 * 2**20)(job)(self.task)
+
+        job.assert_not_called()
+        self.task.retry.assert_called_once_with(countdown=7, max_retries=None)
+        self.assertEqual(self.used_bytes(), 80 * 2**20)
+
+        # Alone on the worker, even a job over the whole budget runs
+        admission.release('worker1', 'running')
+        admission.memory_admission(lambda: 300 * 2**20)(job)(self.task)
+        job.assert_called_once_with()
+
+    def test_lease_is_released_when_the_job_raises(self):
+        def job():
+            self.assertEqual(self.used_bytes(), 40 * 2**20)
+            raise ValueError('conversion failed')
+
+        with self.assertRaises(ValueError):
+            admission.memory_admission(lambda: 40 * 2**20)(job)(self.task)
+
+        self.assertEqual(self.used_bytes(), 0)
+        self.assertEqual(self.redis.hlen(admission._key('worker1')), 0)
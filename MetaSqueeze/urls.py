@@ -3,10 +3,19 @@ from django.contrib import admin
 from django.urls import path, include 
 from django.conf import settings
 from django.conf.urls.static import static
+from .views import (
+    admission_status_view, derivative_stats_view, png_strategy_stats_view, conversion_cache_stats_view,
+    fair_share_status_view,
+)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('base.urls')),
     path('Fileconvert/', include('fileconvert.urls')),
     path('accounts/', include('accounts.urls')),
+    path('metrics/admission/', admission_status_view, name='admission-status'),
+    path('metrics/derivatives/', derivative_stats_view, name='derivative-stats'),
+    path('metrics/png/', png_strategy_stats_view, name='png-strategy-stats'),
+    path('metrics/conversions/', conversion_cache_stats_view, name='conversion-cache-stats'),
+    path('metrics/fair-share/', fair_share_status_view, name='fair-share-status'),
 ]+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
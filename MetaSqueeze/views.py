@@ -0,0 +1,97 @@
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from .admission import budget_usage
+from .fairshare import queue_depths
+from base.derivatives import cache_stats
+from base.png import png_strategy_stats
+from fileconvert.cache import conversion_cache_stats
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def admission_status_view(request):
+    """
+    Report each worker's memory budget usage from admission control.
+    """
+    try:
+        workers = budget_usage()
+    except Exception as e:
+        return Response(
+            {'error': f'Admission control unavailable: {e}'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return Response({'workers': workers}, status=status.HTTP_200_OK)
+
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def derivative_stats_view(request):
+    """
+    Report hit/miss/eviction counters of the on-demand derivative cache.
+    """
+    try:
+        stats = cache_stats()
+    except Exception as e:
+        return Response(
+            {'error': f'Derivative cache unavailable: {e}'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return Response(stats, status=status.HTTP_200_OK)
+
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def png_strategy_stats_view(request):
+    """
+    Report how often each lossless PNG strategy wins and the bytes it saves.
+    """
+    try:
+        stats = png_strategy_stats()
+    except Exception as e:
+        return Response(
+            {'error': f'PNG strategy statistics unavailable: {e}'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return Response(stats, status=status.HTTP_200_OK)
+
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def conversion_cache_stats_view(request):
+    """
+    Report hit/miss counters of the document conversion cache per conversion type.
+    """
+    try:
+        stats = conversion_cache_stats()
+    except Exception as e:
+        return Response(
+            {'error': f'Conversion cache statistics unavailable: {e}'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return Response(stats, status=status.HTTP_200_OK)
+
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def fair_share_status_view(request):
+    """
+    Report queued and running jobs per user of the fair-share dispatcher, most backlogged first.
+    """
+    try:
+        users = queue_depths()
+    except Exception as e:
+        return Response(
+            {'error': f'Fair-share queue unavailable: {e}'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return Response({
+        'queued': sum(user['queued'] for user in users),
+        'running': sum(user['running'] for user in users),
+        'users': users,
+    }, status=status.HTTP_200_OK)
@@ -55,3 +55,11 @@ class IPThrottle(SimpleRateThrottle):
         cache_key = self.cache_format % {'scope': self.scope, 'ident': ip}
         logger.debug(f"IPThrottle: ip={ip}, cache_key={cache_key}")
         return cache_key
+
+
+class DerivativeThrottle(IPThrottle):
+    """
+    Per-IP limit for on-demand image derivatives, which a CDN pulls far more
+    often than the default IP rate allows.
+    """
+    scope = 'derivatives'
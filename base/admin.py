@@ -1,12 +1,18 @@
 from django.contrib import admin
 from django.contrib import admin
-from .models import UploadedImage
+from .models import UploadedImage, ImageRendition
 
 
 
 @admin.register(UploadedImage)
 class UploadedImageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'original_image', 'optimized_image', 'width', 'height', 'uploaded_at']
+    list_display = ['id', 'original_image', 'optimized_image', 'width', 'height', 'uploaded_by', 'uploaded_at']
+
+
+@admin.register(ImageRendition)
+class ImageRenditionAdmin(admin.ModelAdmin):
+    list_display = ['id', 'image', 'width', 'height', 'format', 'file_size', 'created_at']
+    list_filter = ['format', 'width']
 
 
 # Register your models here.
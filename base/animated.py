@@ -0,0 +1,86 @@
+import logging
+import numpy as np
+# Pillow's own animated WEBP encoder binding (what WebPImagePlugin uses); taking
+# frames one at a time lets us stream instead of handing Pillow a list of frames.
+# The public save_all=True API materialises every transformed frame first: on 150
+# frames at 960x720 it peaks at 490 MB RSS against 95 MB, for identical bytes
+# (manage.py benchmark_animated_webp --synthetic 150).
+# It is private and called with positional arguments, so it is tied to the pinned
+# Pillow (11.2.1): re-run AnimatedWebpTests in base/tests.py before bumping it
+from PIL import _webp
+from .utils import DEFAULT_QUALITY
+
+logger = logging.getLogger(__name__)
+
+# Output formats that can carry an animation
+ANIMATED_FORMATS = ('WEBP', 'AUTO')
+
+# Frame duration (ms) used when the source does not give one
+DEFAULT_FRAME_DURATION = 100
+
+# libwebp keyframe spacing for lossy animations (the gif2webp defaults)
+KEYFRAME_MIN = 3
+KEYFRAME_MAX = 5
+
+# With drop_duplicates, a frame whose channels all stay within this distance of
+# the last kept frame counts as a duplicate (GIF dithering noise, re-encoded
+# pauses); libwebp itself only merges frames that are identical after encoding
+DUPLICATE_FRAME_TOLERANCE = 8
+
+
+def is_animated(img):
+    """
+    True if img has more than one frame.
+    """
+    return getattr(img, 'is_animated', False) and getattr(img, 'n_frames', 1) > 1
+
+
+def encode_animation(img, transform, quality=DEFAULT_QUALITY, drop_duplicates=False, icc_profile=None):
+    """
+    Encode every frame of an animated image as an animated WEBP, one frame at a time.
+    transform(frame) resizes (and otherwise edits) a single decoded frame; at most one
+    source frame and one transformed frame are alive at once, so memory is bounded
+    by a frame rather than by the animation. Frame durations and the loop count are
+    kept. With drop_duplicates a frame (nearly) identical to the last kept one is not
+    encoded; the kept frame is shown for the combined duration instead.
+    Returns (data, frame_count) where frame_count counts the frames in the output.
+    """
+    # GIFs without a NETSCAPE loop extension play once; WEBP counts loops the same way
+    loop = img.info.get('loop', 1)
+    encoder = None
+    kept = None
+    timestamp = 0
+    try:
+        for index in range(img.n_frames):
+            img.seek(index)
+            img.load()
+            duration = img.info.get('duration') or DEFAULT_FRAME_DURATION
+            frame = transform(img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'PA', 'P') else 'RGB'))
+            if frame.mode != 'RGBA':
+                frame = frame.convert('RGBA')
+
+            if encoder is None:
+                encoder = _webp.WebPAnimEncoder(
+                    frame.size, 0, loop, False, KEYFRAME_MIN, KEYFRAME_MAX, False, False
+                )
+            if drop_duplicates:
+                pixels = np.asarray(frame, dtype=np.int16)
+                if kept is not None and np.abs(pixels - kept).max() <= DUPLICATE_FRAME_TOLERANCE:
+                    # Not added: the last kept frame stays up until the next timestamp
+                    timestamp += duration
+                    continue
+                kept = pixels
+            encoder.add(frame.getim(), round(timestamp), False, quality, 100, 0)
+            timestamp += duration
+            del frame
+    finally:
+        img.seek(0)
+
+    # A final empty frame marks the end time of the last real one
+    encoder.add(None, round(timestamp), False, quality, 100, 0)
+    data = encoder.assemble(icc_profile or b'', b'', b'')
+    if data is None:
+        raise OSError("Animated WEBP encoder returned no data")
+    frame_count = _webp.WebPAnimDecoder(data).get_info()[3]
+    logger.info(f"Encoded {frame_count} of {img.n_frames} frames ({timestamp} ms, loop {loop})")
+    return data, frame_count
@@ -0,0 +1,202 @@
+import os
+import uuid
+import logging
+import tempfile
+import time
+from PIL import Image
+from django.conf import settings
+from django_redis import get_redis_connection
+from MetaSqueeze.admission import acquire, release
+from .resize import get_resize_engine
+from .tiled import read_png_header, band_decodable, decoded_png_bytes, tiled_shrink
+from .tasks import DECODE_MEMORY_FACTOR, TILED_BAND_COPIES, TILED_CANVAS_BYTES
+from .utils import DRAFT_FORMATS, REDUCING_GAP, fit_within, shrink_on_load, encode_image
+
+logger = logging.getLogger(__name__)
+
+# Redis keys of the derivative cache index
+LRU_KEY = 'derivatives:lru'        # sorted set: derivative key -> last access time
+SIZES_KEY = 'derivatives:sizes'    # hash: derivative key -> bytes on disk
+STATS_KEY = 'derivatives:stats'    # hash: hits, misses, evictions, bytes
+LOCK_PREFIX = 'derivatives:lock:'
+
+# Seconds a single-flight lock is held at most, and waited for at most
+BUILD_LOCK_TIMEOUT = 60
+BUILD_WAIT_TIMEOUT = 30
+
+CONTENT_TYPES = {
+    'WEBP': 'image/webp',
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+}
+
+
+def derivative_key(image_id, width, output_format):
+    return f"{image_id}/w{width}.{output_format.lower()}"
+
+
+def derivative_path(key):
+    return os.path.join(settings.DERIVATIVE_CACHE_ROOT, key)
+
+
+class DerivativeTooLarge(Exception):
+    """
+    The original cannot be decoded within DERIVATIVE_MAX_DECODE_BYTES.
+    """
+
+
+class DerivativeBusy(Exception):
+    """
+    The app server's memory budget is taken by other decodes; retry later.
+    """
+
+
+def _decode_memory(img, size):
+    """
+    Expected peak memory of decoding an opened original for a derivative of the given size.
+    JPEGs and MPOs are decoded at the DCT scale shrink_on_load will pick: draft() only sets up
+    the decoder, after which img.size is the size that will be decoded.
+    """
+    if img.format in DRAFT_FORMATS:
+        img.draft(None, (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+    return img.width * img.height * len(img.getbands()) * DECODE_MEMORY_FACTOR
+
+
+def _admitted_decode(cost, decode):
+    """
+    Run decode() under a lease on this host's memory budget (shared with any worker
+    on the same host), as optimize_image does in the workers.
+    Raises DerivativeTooLarge or DerivativeBusy instead of decoding.
+    """
+    if cost > settings.DERIVATIVE_MAX_DECODE_BYTES:
+        raise DerivativeTooLarge(f"Decoding needs {cost / 2**20:.0f} MB")
+    lease = f"derivative:{uuid.uuid4().hex}"
+    if not acquire(None, lease, cost):
+        raise DerivativeBusy(f"{cost / 2**20:.0f} MB does not fit the memory budget")
+    try:
+        return decode()
+    finally:
+        release(None, lease)
+
+
+def build_derivative(original_path, width, output_format):
+    """
+    Decode the original at reduced scale and encode it at the requested width.
+    The original is never upscaled. PNGs too large to decode whole are decoded
+    band by band, like in optimize_image; any other decode must fit
+    DERIVATIVE_MAX_DECODE_BYTES and the host's memory budget.
+    Raises DerivativeTooLarge or DerivativeBusy.
+    """
+    png_header = read_png_header(original_path)
+    if band_decodable(png_header) and decoded_png_bytes(png_header) > settings.IMAGE_TILED_RESIZE_THRESHOLD:
+        source_width, source_height = png_header[:2]
+        size = fit_within(source_width, source_height, (width, source_height))
+        img = _admitted_decode(
+            TILED_BAND_COPIES * settings.IMAGE_TILED_BAND_BYTES + TILED_CANVAS_BYTES,
+            lambda: tiled_shrink(original_path, size, settings.IMAGE_TILED_BAND_BYTES),
+        )
+    else:
+        try:
+            original = Image.open(original_path)
+        except Image.DecompressionBombError as e:
+            raise DerivativeTooLarge(str(e))
+        with original:
+            size = fit_within(original.width, original.height, (width, original.height))
+            img = _admitted_decode(_decode_memory(original, size), lambda: shrink_on_load(original, size))
+    if img.size != size:
+        img = get_resize_engine()(img, size)
+    return encode_image(img, output_format)
+
+
+def _write_atomically(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _evict(connection, keep):
+    """
+    Remove least recently used derivatives until the cache fits its byte budget.
+    The derivative about to be served (keep) is never removed.
+    """
+    while int(connection.hget(STATS_KEY, 'bytes') or 0) > settings.DERIVATIVE_CACHE_MAX_BYTES:
+        oldest = connection.zpopmin(LRU_KEY)
+        if not oldest:
+            break
+        key = oldest[0][0].decode()
+        if key == keep:
+            connection.zadd(LRU_KEY, {key: oldest[0][1]})
+            break
+        size = int(connection.hget(SIZES_KEY, key) or 0)
+        connection.hdel(SIZES_KEY, key)
+        try:
+            os.remove(derivative_path(key))
+        except FileNotFoundError:
+            pass
+        pipeline = connection.pipeline()
+        pipeline.hincrby(STATS_KEY, 'bytes', -size)
+        pipeline.hincrby(STATS_KEY, 'evictions', 1)
+        pipeline.execute()
+        logger.info(f"Evicted derivative {key} ({size} bytes)")
+
+
+def get_derivative(image_id, original_path, width, output_format):
+    """
+    Return the path of the derivative, building it on a miss.
+    Redis indexes what exists on disk and orders it by last access for LRU
+    eviction. A per-derivative lock makes a burst of identical misses run a
+    single encode; the other requests wait and then read the finished file.
+    Raises DerivativeTooLarge or DerivativeBusy when the original cannot be decoded now.
+    """
+    key = derivative_key(image_id, width, output_format)
+    path = derivative_path(key)
+    try:
+        connection = get_redis_connection('default')
+        if connection.zscore(LRU_KEY, key) is not None and os.path.exists(path):
+            connection.zadd(LRU_KEY, {key: time.time()})
+            connection.hincrby(STATS_KEY, 'hits', 1)
+            return path
+    except Exception as e:
+        # Without the index there is no LRU accounting, so serve without caching
+        logger.warning(f"Derivative cache unavailable, building {key} uncached: {e}")
+        _write_atomically(path, build_derivative(original_path, width, output_format))
+        return path
+
+    with connection.lock(f"{LOCK_PREFIX}{key}", timeout=BUILD_LOCK_TIMEOUT, blocking_timeout=BUILD_WAIT_TIMEOUT):
+        # Another request may have built it while we waited for the lock
+        if connection.zscore(LRU_KEY, key) is not None and os.path.exists(path):
+            connection.zadd(LRU_KEY, {key: time.time()})
+            connection.hincrby(STATS_KEY, 'hits', 1)
+            return path
+
+        data = build_derivative(original_path, width, output_format)
+        _write_atomically(path, data)
+        previous_size = int(connection.hget(SIZES_KEY, key) or 0)
+        pipeline = connection.pipeline()
+        pipeline.zadd(LRU_KEY, {key: time.time()})
+        pipeline.hset(SIZES_KEY, key, len(data))
+        pipeline.hincrby(STATS_KEY, 'bytes', len(data) - previous_size)
+        pipeline.hincrby(STATS_KEY, 'misses', 1)
+        pipeline.execute()
+    _evict(connection, keep=key)
+    return path
+
+
+def cache_stats():
+    """
+    Hit/miss/eviction counters and current size of the derivative cache.
+    """
+    connection = get_redis_connection('default')
+    stats = {k.decode(): int(v) for k, v in connection.hgetall(STATS_KEY).items()}
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    return {
+        'hits': stats.get('hits', 0),
+        'misses': stats.get('misses', 0),
+        'evictions': stats.get('evictions', 0),
+        'hit_rate': round(stats.get('hits', 0) / lookups, 4) if lookups else None,
+        'entries': connection.zcard(LRU_KEY),
+        'bytes': stats.get('bytes', 0),
+        'max_bytes': settings.DERIVATIVE_CACHE_MAX_BYTES,
+    }
@@ -0,0 +1,85 @@
+import os
+import time
+import tempfile
+import multiprocessing
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand
+from base.animated import DEFAULT_FRAME_DURATION, KEYFRAME_MAX, KEYFRAME_MIN, encode_animation
+from base.utils import DEFAULT_QUALITY, peak_rss_mb
+
+FRAME_SIZE = (960, 720)
+
+
+def _resize(frame):
+    return frame.resize(FRAME_SIZE)
+
+
+def _run_one(path, mode):
+    """
+    Encode an animation in a fresh process; return (seconds, peak RSS in MB, output bytes).
+    - streaming: encode_animation, one frame at a time through Pillow's encoder binding
+    - save_all: Pillow's public API, which needs every transformed frame up front
+    """
+    start = time.perf_counter()
+    with Image.open(path) as img:
+        if mode == 'streaming':
+            data, _ = encode_animation(img, _resize)
+        else:
+            frames, durations = [], []
+            for index in range(img.n_frames):
+                img.seek(index)
+                img.load()
+                durations.append(img.info.get('duration') or DEFAULT_FRAME_DURATION)
+                frames.append(_resize(img.convert('RGBA')))
+            buffer = BytesIO()
+            frames[0].save(
+                buffer, format='WEBP', save_all=True, append_images=frames[1:], duration=durations,
+                loop=img.info.get('loop', 1), quality=DEFAULT_QUALITY, kmin=KEYFRAME_MIN, kmax=KEYFRAME_MAX,
+            )
+            data = buffer.getvalue()
+    return time.perf_counter() - start, peak_rss_mb(), len(data)
+
+
+def _synthetic_gif(directory, frame_count):
+    """
+    Write a GIF of frame_count noisy 960x720 frames at 25 fps.
+    """
+    rng = np.random.default_rng(0)
+    frames = [
+        Image.fromarray(rng.integers(0, 256, (60, 80, 3), dtype=np.uint8))
+        .resize(FRAME_SIZE, Image.NEAREST).quantize(64)
+        for _ in range(frame_count)
+    ]
+    path = os.path.join(directory, 'synthetic.gif')
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=40, loop=0)
+    return path
+
+
+class Command(BaseCommand):
+    help = "Benchmark latency and peak RSS of streaming animated WEBP encoding vs Pillow's save_all."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Animated GIF or WEBP files to benchmark.")
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help="Generate a synthetic 960x720 GIF of N frames instead of reading paths.")
+
+    def handle(self, *args, **options):
+        # maxtasksperchild=1 gives every measurement a fresh process so the peak RSS is per encode.
+        ctx = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as tmp, ctx.Pool(1, maxtasksperchild=1) as pool:
+            paths = list(options['paths'])
+            if options['synthetic']:
+                paths.append(pool.apply(_synthetic_gif, (tmp, options['synthetic'])))
+            if not paths:
+                self.stderr.write("No animations to benchmark. Pass paths or --synthetic N.")
+                return
+
+            self.stdout.write(f"{'animation':<32}{'mode':<12}{'ms':>10}{'peak MB':>12}{'bytes':>12}")
+            for path in paths:
+                for mode in ('streaming', 'save_all'):
+                    elapsed, peak, size = pool.apply(_run_one, (path, mode))
+                    self.stdout.write(
+                        f"{os.path.basename(path)[:30]:<32}{mode:<12}{elapsed * 1000:>10.1f}{peak:>12.1f}{size:>12}"
+                    )
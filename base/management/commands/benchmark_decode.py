@@ -0,0 +1,96 @@
+import os
+import time
+import tempfile
+import multiprocessing
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand
+from base.utils import shrink_on_load, peak_rss_mb
+
+MAX_SIZE = (1024, 1024)
+
+
+def _run_one(path, mode):
+    """
+    Decode and resize a single image in a fresh process; return (seconds, peak RSS in MB).
+    """
+    start = time.perf_counter()
+    with Image.open(path) as img:
+        if mode == 'shrink':
+            img = shrink_on_load(img, MAX_SIZE)
+        else:
+            img.load()
+        img.thumbnail(MAX_SIZE, Image.LANCZOS)
+    elapsed = time.perf_counter() - start
+    return elapsed, peak_rss_mb()
+
+
+def _synthetic_corpus(directory, count):
+    """
+    Write camera-sized JPEGs (24 MP) and PNGs (12 MP) with smooth gradients plus sensor-like noise.
+    """
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        for ext, (width, height) in (('jpg', (6000, 4000)), ('png', (4000, 3000))):
+            x = np.linspace(0, 255, width, dtype=np.float32)
+            y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+            base = (x + y) / 2
+            pixels = np.stack([base, np.flipud(base), 255 - base], axis=-1)
+            pixels += rng.normal(0, 6, pixels.shape).astype(np.float32)
+            image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+            path = os.path.join(directory, f"synthetic_{i}.{ext}")
+            if ext == 'jpg':
+                image.save(path, quality=92)
+            else:
+                image.save(path)
+            paths.append(path)
+    return paths
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-image latency and peak RSS of full decode vs shrink-on-load decode."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Image files or directories to benchmark.")
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help="Generate N synthetic 24 MP JPEGs and 12 MP PNGs instead of reading paths.")
+
+    def handle(self, *args, **options):
+        # maxtasksperchild=1 gives every measurement a fresh process so the peak RSS is per image.
+        ctx = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as tmp, ctx.Pool(1, maxtasksperchild=1) as pool:
+            paths = self._collect(options['paths'])
+            if options['synthetic']:
+                paths += pool.apply(_synthetic_corpus, (tmp, options['synthetic']))
+            if not paths:
+                self.stderr.write("No images to benchmark. Pass paths or --synthetic N.")
+                return
+
+            self.stdout.write(f"{'image':<32}{'mode':<10}{'ms':>10}{'peak MB':>12}")
+            totals = {'full': [0.0, 0.0], 'shrink': [0.0, 0.0]}
+            for path in paths:
+                for mode in ('full', 'shrink'):
+                    elapsed, peak = pool.apply(_run_one, (path, mode))
+                    totals[mode][0] += elapsed
+                    totals[mode][1] = max(totals[mode][1], peak)
+                    self.stdout.write(
+                        f"{os.path.basename(path)[:30]:<32}{mode:<10}{elapsed * 1000:>10.1f}{peak:>12.1f}"
+                    )
+
+            for mode, (elapsed, peak) in totals.items():
+                self.stdout.write(
+                    f"{mode}: mean {elapsed / len(paths) * 1000:.1f} ms/image, max peak RSS {peak:.1f} MB"
+                )
+
+    def _collect(self, entries):
+        paths = []
+        for entry in entries:
+            if os.path.isdir(entry):
+                paths += sorted(
+                    os.path.join(entry, name) for name in os.listdir(entry)
+                    if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))
+                )
+            else:
+                paths.append(entry)
+        return paths
@@ -0,0 +1,112 @@
+import os
+import time
+import statistics
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+from django.core.management.base import BaseCommand
+from base.resize import RESIZE_ENGINES
+from base.utils import fit_within, encode_image, luma_array, structural_similarity
+
+MAX_SIZE = (1024, 1024)
+
+# Engine every other engine's output is scored against
+REFERENCE_ENGINE = 'pillow-lanczos'
+
+
+def _standard_corpus():
+    """
+    Return (name, image) pairs covering the content the service sees most:
+    a noisy camera photo, a screenshot with hard edges and text-like detail,
+    and a transparent graphic.
+    """
+    rng = np.random.default_rng(0)
+
+    width, height = 6000, 4000
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = (x + y) / 2
+    pixels = np.stack([base, np.flipud(base), 255 - base], axis=-1)
+    pixels += rng.normal(0, 6, pixels.shape).astype(np.float32)
+    photo = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+    screenshot = Image.new('RGB', (2560, 1440), 'white')
+    draw = ImageDraw.Draw(screenshot)
+    for top in range(40, 1400, 24):
+        for left in range(40, 2500, 180):
+            draw.rectangle((left, top, left + int(rng.integers(40, 160)), top + 12), fill=(40, 40, 40))
+    draw.rectangle((0, 0, 2560, 30), fill=(30, 90, 200))
+
+    graphic = Image.new('RGBA', (2000, 2000), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(graphic)
+    for i in range(12):
+        radius = 900 - i * 70
+        draw.ellipse((1000 - radius, 1000 - radius, 1000 + radius, 1000 + radius),
+                     fill=(255 * (i % 2), 120, 255 * ((i + 1) % 2), 255 if i % 3 else 96))
+
+    return [('photo_24mp.rgb', photo), ('screenshot_1440p.rgb', screenshot), ('graphic_4mp.rgba', graphic)]
+
+
+class Command(BaseCommand):
+    help = "Benchmark resize engines: throughput, encoded size and similarity to exact Lanczos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Image files or directories to benchmark. "
+                                                     "Defaults to a built-in synthetic corpus.")
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Resizes per image and engine; the median time is reported.")
+        parser.add_argument('--format', default='WEBP', choices=['WEBP', 'JPEG', 'PNG'],
+                            help="Format used to compare encoded output sizes.")
+        parser.add_argument('--single-thread', action='store_true',
+                            help="Limit OpenCV to one thread for a per-core comparison.")
+
+    def handle(self, *args, **options):
+        if options['single_thread']:
+            cv2.setNumThreads(1)
+
+        corpus = [(os.path.basename(path), Image.open(path)) for path in self._collect(options['paths'])]
+        corpus = corpus or _standard_corpus()
+
+        self.stdout.write(f"{'image':<26}{'engine':<22}{'ms':>9}{'MP/s':>9}{'bytes':>10}{'ssim':>9}")
+        totals = {name: [0.0, 0, 0.0] for name in RESIZE_ENGINES}
+        for label, img in corpus:
+            img.load()
+            size = fit_within(img.width, img.height, MAX_SIZE)
+            reference = luma_array(RESIZE_ENGINES[REFERENCE_ENGINE](img, size))
+            megapixels = img.width * img.height / 1e6
+
+            for name, engine in RESIZE_ENGINES.items():
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    resized = engine(img, size)
+                    timings.append(time.perf_counter() - start)
+                elapsed = statistics.median(timings)
+                encoded = len(encode_image(resized, options['format']))
+                similarity = structural_similarity(reference, luma_array(resized))
+
+                totals[name][0] += elapsed
+                totals[name][1] += encoded
+                totals[name][2] += similarity
+                self.stdout.write(
+                    f"{label[:24]:<26}{name:<22}{elapsed * 1000:>9.1f}{megapixels / elapsed:>9.1f}"
+                    f"{encoded:>10}{similarity:>9.4f}"
+                )
+
+        for name, (elapsed, encoded, similarity) in totals.items():
+            self.stdout.write(
+                f"{name}: mean {elapsed / len(corpus) * 1000:.1f} ms/image, "
+                f"{encoded} {options['format']} bytes total, mean ssim {similarity / len(corpus):.4f}"
+            )
+
+    def _collect(self, entries):
+        paths = []
+        for entry in entries:
+            if os.path.isdir(entry):
+                paths += sorted(
+                    os.path.join(entry, name) for name in os.listdir(entry)
+                    if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))
+                )
+            else:
+                paths.append(entry)
+        return paths
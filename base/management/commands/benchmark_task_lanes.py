@@ -0,0 +1,158 @@
+import os
+import io
+import time
+import random
+import tempfile
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand, CommandError
+
+# Source photo of the small jobs, and the thumbnail they make
+SMALL_JOB_SIZE = (1600, 1200)
+THUMBNAIL_SIZE = (320, 320)
+
+
+def _small_job(data):
+    """
+    A thumbnail job: decode a JPEG at reduced scale, shrink it and encode a WEBP.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft('RGB', THUMBNAIL_SIZE)
+        img = img.convert('RGB')
+        img.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+        img.save(io.BytesIO(), format='WEBP', quality=80)
+
+
+def _heavy_job(input_path, output_path):
+    """
+    A document job: convert a PDF to DOCX.
+    """
+    from fileconvert.pdf_to_word import convert_pages_sequential
+    convert_pages_sequential(input_path, output_path)
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _photo():
+    rng = np.random.default_rng(0)
+    width, height = SMALL_JOB_SIZE
+    pixels = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).resize(SMALL_JOB_SIZE, Image.BILINEAR).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(percent / 100 * (len(ordered) - 1)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark queue lanes under a mixed load: latency of small image jobs arriving while "
+        "PDF conversions run, with one shared queue versus light and heavy lanes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2,
+                            help="Worker processes in total, in both setups.")
+        parser.add_argument('--heavy-workers', type=int, default=1,
+                            help="Of those, the workers serving the heavy lane.")
+        parser.add_argument('--small-jobs', type=int, default=200,
+                            help="Thumbnail jobs, arriving at random at --rate per second.")
+        parser.add_argument('--rate', type=float, default=10.0,
+                            help="Mean arrival rate of small jobs per second.")
+        parser.add_argument('--heavy-jobs', type=int, default=4,
+                            help="PDF to Word jobs, arriving evenly spread among the small ones.")
+        parser.add_argument('--heavy-pages', type=int, default=6,
+                            help="Page count of the PDF every heavy job converts.")
+
+    def handle(self, *args, **options):
+        from base.tasks import optimize_cost
+        from fileconvert.preflight import analyze_pdf, estimate_cpu_seconds
+        from fileconvert.management.commands.benchmark_pdf_text import _synthetic_corpus
+        from MetaSqueeze.celery import lane_for, LIGHT_QUEUE, HEAVY_QUEUE
+
+        workers, heavy_workers = options['workers'], options['heavy_workers']
+        if not 0 < heavy_workers < workers:
+            raise CommandError("--heavy-workers must be at least 1 and fewer than --workers.")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            photo = _photo()
+            pdf_path = _synthetic_corpus(tmp, options['heavy_pages'])
+            small_cost = optimize_cost(*SMALL_JOB_SIZE, len(photo))
+            heavy_cost = estimate_cpu_seconds('pdf2docx', analyze_pdf(pdf_path))
+            lanes = {'small': lane_for(small_cost), 'heavy': lane_for(heavy_cost)}
+            self.stdout.write(
+                f"small job: ~{small_cost:.2f} CPU-s -> {lanes['small']} lane; "
+                f"heavy job: ~{heavy_cost:.2f} CPU-s -> {lanes['heavy']} lane"
+            )
+
+            # The same arrivals for both setups
+            rng = random.Random(0)
+            arrivals, at = [], 0.0
+            for _ in range(options['small_jobs']):
+                at += rng.expovariate(options['rate'])
+                arrivals.append((at, 'small'))
+            every = max(1, options['small_jobs'] // (options['heavy_jobs'] + 1))
+            for number in range(options['heavy_jobs']):
+                arrivals.append((arrivals[(number + 1) * every - 1][0], 'heavy'))
+            arrivals.sort()
+
+            ctx = multiprocessing.get_context('spawn')
+            setups = {
+                'shared queue': {'default': workers},
+                'lanes': {LIGHT_QUEUE: workers - heavy_workers, HEAVY_QUEUE: heavy_workers},
+            }
+            self.stdout.write(
+                f"{'setup':<14}{'small p50':>11}{'p95':>9}{'p99':>9}{'max':>9}{'heavy mean':>12}{'total s':>9}"
+            )
+            for setup, pools in setups.items():
+                executors = {name: ProcessPoolExecutor(size, mp_context=ctx) for name, size in pools.items()}
+                try:
+                    for name, executor in executors.items():
+                        wait([executor.submit(_warm_up) for _ in range(pools[name])])
+                    latencies = self._run(arrivals, executors, lanes, photo, pdf_path, tmp)
+                finally:
+                    for executor in executors.values():
+                        executor.shutdown()
+                small, heavy = latencies['small'], latencies['heavy']
+                self.stdout.write(
+                    f"{setup:<14}{statistics.median(small):>11.3f}{_percentile(small, 95):>9.3f}"
+                    f"{_percentile(small, 99):>9.3f}{max(small):>9.3f}{statistics.mean(heavy):>12.2f}"
+                    f"{latencies['total']:>9.1f}"
+                )
+
+    def _run(self, arrivals, executors, lanes, photo, pdf_path, tmp):
+        """
+        Submit every job at its arrival time to its lane's executor (or the only one)
+        and return the seconds from arrival to completion, per kind of job.
+        """
+        finished = {}
+        submitted = []
+        start = time.perf_counter()
+        for number, (at, kind) in enumerate(arrivals):
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor = executors.get(lanes[kind]) or executors['default']
+            if kind == 'small':
+                future = executor.submit(_small_job, photo)
+            else:
+                future = executor.submit(_heavy_job, pdf_path, os.path.join(tmp, f'{number}.docx'))
+            future.add_done_callback(lambda _, number=number: finished.setdefault(number, time.perf_counter()))
+            submitted.append(future)
+        wait(submitted)
+        for future in submitted:
+            future.result()
+
+        latencies = {'small': [], 'heavy': []}
+        for number, (at, kind) in enumerate(arrivals):
+            latencies[kind].append(finished[number] - start - at)
+        latencies['total'] = max(finished.values()) - start
+        return latencies
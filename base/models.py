@@ -1,15 +1,45 @@
 from django.db import models
+from django.conf import settings
 import os
 
 class UploadedImage(models.Model):
-    # Choices for output_format field
-    OUTPUT_FORMAT_CHOICES = [
+    # Formats an image can actually be encoded in
+    ENCODED_FORMAT_CHOICES = [
         ('WEBP', 'WEBP'),
         ('JPEG', 'JPEG'),
         ('PNG', 'PNG'),
     ]
+    # Choices for output_format field; AUTO keeps the smallest acceptable encoding
+    OUTPUT_FORMAT_CHOICES = ENCODED_FORMAT_CHOICES + [
+        ('AUTO', 'AUTO'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    # Widths the frontends request renditions at
+    RENDITION_WIDTHS = [320, 640, 1024, 2048]
+    # Fields filled in by optimize_image, copied when an identical upload is reused
+    PROCESSED_FIELDS = [
+        'width', 'height', 'format', 'camera_make', 'camera_model',
+        'taken_at', 'gps_latitude', 'gps_longitude',
+        'encode_quality', 'optimized_size', 'similarity_score',
+        'optimized_format', 'candidate_sizes', 'perceptual_hash', 'png_report',
+        'lqip', 'blurhash', 'dominant_color', 'frame_count',
+    ]
+    # Requested processing; identical content with identical parameters gives identical output
+    PROCESSING_PARAMS = [
+        'output_format', 'rendition_widths', 'rendition_formats', 'target_max_bytes',
+        'target_min_similarity', 'operations', 'drop_duplicate_frames',
+    ]
 
     original_image = models.ImageField(upload_to='originals/')
+    # SHA-256 of the uploaded bytes; identical uploads share the stored blobs
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # 64-bit pHash (stored signed); near-identical images differ in only a few bits
+    perceptual_hash = models.BigIntegerField(null=True, blank=True)
     optimized_image = models.ImageField(upload_to='optimized/', null=True, blank=True)
     width = models.IntegerField(null=True, blank=True)
     height = models.IntegerField(null=True, blank=True)
@@ -20,16 +50,73 @@ class UploadedImage(models.Model):
     gps_latitude = models.FloatField(null=True, blank=True)
     gps_longitude = models.FloatField(null=True, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    # Set for images uploaded together through the batch endpoint
+    batch_id = models.UUIDField(null=True, blank=True, db_index=True)
+    # Uploading user (None for anonymous uploads); jobs are scheduled fairly between users
+    uploaded_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='uploaded_images'
+    )
     output_format = models.CharField(
         max_length=10,
         choices=OUTPUT_FORMAT_CHOICES,
         null=True,
         blank=True,
         default='WEBP'
-    )  
+    )
+    # Opt-in target encoding: search the quality range for a byte budget and/or an SSIM floor
+    target_max_bytes = models.PositiveIntegerField(null=True, blank=True)
+    target_min_similarity = models.FloatField(null=True, blank=True)
+    # Encoding actually chosen for optimized_image
+    optimized_format = models.CharField(max_length=10, null=True, blank=True)
+    # Byte count of every candidate format tried by AUTO
+    candidate_sizes = models.JSONField(null=True, blank=True)
+    # Lossless PNG search: baseline and output size, winning strategy, bytes saved per strategy
+    png_report = models.JSONField(null=True, blank=True)
+    encode_quality = models.PositiveSmallIntegerField(null=True, blank=True)
+    optimized_size = models.PositiveIntegerField(null=True, blank=True)
+    similarity_score = models.FloatField(null=True, blank=True)
+    # Placeholders shown before the optimized image loads: an inline ~16px WEBP data URI,
+    # a blurhash string and the dominant colour as '#rrggbb'
+    lqip = models.TextField(null=True, blank=True)
+    blurhash = models.CharField(max_length=64, null=True, blank=True)
+    dominant_color = models.CharField(max_length=7, null=True, blank=True)
+    # Requested renditions; every width is encoded in every format from a single decode
+    rendition_widths = models.JSONField(default=list, blank=True)
+    rendition_formats = models.JSONField(default=list, blank=True)
+    # Animated uploads: skip frames identical to the previous one (their time is merged)
+    drop_duplicate_frames = models.BooleanField(default=False)
+    # Frames in the optimized image; animated GIF/WEBP stay animated when the output is WEBP or AUTO
+    frame_count = models.PositiveIntegerField(null=True, blank=True)
+    # Edits applied in a single decode/encode pass, e.g. [{"op": "crop", "box": [0, 0, 800, 600]}];
+    # see base.operations for the supported operations
+    operations = models.JSONField(default=list, blank=True)
+    # Expected CPU-seconds of the optimization, estimated at upload; picks the task's lane
+    estimated_cpu_seconds = models.FloatField(null=True, blank=True)
+
     def __str__(self):
         return f"Image {self.id} - {os.path.basename(self.original_image.name)}"
 
     class Meta:
         ordering = ['-uploaded_at']
-        indexes = [models.Index(fields=['uploaded_at'])]
\ No newline at end of file
+        indexes = [models.Index(fields=['uploaded_at'])]
+
+
+
+class ImageRendition(models.Model):
+    image = models.ForeignKey(UploadedImage, on_delete=models.CASCADE, related_name='renditions')
+    width = models.IntegerField()
+    height = models.IntegerField()
+    format = models.CharField(max_length=10, choices=UploadedImage.ENCODED_FORMAT_CHOICES)
+    file = models.ImageField(upload_to='renditions/')
+    file_size = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Rendition {self.width}w {self.format} of image {self.image_id}"
+
+    class Meta:
+        ordering = ['width', 'format']
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'width', 'format'], name='unique_image_rendition')
+        ]
@@ -0,0 +1,199 @@
+import math
+from collections import namedtuple
+from PIL import Image, ImageFilter
+from .utils import fit_within
+from .resize import get_resize_engine
+
+OPERATIONS = ('auto_orient', 'crop', 'resize', 'strip_metadata', 'sharpen')
+
+# Longest operations list accepted per upload
+MAX_OPERATIONS = 20
+
+# EXIF Orientation tag and the transpose that puts the image upright (as ImageOps.exif_transpose)
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+SWAPS_AXES = (Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE,
+              Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270)
+
+# Unsharp mask defaults (Pillow's)
+SHARPEN_DEFAULTS = {'radius': 2.0, 'percent': 150, 'threshold': 3}
+
+# What a chain of operations reduces to:
+# - box: region of the source (in stored, un-rotated pixels) that ends up in the output
+# - size: output size before the transpose
+# - transpose: applied last, or None
+# - sharpen: (radius, percent, threshold) applied after resampling, or None
+# - strip_metadata: drop the colour profile as well as EXIF/XMP
+OperationPlan = namedtuple('OperationPlan', ['box', 'size', 'transpose', 'sharpen', 'strip_metadata'])
+
+
+def validate_operations(operations):
+    """
+    Check an operations list and return it normalised (defaults filled in, numbers typed).
+    Raises ValueError describing the first invalid entry.
+    """
+    if not isinstance(operations, list):
+        raise ValueError("operations must be a list.")
+    if len(operations) > MAX_OPERATIONS:
+        raise ValueError(f"At most {MAX_OPERATIONS} operations are allowed.")
+
+    normalized = []
+    for position, operation in enumerate(operations):
+        name = operation.get('op') if isinstance(operation, dict) else None
+        if name not in OPERATIONS:
+            raise ValueError(f"Operation {position}: op must be one of {', '.join(OPERATIONS)}.")
+        try:
+            if name == 'crop':
+                left, top, right, bottom = (int(value) for value in operation['box'])
+                if not 0 <= left < right or not 0 <= top < bottom:
+                    raise ValueError
+                normalized.append({'op': name, 'box': [left, top, right, bottom]})
+            elif name == 'resize':
+                width, height = operation.get('width'), operation.get('height')
+                if width is None and height is None:
+                    raise ValueError
+                width = None if width is None else int(width)
+                height = None if height is None else int(height)
+                if (width is not None and width < 1) or (height is not None and height < 1):
+                    raise ValueError
+                normalized.append({'op': name, 'width': width, 'height': height})
+            elif name == 'sharpen':
+                params = {**SHARPEN_DEFAULTS, **{k: v for k, v in operation.items() if k != 'op'}}
+                if set(params) != set(SHARPEN_DEFAULTS):
+                    raise ValueError
+                radius, percent, threshold = float(params['radius']), int(params['percent']), int(params['threshold'])
+                if not 0 < radius <= 50 or not 0 < percent <= 500 or not 0 <= threshold <= 255:
+                    raise ValueError
+                normalized.append({'op': name, 'radius': radius, 'percent': percent, 'threshold': threshold})
+            else:
+                normalized.append({'op': name})
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Operation {position}: invalid parameters for {name}.")
+    return normalized
+
+
+def _source_point(transpose, x, y, width, height):
+    """
+    Map a point of the transposed image back to the (width x height) image before the transpose.
+    """
+    if transpose == Image.Transpose.FLIP_LEFT_RIGHT:
+        return width - x, y
+    if transpose == Image.Transpose.FLIP_TOP_BOTTOM:
+        return x, height - y
+    if transpose == Image.Transpose.ROTATE_180:
+        return width - x, height - y
+    if transpose == Image.Transpose.TRANSPOSE:
+        return y, x
+    if transpose == Image.Transpose.ROTATE_90:
+        return width - y, x
+    if transpose == Image.Transpose.ROTATE_270:
+        return y, height - x
+    if transpose == Image.Transpose.TRANSVERSE:
+        return width - y, height - x
+    return x, y
+
+
+def plan_operations(operations, source_size, orientation=None, bound=None):
+    """
+    Fold an operations list into one OperationPlan.
+    Geometric operations are merged rather than run in turn: every crop becomes a
+    narrower box on the source, every resize just changes the output size, and the
+    EXIF transpose is moved to the end by mapping later crops back through it.
+    The whole chain then costs one resample of only the pixels that survive the
+    crops. Sharpening runs once, after resampling; repeated sharpen operations are
+    merged (percents add up, the widest radius and lowest threshold win).
+    bound caps the size of the upright output.
+    Raises ValueError if a crop falls outside the image.
+    """
+    left, top, right, bottom = 0.0, 0.0, float(source_size[0]), float(source_size[1])
+    width, height = source_size
+    transpose = None
+    sharpen = None
+    strip_metadata = False
+
+    def displayed():
+        return (height, width) if transpose in SWAPS_AXES else (width, height)
+
+    for operation in operations:
+        name = operation['op']
+        if name == 'auto_orient':
+            if transpose is None:
+                transpose = ORIENTATION_TRANSPOSE.get(orientation)
+        elif name == 'crop':
+            shown_width, shown_height = displayed()
+            crop_left, crop_top, crop_right, crop_bottom = operation['box']
+            crop_right, crop_bottom = min(crop_right, shown_width), min(crop_bottom, shown_height)
+            if crop_left >= crop_right or crop_top >= crop_bottom:
+                raise ValueError(f"Crop box {operation['box']} is outside the {shown_width}x{shown_height} image.")
+            corners = [
+                _source_point(transpose, x, y, width, height)
+                for x, y in ((crop_left, crop_top), (crop_right, crop_bottom))
+            ]
+            xs, ys = sorted(x for x, _ in corners), sorted(y for _, y in corners)
+            # From output pixels to source pixels
+            scale_x, scale_y = (right - left) / width, (bottom - top) / height
+            left, right = left + xs[0] * scale_x, left + xs[1] * scale_x
+            top, bottom = top + ys[0] * scale_y, top + ys[1] * scale_y
+            width, height = xs[1] - xs[0], ys[1] - ys[0]
+        elif name == 'resize':
+            shown_width, shown_height = displayed()
+            fitted = fit_within(shown_width, shown_height, (
+                operation['width'] or shown_width, operation['height'] or shown_height
+            ))
+            width, height = (fitted[1], fitted[0]) if transpose in SWAPS_AXES else fitted
+        elif name == 'sharpen':
+            params = (operation['radius'], operation['percent'], operation['threshold'])
+            if sharpen is None:
+                sharpen = params
+            else:
+                sharpen = (max(sharpen[0], params[0]), sharpen[1] + params[1], min(sharpen[2], params[2]))
+        elif name == 'strip_metadata':
+            strip_metadata = True
+
+    if bound:
+        fitted = fit_within(*displayed(), bound)
+        width, height = (fitted[1], fitted[0]) if transpose in SWAPS_AXES else fitted
+    size = (max(1, round(width)), max(1, round(height)))
+    return OperationPlan((left, top, right, bottom), size, transpose, sharpen, strip_metadata)
+
+
+def decode_size(plan, source_size):
+    """
+    Size the whole source would have at the plan's output scale, i.e. the size to
+    shrink-on-load to before cutting out the box.
+    """
+    left, top, right, bottom = plan.box
+    return (
+        math.ceil(source_size[0] * plan.size[0] / (right - left)),
+        math.ceil(source_size[1] * plan.size[1] / (bottom - top)),
+    )
+
+
+def execute_plan(img, plan, source_size):
+    """
+    Run a plan on a decoded image, which may already be shrunk from source_size
+    (draft, reduce or tiled decode). The crop and the resample happen in a single
+    call of the IMAGE_RESIZE_ENGINE over the box, so the Pillow engines build no
+    cropped intermediate.
+    """
+    scale_x, scale_y = img.width / source_size[0], img.height / source_size[1]
+    left, top, right, bottom = plan.box
+    box = (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y)
+    if box != (0, 0, img.width, img.height) or plan.size != img.size:
+        if img.mode in ('1', 'P'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        img = get_resize_engine()(img, plan.size, box=box)
+    if plan.transpose is not None:
+        img = img.transpose(plan.transpose)
+    if plan.sharpen is not None:
+        radius, percent, threshold = plan.sharpen
+        img = img.filter(ImageFilter.UnsharpMask(radius, percent, threshold))
+    return img
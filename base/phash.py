@@ -0,0 +1,159 @@
+import threading
+import time
+import logging
+from datetime import timedelta
+import numpy as np
+from PIL import Image
+from django.utils import timezone
+from .models import UploadedImage
+
+logger = logging.getLogger(__name__)
+
+# pHash: DCT of a 32x32 luma thumbnail, keeping the 8x8 lowest frequencies
+PHASH_SAMPLE_SIZE = 32
+PHASH_BITS_SIDE = 8
+
+# Seconds between incremental index refreshes, and between full rebuilds that
+# drop deleted rows
+INDEX_REFRESH_INTERVAL = 5
+INDEX_REBUILD_INTERVAL = 3600
+# Only images uploaded this recently can hold refreshes back while they wait to be
+# hashed; older ones have lost their job or wait in a long queue, and are picked
+# up by the next full rebuild
+INDEX_UNSETTLED_WINDOW = INDEX_REBUILD_INTERVAL
+
+# Rows fetched per query while loading the index
+INDEX_LOAD_CHUNK = 100000
+
+
+def _dct_matrix(n):
+    """
+    Orthonormal DCT-II basis; D @ x @ D.T is the 2-D DCT of an n x n block.
+    """
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(PHASH_SAMPLE_SIZE)
+
+
+def perceptual_hash(img):
+    """
+    64-bit perceptual hash of an image as a signed integer (fits a BigIntegerField).
+    Each bit says whether a low-frequency DCT coefficient is above the median, so
+    re-encoding, resizing and small crops or colour shifts change only a few bits.
+    """
+    sample = img.convert('L').resize((PHASH_SAMPLE_SIZE, PHASH_SAMPLE_SIZE), Image.LANCZOS)
+    pixels = np.asarray(sample, dtype=np.float64)
+    coefficients = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:PHASH_BITS_SIDE, :PHASH_BITS_SIDE].ravel()
+    # The DC term is the mean brightness and would dominate the median
+    bits = coefficients > np.median(coefficients[1:])
+    value = np.packbits(bits).view('>u8')[0]
+    return int(value.astype(np.int64))
+
+
+class PerceptualHashIndex:
+    """
+    In-memory index of every stored perceptual hash, scanned brute force.
+    Hashes are packed into one uint64 array; a query is a vectorized XOR and
+    popcount over the whole array (about 40 MB and tens of milliseconds for 5M images),
+    which needs no tuning and answers any distance exactly.
+    """
+
+    def __init__(self, ids=(), hashes=()):
+        # (ids, hashes) in id order, swapped as one tuple so queries never see a half-refresh
+        self.entries = (
+            np.asarray(ids, dtype=np.int64),
+            np.asarray(hashes, dtype=np.int64).view(np.uint64),
+        )
+        # Rows at or above this id may still be hashed later and are re-read on refresh
+        self.unsettled_from = 0
+        self.refreshed_at = 0
+        self.rebuilt_at = 0
+        self.lock = threading.Lock()
+
+    def _load(self, from_id):
+        """
+        Read (ids, hashes) of every hashed image with id >= from_id, in id order.
+        """
+        rows = UploadedImage.objects.filter(id__gte=from_id, perceptual_hash__isnull=False).order_by('id')
+        ids, hashes = [], []
+        last_id = from_id - 1
+        while True:
+            chunk = list(rows.filter(id__gt=last_id).values_list('id', 'perceptual_hash')[:INDEX_LOAD_CHUNK])
+            if not chunk:
+                break
+            chunk_ids, chunk_hashes = zip(*chunk)
+            ids.append(np.array(chunk_ids, dtype=np.int64))
+            hashes.append(np.array(chunk_hashes, dtype=np.int64).view(np.uint64))
+            last_id = chunk_ids[-1]
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+        return np.concatenate(ids), np.concatenate(hashes)
+
+    def refresh(self, force=False):
+        """
+        Bring the index up to date with the database.
+        Images are hashed asynchronously, so rows from the oldest recent one still
+        being processed onwards are re-read; everything below it is settled.
+        Deleted rows linger until the next full rebuild; query callers re-check them.
+        """
+        now = time.monotonic()
+        if not force and now - self.refreshed_at < INDEX_REFRESH_INTERVAL:
+            return
+        with self.lock:
+            if not force and now - self.refreshed_at < INDEX_REFRESH_INTERVAL:
+                return
+            rebuild = force or now - self.rebuilt_at >= INDEX_REBUILD_INTERVAL
+            from_id = 0 if rebuild else self.unsettled_from
+            # A range scan of the uploaded_at index over recent uploads only
+            unsettled = (
+                UploadedImage.objects.filter(
+                    uploaded_at__gte=timezone.now() - timedelta(seconds=INDEX_UNSETTLED_WINDOW),
+                    status__in=['pending', 'processing'],
+                )
+                .order_by('id').values_list('id', flat=True).first()
+            )
+
+            ids, hashes = self.entries
+            new_ids, new_hashes = self._load(from_id)
+            keep = np.searchsorted(ids, from_id)
+            ids = np.concatenate([ids[:keep], new_ids])
+            self.entries = (ids, np.concatenate([hashes[:keep], new_hashes]))
+
+            if unsettled is not None:
+                self.unsettled_from = unsettled
+            elif len(ids):
+                self.unsettled_from = int(ids[-1]) + 1
+            self.refreshed_at = now
+            if rebuild:
+                self.rebuilt_at = now
+                logger.info(f"Rebuilt perceptual hash index with {len(ids)} images")
+
+    def query(self, value, max_distance, exclude_id=None):
+        """
+        Return [(id, distance)] of every indexed image within max_distance bits of
+        value, nearest first.
+        """
+        ids, hashes = self.entries
+        target = np.array([value], dtype=np.int64).view(np.uint64)[0]
+        distances = np.bitwise_count(hashes ^ target)
+        matches = np.flatnonzero(distances <= max_distance)
+        if exclude_id is not None:
+            matches = matches[ids[matches] != exclude_id]
+        matches = matches[np.argsort(distances[matches], kind='stable')]
+        return [(int(ids[i]), int(distances[i])) for i in matches]
+
+
+_index = PerceptualHashIndex()
+
+
+def find_similar(uploaded_image, max_distance):
+    """
+    Return [(id, distance)] of images within max_distance bits of uploaded_image's
+    perceptual hash, nearest first, excluding the image itself.
+    """
+    _index.refresh()
+    return _index.query(uploaded_image.perceptual_hash, max_distance, exclude_id=uploaded_image.id)
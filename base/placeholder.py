@@ -0,0 +1,122 @@
+import base64
+import math
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+# Longest side of the inline WEBP placeholder, and its encoder quality
+LQIP_SIZE = 16
+LQIP_QUALITY = 40
+# Longest data URI stored; it is inlined in every image response. A 16px WEBP of
+# noise with alpha takes about half of it; clients fall back to the blurhash above it
+LQIP_MAX_BYTES = 1024
+
+# Longest side of the thumbnail every placeholder is derived from
+SAMPLE_SIZE = 64
+
+# Blurhash components along the longer and the shorter side (1-9 each)
+BLURHASH_COMPONENTS = (4, 3)
+BASE83_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+# Palette size used to find the dominant colour
+DOMINANT_COLORS = 5
+
+
+def _base83(value, length):
+    return ''.join(
+        BASE83_CHARACTERS[(value // 83 ** (length - position)) % 83]
+        for position in range(1, length + 1)
+    )
+
+
+def _srgb_to_linear(values):
+    values = values / 255
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def _linear_to_srgb(value):
+    value = min(1.0, max(0.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash(img, components=BLURHASH_COMPONENTS):
+    """
+    Encode an RGB image as a blurhash string (https://blurha.sh), which clients
+    decode into a blurred preview. The cosine factors are computed for all
+    components at once with a single einsum over linear-light pixels.
+    """
+    longer, shorter = components
+    components_x, components_y = (longer, shorter) if img.width >= img.height else (shorter, longer)
+    pixels = _srgb_to_linear(np.asarray(img, dtype=np.float64))
+    height, width = pixels.shape[:2]
+
+    basis_x = np.cos(np.pi * np.arange(components_x)[:, None] * np.arange(width)[None, :] / width)
+    basis_y = np.cos(np.pi * np.arange(components_y)[:, None] * np.arange(height)[None, :] / height)
+    factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, pixels) / (width * height)
+    factors[1:] *= 2
+    factors[0, 1:] *= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+
+    result = _base83((components_x - 1) + (components_y - 1) * 9, 1)
+    if len(ac):
+        quantised_max = max(0, min(82, int(math.floor(np.abs(ac).max() * 166 - 0.5))))
+        maximum = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        maximum = 1
+        result += _base83(0, 1)
+    r, g, b = (_linear_to_srgb(channel) for channel in dc)
+    result += _base83((r << 16) + (g << 8) + b, 4)
+
+    # AC components are stored as the signed square root, quantised to 19 levels per channel
+    quantised = np.floor(np.sign(ac) * np.abs(ac / maximum) ** 0.5 * 9 + 9.5).clip(0, 18).astype(int)
+    for r, g, b in quantised:
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def dominant_color(img):
+    """
+    Most common colour of an RGB image after reducing it to a small palette, as '#rrggbb'.
+    """
+    quantized = img.quantize(DOMINANT_COLORS, method=Image.Quantize.MEDIANCUT)
+    _, index = max(quantized.getcolors())
+    r, g, b = quantized.getpalette()[index * 3:index * 3 + 3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def lqip_data_uri(img):
+    """
+    A tiny WEBP of the image (longest side LQIP_SIZE) as a data: URI for inline use,
+    or None if it would be longer than LQIP_MAX_BYTES.
+    """
+    tiny = img.copy()
+    tiny.thumbnail((LQIP_SIZE, LQIP_SIZE), Image.LANCZOS)
+    buffer = BytesIO()
+    tiny.save(buffer, format='WEBP', quality=LQIP_QUALITY)
+    uri = 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+    return uri if len(uri) <= LQIP_MAX_BYTES else None
+
+
+def make_placeholders(img):
+    """
+    Return the placeholder fields for a decoded image: lqip (inline WEBP data URI),
+    blurhash and dominant_color. Everything is derived from one small thumbnail,
+    so the cost does not depend on the image size.
+    """
+    sample = img.copy() if img.mode in ('RGB', 'RGBA') else img.convert('RGBA')
+    sample.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS)
+    if sample.mode == 'RGBA':
+        # Blurhash and the dominant colour have no alpha: judge them as shown on white
+        opaque = Image.new('RGB', sample.size, 'white')
+        opaque.paste(sample, mask=sample.getchannel('A'))
+    else:
+        opaque = sample
+    return {
+        'lqip': lqip_data_uri(sample),
+        'blurhash': blurhash(opaque),
+        'dominant_color': dominant_color(opaque),
+    }
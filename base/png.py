@@ -0,0 +1,301 @@
+import struct
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Modes the pipeline re-encodes itself; anything else (16-bit, float, CMYK) is
+# left to Pillow's encoder
+SOURCE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+# PNG colour type per mode, and the samples per pixel it stores
+COLOR_TYPES = {'L': 0, 'RGB': 2, 'P': 3, 'LA': 4, 'RGBA': 6}
+
+# Row filters tried; 'adaptive' picks the best filter per row (minimum sum of
+# absolute differences, the heuristic libpng uses)
+FILTERS = ('none', 'sub', 'up', 'paeth', 'adaptive')
+FILTER_TYPES = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4}
+
+# zlib strategies tried at level 9 for every (image, filter) pair
+ZLIB_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'rle': zlib.Z_RLE,
+}
+
+# Upper bound on concurrent trial encodes; zlib releases the GIL while compressing
+MAX_TRIAL_WORKERS = 8
+
+# Redis hash of running totals: images, baseline/output bytes, and per strategy
+# '<strategy>:saved' bytes and '<strategy>:wins'
+STATS_KEY = 'png:strategies'
+
+
+def png_chunk(chunk_type, data):
+    """
+    Serialize one PNG chunk: length, type, data and CRC.
+    """
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def _pillow_png(img):
+    """
+    Pillow's own PNG encode with optimize=True, the baseline every strategy is measured against.
+    """
+    buffer = BytesIO()
+    img.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _variants(img):
+    """
+    Yield (transforms, mode, pixels, bit_depth, extra_chunks) for every lossless
+    re-representation of img worth trying. pixels is a 2-D uint8 array of packed
+    scanline bytes (without filter bytes); transforms names the reductions applied.
+    """
+    source = img if img.mode in SOURCE_MODES else img.convert('RGBA')
+    arr = np.asarray(source)
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    height, width, channels = arr.shape
+    has_alpha = source.mode in ('LA', 'RGBA')
+    transforms = ()
+
+    yield ('original',), source.mode, arr.reshape(height, -1), 8, []
+
+    # An alpha channel that is fully opaque carries nothing
+    if has_alpha and arr[:, :, -1].min() == 255:
+        arr = arr[:, :, :-1]
+        channels -= 1
+        has_alpha = False
+        transforms += ('drop_alpha',)
+        yield transforms, 'L' if channels == 1 else 'RGB', arr.reshape(height, -1), 8, []
+
+    color = arr[:, :, :-1] if has_alpha else arr
+    # An RGB colour profile cannot be attached to greyscale samples
+    if 'icc_profile' not in img.info and color.shape[2] == 3 and (color[:, :, 0] == color[:, :, 1]).all() and (color[:, :, 1] == color[:, :, 2]).all():
+        arr = arr[:, :, [0, 3]] if has_alpha else arr[:, :, :1]
+        channels = arr.shape[2]
+        transforms += ('grayscale',)
+        yield transforms, 'LA' if has_alpha else 'L', arr.reshape(height, -1), 8, []
+
+    # Greyscale whose levels sit on a coarser grid fits in 1, 2 or 4 bits per sample
+    if channels == 1:
+        levels = arr[:, :, 0]
+        for bits in (1, 2, 4):
+            step = 255 // (2 ** bits - 1)
+            if not (levels % step).any():
+                yield transforms + ('bit_depth',), 'L', _pack_bits(levels // step, bits), bits, []
+                break
+
+    keys = np.zeros((height, width), dtype=np.uint32)
+    for channel in range(channels):
+        keys = (keys << 8) | arr[:, :, channel]
+    colors, indices = np.unique(keys, return_inverse=True)
+    if len(colors) > 256 or channels == 1:
+        return
+    indices = indices.reshape(height, width).astype(np.uint8)
+    palette = np.stack([(colors >> (8 * (channels - 1 - c))) & 0xFF for c in range(channels)], axis=1).astype(np.uint8)
+    if channels == 2:
+        palette = palette[:, [0, 0, 0, 1]]
+    rgb = palette[:, :3]
+    chunks = [png_chunk(b'PLTE', rgb.tobytes())]
+    if palette.shape[1] == 4:
+        alpha = palette[:, 3]
+        # Only palette entries before the last translucent one need a tRNS value
+        translucent = np.flatnonzero(alpha < 255)
+        if len(translucent):
+            chunks.append(png_chunk(b'tRNS', alpha[:translucent[-1] + 1].tobytes()))
+    yield transforms + ('palette',), 'P', indices, 8, chunks
+
+    for bits in (1, 2, 4):
+        if len(colors) <= 2 ** bits:
+            yield transforms + ('palette', 'bit_depth'), 'P', _pack_bits(indices, bits), bits, chunks
+            break
+
+
+def _pack_bits(values, bits):
+    """
+    Pack a 2-D array of small unsigned values into PNG scanlines of bits per sample.
+    """
+    height, width = values.shape
+    per_byte = 8 // bits
+    padded = np.zeros((height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :width] = values
+    groups = padded.reshape(height, -1, per_byte)
+    packed = np.zeros(groups.shape[:2], dtype=np.uint8)
+    for position in range(per_byte):
+        packed |= groups[:, :, position] << (8 - bits * (position + 1))
+    return packed
+
+
+def _filter_rows(rows, bpp, method):
+    """
+    Return PNG-filtered scanlines (filter byte first) for a 2-D uint8 array of raw rows.
+    Every filter reads only unfiltered neighbours, so all rows are filtered at once.
+    """
+    raw = rows.astype(np.int16)
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    up = np.zeros_like(raw)
+    up[1:] = raw[:-1]
+    up_left = np.zeros_like(raw)
+    up_left[1:, bpp:] = raw[:-1, :-bpp]
+
+    def paeth():
+        estimate = left + up - up_left
+        distance_left = np.abs(estimate - left)
+        distance_up = np.abs(estimate - up)
+        distance_up_left = np.abs(estimate - up_left)
+        predictor = np.where(
+            (distance_left <= distance_up) & (distance_left <= distance_up_left), left,
+            np.where(distance_up <= distance_up_left, up, up_left)
+        )
+        return raw - predictor
+
+    candidates = {
+        'none': lambda: raw,
+        'sub': lambda: raw - left,
+        'up': lambda: raw - up,
+        'average': lambda: raw - (left + up) // 2,
+        'paeth': paeth,
+    }
+    if method == 'adaptive':
+        names = list(FILTER_TYPES)
+        filtered = np.stack([candidates[name]().astype(np.uint8) for name in names])
+        # Score bytes as signed deltas, so small negative residuals count as small
+        scores = np.abs(filtered.astype(np.int8).astype(np.int16)).sum(axis=2)
+        choice = scores.argmin(axis=0)
+        data = filtered[choice, np.arange(len(choice))]
+        types = np.array([FILTER_TYPES[name] for name in names], dtype=np.uint8)[choice]
+    else:
+        data = candidates[method]().astype(np.uint8)
+        types = np.full(len(data), FILTER_TYPES[method], dtype=np.uint8)
+    return np.column_stack([types, data]).tobytes()
+
+
+def _trial(variant, method, width, icc_profile):
+    """
+    Filter one variant with one method and compress it with every zlib strategy.
+    Returns [(transforms, method, strategy, png bytes)].
+    """
+    transforms, mode, rows, bit_depth, chunks = variant
+    height = rows.shape[0]
+    if icc_profile:
+        chunks = [png_chunk(b'iCCP', b'ICC Profile\x00\x00' + zlib.compress(icc_profile))] + chunks
+    # Filters look back one whole pixel, or one byte for sub-byte samples
+    bpp = max(1, len(mode) * bit_depth // 8)
+    filtered = _filter_rows(rows, bpp, method)
+    header = png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, COLOR_TYPES[mode], 0, 0, 0))
+
+    results = []
+    for strategy, zlib_strategy in ZLIB_STRATEGIES.items():
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, zlib_strategy)
+        data = compressor.compress(filtered) + compressor.flush()
+        png = b''.join([PNG_SIGNATURE, header, *chunks, png_chunk(b'IDAT', data), png_chunk(b'IEND', b'')])
+        results.append((transforms, method, strategy, png))
+    return results
+
+
+def optimize_png(img, report=None):
+    """
+    Losslessly encode img as the smallest PNG found by a strategy search.
+    Candidate images (alpha dropped when fully opaque, greyscale when the channels
+    are equal, an exact palette when there are at most 256 colours, fewer bits per
+    sample where the values allow) are each written with several row filters and
+    zlib strategies, concurrently. The smallest candidate that decodes to exactly
+    the source pixels wins; Pillow's optimize=True encode is the fallback.
+    If report is a dict it is filled with the baseline size, the winning strategy
+    and the bytes each strategy saved over the baseline at best.
+    """
+    baseline = _pillow_png(img)
+    variants = list(_variants(img)) if img.mode in SOURCE_MODES + ('P', '1') else []
+    icc_profile = img.info.get('icc_profile')
+    jobs = [(variant, method, img.width, icc_profile) for variant in variants for method in FILTERS]
+
+    candidates = [(('original',), 'pillow', 'default', baseline)]
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(MAX_TRIAL_WORKERS, len(jobs))) as executor:
+            for results in executor.map(lambda job: _trial(*job), jobs):
+                candidates.extend(results)
+    candidates.sort(key=lambda candidate: len(candidate[3]))
+
+    expected = None
+    winner = candidates[-1]
+    for candidate in candidates:
+        if candidate[1] == 'pillow':
+            winner = candidate
+            break
+        if expected is None:
+            expected = np.asarray(img.convert('RGBA'))
+        with Image.open(BytesIO(candidate[3])) as decoded:
+            if np.array_equal(np.asarray(decoded.convert('RGBA')), expected):
+                winner = candidate
+                break
+        logger.warning(f"PNG candidate {_strategy_name(candidate)} did not round-trip; skipped")
+
+    if report is not None:
+        saved = {}
+        for transforms, method, strategy, data in candidates:
+            for name in transforms + (f"filter_{method}", f"zlib_{strategy}"):
+                saved[name] = max(saved.get(name, 0), len(baseline) - len(data))
+        report.update({
+            'baseline_bytes': len(baseline),
+            'output_bytes': len(winner[3]),
+            'strategy': _strategy_name(winner),
+            'saved': saved,
+        })
+    return winner[3]
+
+
+def _strategy_name(candidate):
+    transforms, method, strategy, _ = candidate
+    return f"{'+'.join(transforms)}/{method}/{strategy}"
+
+
+def record_png_report(report):
+    """
+    Add one image's strategy report to the running totals in Redis.
+    """
+    try:
+        pipeline = get_redis_connection('default').pipeline()
+        pipeline.hincrby(STATS_KEY, 'images', 1)
+        pipeline.hincrby(STATS_KEY, 'baseline_bytes', report['baseline_bytes'])
+        pipeline.hincrby(STATS_KEY, 'output_bytes', report['output_bytes'])
+        for name, saved in report['saved'].items():
+            pipeline.hincrby(STATS_KEY, f"{name}:saved", saved)
+        transforms, method, strategy = report['strategy'].split('/')
+        for name in transforms.split('+') + [f"filter_{method}", f"zlib_{strategy}"]:
+            pipeline.hincrby(STATS_KEY, f"{name}:wins", 1)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Could not record PNG strategy report: {e}")
+
+
+def png_strategy_stats():
+    """
+    Per-strategy totals: how often it was part of the winning encode and how many
+    bytes it saved over Pillow's encoder summed across images. A strategy that
+    rarely wins and saves little is a candidate for removal from the search.
+    """
+    totals = {k.decode(): int(v) for k, v in get_redis_connection('default').hgetall(STATS_KEY).items()}
+    images = totals.pop('images', 0)
+    summary = {
+        'images': images,
+        'baseline_bytes': totals.pop('baseline_bytes', 0),
+        'output_bytes': totals.pop('output_bytes', 0),
+        'strategies': {},
+    }
+    for key, value in totals.items():
+        name, field = key.rsplit(':', 1)
+        summary['strategies'].setdefault(name, {'wins': 0, 'saved': 0})[field] = value
+    for stats in summary['strategies'].values():
+        stats['win_rate'] = round(stats['wins'] / images, 4) if images else None
+    return summary
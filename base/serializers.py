@@ -1,9 +1,95 @@
+import json
+import logging
 from rest_framework import serializers
-from .models import UploadedImage
+from .models import UploadedImage, ImageRendition
+from django.utils import timezone
+from PIL import Image
+from .utils import hash_uploaded_file, extract_metadata
+from .operations import ORIENTATION_TAG, validate_operations, plan_operations
+
+logger = logging.getLogger(__name__)
+
+
+class ImageRenditionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImageRendition
+        fields = ['width', 'height', 'format', 'file', 'file_size']
+        read_only_fields = fields
+
+
+def share_renditions(source, uploaded_image):
+    """
+    Point uploaded_image at the rendition files already stored for source.
+    """
+    ImageRendition.objects.bulk_create([
+        ImageRendition(
+            image=uploaded_image,
+            width=rendition.width,
+            height=rendition.height,
+            format=rendition.format,
+            file=rendition.file.name,
+            file_size=rendition.file_size,
+        )
+        for rendition in source.renditions.all()
+    ])
+
+
+class BulkImageListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        """
+        Insert the uploads of a batch with a bulk_create for the distinct ones and
+        one for the repeats. Identical earlier uploads are reused the same way as for
+        single uploads. A file repeated within the batch with the same parameters is
+        stored and optimized once: the repeats point at the first one's blobs and are
+        marked with duplicate_of (not saved) until its optimization fills them in.
+        """
+        first = {}
+        leader_of = [
+            first.setdefault(key, index) if key else index
+            for index, key in enumerate(map(self.child.dedup_key, validated_data))
+        ]
+        leaders = [index for index, leader in enumerate(leader_of) if leader == index]
+        repeats = [index for index, leader in enumerate(leader_of) if leader != index]
+
+        sources = {index: self.child.reuse_stored_blobs(validated_data[index]) for index in leaders}
+        created = dict(zip(leaders, UploadedImage.objects.bulk_create(
+            [UploadedImage(**validated_data[index]) for index in leaders]
+        )))
+        for index in repeats:
+            leader = created[leader_of[index]]
+            validated_data[index]['original_image'] = leader.original_image.name
+            if sources[leader_of[index]] is not None:
+                for field in UploadedImage.PROCESSED_FIELDS:
+                    validated_data[index][field] = getattr(leader, field)
+                validated_data[index]['optimized_image'] = leader.optimized_image.name
+                validated_data[index]['status'] = 'completed'
+        created.update(zip(repeats, UploadedImage.objects.bulk_create(
+            [UploadedImage(**validated_data[index]) for index in repeats]
+        )))
+
+        for index, uploaded_image in created.items():
+            source = sources[leader_of[index]]
+            if source is not None:
+                share_renditions(source, uploaded_image)
+            elif index != leader_of[index]:
+                uploaded_image.duplicate_of = created[leader_of[index]]
+        return [created[index] for index in range(len(validated_data))]
+
 
 class ImageSerializer(serializers.ModelSerializer):
+    rendition_widths = serializers.ListField(
+        child=serializers.ChoiceField(choices=UploadedImage.RENDITION_WIDTHS),
+        required=False
+    )
+    rendition_formats = serializers.ListField(
+        child=serializers.ChoiceField(choices=UploadedImage.ENCODED_FORMAT_CHOICES),
+        required=False
+    )
+    renditions = ImageRenditionSerializer(many=True, read_only=True)
+
     class Meta:
         model = UploadedImage
+        list_serializer_class = BulkImageListSerializer
         fields = [
             'id',
             'original_image',
@@ -18,6 +104,24 @@ class ImageSerializer(serializers.ModelSerializer):
             'gps_longitude',
             'uploaded_at',
             'output_format',
+            'target_max_bytes',
+            'target_min_similarity',
+            'optimized_format',
+            'candidate_sizes',
+            'encode_quality',
+            'optimized_size',
+            'similarity_score',
+            'lqip',
+            'blurhash',
+            'dominant_color',
+            'status',
+            'batch_id',
+            'rendition_widths',
+            'rendition_formats',
+            'operations',
+            'drop_duplicate_frames',
+            'frame_count',
+            'renditions',
         ]
         read_only_fields = [
             'id',
@@ -31,18 +135,189 @@ class ImageSerializer(serializers.ModelSerializer):
             'gps_latitude',
             'gps_longitude',
             'uploaded_at',
+            'optimized_format',
+            'candidate_sizes',
+            'encode_quality',
+            'optimized_size',
+            'similarity_score',
+            'lqip',
+            'blurhash',
+            'dominant_color',
+            'frame_count',
+            'status',
+            'batch_id',
+            'renditions',
         ]
 
     def validate_output_format(self, value):
         """
-        Validate that output_format is one of the supported formats (WEBP, JPEG, PNG).
+        Validate that output_format is one of the supported formats (WEBP, JPEG, PNG, AUTO).
         """
         if value and value not in dict(UploadedImage.OUTPUT_FORMAT_CHOICES).keys():
             raise serializers.ValidationError(
-                "Invalid output format. Supported formats: WEBP, JPEG, PNG."
+                "Invalid output format. Supported formats: WEBP, JPEG, PNG, AUTO."
             )
         return value
 
+    def validate_target_max_bytes(self, value):
+        """
+        Reject byte budgets too small to hold any real image.
+        """
+        if value is not None and value < 1024:
+            raise serializers.ValidationError("target_max_bytes must be at least 1024.")
+        return value
+
+    def validate_target_min_similarity(self, value):
+        """
+        The similarity floor is an SSIM score, so it must lie in (0, 1].
+        """
+        if value is not None and not 0 < value <= 1:
+            raise serializers.ValidationError("target_min_similarity must be between 0 and 1.")
+        return value
+
+    def validate_operations(self, value):
+        """
+        Check the operations list and normalise it, so identical edits produce identical dedup keys.
+        """
+        try:
+            return validate_operations(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+    def validate(self, attrs):
+        """
+        Normalise processing parameters and record the upload's hash for deduplication
+        (taken while the upload streamed in, see base.uploadhandler).
+        Default rendition formats to WEBP and JPEG when only widths are given.
+        Estimate the optimization's cost, so queueing the task never has to.
+        """
+        if attrs.get('rendition_widths') and not attrs.get('rendition_formats'):
+            attrs['rendition_formats'] = ['WEBP', 'JPEG']
+        # Sorted so identical requests produce identical dedup keys
+        attrs['rendition_widths'] = sorted(set(attrs.get('rendition_widths', [])))
+        attrs['rendition_formats'] = sorted(set(attrs.get('rendition_formats', [])))
+        if 'original_image' in attrs:
+            upload = attrs['original_image']
+            # Files that did not come through the upload handlers are hashed here
+            attrs['content_hash'] = getattr(upload, 'content_hash', None) or hash_uploaded_file(upload)
+            attrs.update(self.read_metadata(attrs['original_image']))
+            if attrs.get('operations') and attrs.get('width'):
+                self.check_operations_fit(attrs)
+            attrs['estimated_cpu_seconds'] = self.estimate_cost(attrs)
+        return attrs
+
+    def estimate_cost(self, attrs):
+        """
+        Expected CPU-seconds of optimizing the upload, from its recorded dimensions,
+        size and format and the requested processing.
+        """
+        # Imported here: base.tasks imports this module
+        from .tasks import optimize_cost
+
+        params = self.processing_params(attrs)
+        return round(optimize_cost(
+            attrs.get('width'), attrs.get('height'), attrs['original_image'].size,
+            len(params['rendition_widths']) * len(params['rendition_formats']),
+            output_format=params['output_format'] or 'WEBP',
+            source_format=attrs.get('format'),
+            max_bytes=params['target_max_bytes'],
+            min_similarity=params['target_min_similarity'],
+            operations=len(params['operations']),
+        ), 2)
+
+    def check_operations_fit(self, attrs):
+        """
+        Plan the operations against the recorded dimensions, so a crop outside the
+        image is rejected here rather than failing the optimization later.
+        """
+        orientation = None
+        if any(operation['op'] == 'auto_orient' for operation in attrs['operations']):
+            try:
+                with Image.open(attrs['original_image']) as img:
+                    orientation = img.getexif().get(ORIENTATION_TAG)
+            finally:
+                attrs['original_image'].seek(0)
+        try:
+            plan_operations(attrs['operations'], (attrs['width'], attrs['height']), orientation=orientation)
+        except ValueError as e:
+            raise serializers.ValidationError({'operations': str(e)})
+
+    def read_metadata(self, uploaded_file):
+        """
+        Header-only metadata (dimensions, camera, capture time, GPS) so the 201
+        response carries it while pixel optimization runs in the background.
+        """
+        try:
+            metadata = extract_metadata(uploaded_file)
+        except Image.DecompressionBombError as e:
+            # optimize_image could not open it either
+            logger.warning(f"Rejected upload {uploaded_file.name}: {e}")
+            raise serializers.ValidationError({'original_image': "Image has too many pixels to process."})
+        except Exception:
+            raise serializers.ValidationError({'original_image': "Uploaded file is not a valid image."})
+        finally:
+            uploaded_file.seek(0)
+        if metadata.get('taken_at'):
+            metadata['taken_at'] = timezone.make_aware(metadata['taken_at'])
+        return metadata
+
+    def processing_params(self, validated_data):
+        """
+        The requested processing of validated_data, with the model's defaults filled in.
+        """
+        return {
+            field: validated_data.get(field, UploadedImage._meta.get_field(field).get_default())
+            for field in UploadedImage.PROCESSING_PARAMS
+        }
+
+    def dedup_key(self, validated_data):
+        """
+        Uploads with equal keys produce identical output; None if the content is not hashed.
+        """
+        if not validated_data.get('content_hash'):
+            return None
+        params = self.processing_params(validated_data)
+        return validated_data['content_hash'], json.dumps(params, sort_keys=True)
+
+    def reuse_stored_blobs(self, validated_data):
+        """
+        Point validated_data at blobs already stored for identical content.
+        - An identical original is referenced instead of written to originals/ again.
+        - If it was already optimized with the same parameters, the optimized image
+          and metadata are shared too, so no optimization needs to run.
+        Returns the optimized upload being reused, or None.
+        """
+        content_hash = validated_data.get('content_hash')
+        if not content_hash:
+            return None
+        existing = UploadedImage.objects.filter(content_hash=content_hash).order_by('uploaded_at')
+        source = existing.first()
+        if source is None:
+            return None
+
+        validated_data['original_image'] = source.original_image.name
+        optimized = existing.filter(
+            status='completed', **self.processing_params(validated_data),
+        ).exclude(optimized_image='').exclude(optimized_image__isnull=True).first()
+        if optimized is None:
+            return None
+
+        for field in UploadedImage.PROCESSED_FIELDS:
+            validated_data[field] = getattr(optimized, field)
+        validated_data['optimized_image'] = optimized.optimized_image.name
+        validated_data['status'] = 'completed'
+        return optimized
+
+    def create(self, validated_data):
+        """
+        Create the upload, sharing stored blobs with an identical earlier upload.
+        """
+        source = self.reuse_stored_blobs(validated_data)
+        uploaded_image = super().create(validated_data)
+        if source is not None:
+            share_renditions(source, uploaded_image)
+        return uploaded_image
+
 
 
     def validate_original_image(self, value):
@@ -52,8 +327,8 @@ class ImageSerializer(serializers.ModelSerializer):
         max_size = 10 * 1024 * 1024  # 10MB
         if value.size > max_size:
             raise serializers.ValidationError("Image file too large (max 10MB).")
-        if not value.name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+        if not value.name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.gif')):
             raise serializers.ValidationError(
-                "Unsupported image format. Use PNG, JPG, or WEBP."
+                "Unsupported image format. Use PNG, JPG, WEBP or GIF."
             )
         return value
\ No newline at end of file
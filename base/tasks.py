@@ -1,83 +1,164 @@
+import math
 import logging
-from celery import shared_task
+from celery import group, shared_task
 from PIL import Image
-from PIL.ExifTags import TAGS
+from django.conf import settings
 from django.core.files.base import ContentFile
-from io import BytesIO
-from .models import UploadedImage
-from datetime import datetime
+from .models import UploadedImage, ImageRendition
+from .serializers import share_renditions
+from .tiled import read_png_header, band_decodable, decoded_png_bytes, tiled_shrink
+from .resize import get_resize_engine
+from .phash import perceptual_hash
+from .operations import ORIENTATION_TAG, plan_operations, decode_size, execute_plan
+from .png import record_png_report
+from .placeholder import make_placeholders
+from .animated import ANIMATED_FORMATS, is_animated, encode_animation
+from .utils import DEFAULT_QUALITY, fit_within, apply_metadata_policy, shrink_on_load, encode_image, encode_output, encode_best_format, progressive_renditions
+from MetaSqueeze.admission import memory_admission
+from MetaSqueeze.celery import COST_HEADER
+from MetaSqueeze.fairshare import fair_share_job, job_finished
 from datetime import timedelta
 from django.utils.timezone import now
 
 logger = logging.getLogger(__name__)
 
-@shared_task
+# Longest side of the optimized image
+MAX_OPTIMIZED_SIZE = 1024
+
+# Memory estimates for admission control: a decoded bitmap plus resample working copies,
+# or for a tiled decode a few copies of one band plus the reduced canvas
+DECODE_MEMORY_FACTOR = 2
+TILED_BAND_COPIES = 4
+TILED_CANVAS_BYTES = 64 * 1024 * 1024
+
+# CPU-seconds of optimize_image, measured on JPEG and PNG photos from 0.1 to 24 megapixels
+# (JPEG draft decoding keeps large photos cheap; placeholders and the final encode do not scale)
+OPTIMIZE_BASE_SECONDS = 0.2
+OPTIMIZE_SECONDS_PER_MEGAPIXEL = 0.02
+OPTIMIZE_SECONDS_PER_RENDITION = 0.1
+OPTIMIZE_SECONDS_PER_MB = 0.05
+# Encode modes that cost more than one encode, in seconds per megapixel of the
+# optimized image (at most MAX_OPTIMIZED_SIZE), measured on 1024x768 photos and graphics:
+# - PNG: the lossless strategy search (variants x filters x zlib strategies)
+# - AUTO: a WEBP and a JPEG encode with an SSIM each, plus the PNG search unless the source is a photo
+# - a quality search per lossy format encoded: up to MAX_QUALITY_TRIALS encodes,
+#   with an SSIM each for min_similarity
+# - each operation, at most one pass over the pixels
+OPTIMIZE_PNG_SEARCH_SECONDS_PER_MEGAPIXEL = 5.0
+OPTIMIZE_AUTO_SECONDS_PER_MEGAPIXEL = 1.4
+OPTIMIZE_MAX_BYTES_SECONDS_PER_MEGAPIXEL = 2.0
+OPTIMIZE_MIN_SIMILARITY_SECONDS_PER_MEGAPIXEL = 4.5
+OPTIMIZE_SECONDS_PER_OPERATION_MEGAPIXEL = 0.15
+# Source formats whose images are photos, for which AUTO skips the PNG search
+PHOTO_FORMATS = ('JPEG', 'MPO')
+
+
+def estimate_optimize_memory(image_id):
+    """
+    Expected peak memory of optimize_image in bytes, read from the image header only.
+    """
+    original_image_path = UploadedImage.objects.only('original_image').get(id=image_id).original_image.path
+    png_header = read_png_header(original_image_path)
+    if band_decodable(png_header) and decoded_png_bytes(png_header) > settings.IMAGE_TILED_RESIZE_THRESHOLD:
+        return TILED_BAND_COPIES * settings.IMAGE_TILED_BAND_BYTES + TILED_CANVAS_BYTES
+    with Image.open(original_image_path) as img:
+        return img.width * img.height * len(img.getbands()) * DECODE_MEMORY_FACTOR
+
+
+def optimize_cost(width, height, file_size, renditions=0, output_format='WEBP', source_format=None,
+                  max_bytes=None, min_similarity=None, operations=0):
+    """
+    Expected CPU-seconds of optimizing an image: a fixed part (placeholders, final
+    encode), its pixel count, one encode per rendition, and its file size, which
+    tracks decode work for PNG and frame count for animations. On top come the
+    encode modes that run several encodes of the optimized image (PNG and AUTO
+    searches, quality search for a target) and the operations.
+    """
+    megapixels = (width or 0) * (height or 0) / 1e6
+    output_megapixels = math.prod(fit_within(width or 0, height or 0, (MAX_OPTIMIZED_SIZE, MAX_OPTIMIZED_SIZE))) / 1e6
+    target_search = (
+        (OPTIMIZE_MAX_BYTES_SECONDS_PER_MEGAPIXEL if max_bytes else 0)
+        + (OPTIMIZE_MIN_SIMILARITY_SECONDS_PER_MEGAPIXEL if min_similarity else 0)
+    )
+    if output_format == 'PNG':
+        encode = OPTIMIZE_PNG_SEARCH_SECONDS_PER_MEGAPIXEL
+    elif output_format == 'AUTO':
+        # Both lossy candidates search the quality when a target is set
+        encode = 2 * target_search or OPTIMIZE_AUTO_SECONDS_PER_MEGAPIXEL
+        if source_format not in PHOTO_FORMATS:
+            encode += OPTIMIZE_PNG_SEARCH_SECONDS_PER_MEGAPIXEL
+    else:
+        encode = target_search
+    return (
+        OPTIMIZE_BASE_SECONDS
+        + megapixels * OPTIMIZE_SECONDS_PER_MEGAPIXEL
+        + renditions * OPTIMIZE_SECONDS_PER_RENDITION
+        + file_size / 2**20 * OPTIMIZE_SECONDS_PER_MB
+        + output_megapixels * (encode + operations * OPTIMIZE_SECONDS_PER_OPERATION_MEGAPIXEL)
+    )
+
+
+@shared_task(bind=True)
+@fair_share_job('image')
+@memory_admission(estimate_optimize_memory)
 def optimize_image(image_id):
     try:
         # Fetch the image from the database
         uploaded_image = UploadedImage.objects.get(id=image_id)
         original_image_path = uploaded_image.original_image.path
 
+        # Determine output format (default to WEBP if not specified)
+        output_format = uploaded_image.output_format or 'WEBP'
+        if output_format not in dict(UploadedImage.OUTPUT_FORMAT_CHOICES):
+            logger.error(f"Unsupported output format {output_format} for image {image_id}")
+            fail_optimization(image_id)
+            return False
+
+        # PNGs too large to decode whole are decoded band by band within a fixed memory ceiling
+        png_header = read_png_header(original_image_path)
+        if band_decodable(png_header) and decoded_png_bytes(png_header) > settings.IMAGE_TILED_RESIZE_THRESHOLD:
+            uploaded_image.format = 'PNG'
+            uploaded_image.width, uploaded_image.height = png_header[:2]
+            source_size = png_header[:2]
+            plan = plan_for(uploaded_image, orientation=None)
+            img = tiled_shrink(
+                original_image_path,
+                decode_size(plan, source_size) if plan else decode_size_for(uploaded_image),
+                settings.IMAGE_TILED_BAND_BYTES
+            )
+            if plan:
+                img = execute_plan(img, plan, source_size)
+            finish_optimization(uploaded_image, img, output_format, strip_metadata=bool(plan and plan.strip_metadata))
+            return True
+
+        # EXIF metadata was already extracted from the header at upload time
         with Image.open(original_image_path) as img:
             # Store original image format and dimensions
             uploaded_image.format = img.format
             uploaded_image.width = img.width
             uploaded_image.height = img.height
+            source_size = img.size
+            orientation = img.getexif().get(ORIENTATION_TAG)
+            plan = plan_for(uploaded_image, orientation)
+            strip_metadata = bool(plan and plan.strip_metadata)
 
-            # Extract EXIF metadata
-            exif_data = img._getexif() if img._getexif() else None
-            if exif_data:
-                for tag, value in exif_data.items():
-                    tag_name = TAGS.get(tag, tag)
-                    if tag_name == 'Make':
-                        uploaded_image.camera_make = value
-                    elif tag_name == 'Model':
-                        uploaded_image.camera_model = value
-                    elif tag_name == 'DateTime':
-                        try:
-                            uploaded_image.taken_at = datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
-                        except ValueError:
-                            logger.warning(f"Invalid DateTime format for image {image_id}: {value}")
-                    elif tag_name == 'GPSLatitude' and isinstance(value, tuple):
-                        ref = exif_data.get(TAGS.get('GPSLatitudeRef'), 'N')
-                        uploaded_image.gps_latitude = convert_gps_to_decimal(*value, ref)
-                    elif tag_name == 'GPSLongitude' and isinstance(value, tuple):
-                        ref = exif_data.get(TAGS.get('GPSLongitudeRef'), 'E')
-                        uploaded_image.gps_longitude = convert_gps_to_decimal(*value, ref)
-
-            # Optimize image: resize to max 1024px while preserving aspect ratio
-            max_size = 1024
-            img.thumbnail((max_size, max_size), Image.LANCZOS)
-
-            # Determine output format (default to WEBP if not specified)
-            output_format = uploaded_image.output_format or 'WEBP'
-            optimized_image_name = f"optimized_{uploaded_image.id}.{output_format.lower()}"
-            optimized_image_io = BytesIO()
-
-            # Save optimized image in the chosen format
-            if output_format == 'WEBP':
-                img.save(optimized_image_io, format='WEBP', quality=85)
-            elif output_format == 'JPEG':
-                # Convert to RGB if necessary (JPEG doesn't support transparency)
-                if img.mode in ('RGBA', 'LA'):
-                    img = img.convert('RGB')
-                img.save(optimized_image_io, format='JPEG', quality=85, optimize=True)
-            elif output_format == 'PNG':
-                img.save(optimized_image_io, format='PNG', optimize=True)
-            else:
-                logger.error(f"Unsupported output format {output_format} for image {image_id}")
-                return False
-
-            # Save optimized image to model
-            optimized_image_io.seek(0)
-            uploaded_image.optimized_image.save(
-                optimized_image_name,
-                ContentFile(optimized_image_io.getvalue())
-            )
+            animation = None
+            if output_format in ANIMATED_FORMATS and is_animated(img):
+                # Stream every frame through resize and encode; the first frame then
+                # goes through the still pipeline for renditions and placeholders
+                animation = encode_animation(
+                    img,
+                    frame_transform(uploaded_image, orientation, source_size),
+                    drop_duplicates=uploaded_image.drop_duplicate_frames,
+                    icc_profile=None if strip_metadata else img.info.get('icc_profile'),
+                )
 
-            # Save updated model fields
-            uploaded_image.save()
-            img.close()
+            # Decode at a reduced scale first so the full-resolution bitmap is never built
+            img = shrink_on_load(img, decode_size(plan, source_size) if plan else decode_size_for(uploaded_image))
+            if plan:
+                # Crop, resize, orient and sharpen in one pass over the decoded pixels
+                img = execute_plan(img, plan, source_size)
+            finish_optimization(uploaded_image, img, output_format, strip_metadata=strip_metadata, animation=animation)
 
         return True
 
@@ -86,23 +167,210 @@ def optimize_image(image_id):
         return False
     except Exception as e:
         logger.error(f"Error optimizing image {image_id}: {e}", exc_info=True)
+        fail_optimization(image_id)
         return False
+    finally:
+        job_finished('image', image_id)
+
+
+def start_optimizations(image_ids):
+    """
+    Queue optimize_image for uploads the fair-share dispatcher released together,
+    as one Celery group. Each task carries the cost estimated at upload, which picks its lane.
+    """
+    costs = dict(UploadedImage.objects.filter(id__in=image_ids).values_list('id', 'estimated_cpu_seconds'))
+    group(
+        optimize_image.s(image_id).set(headers={COST_HEADER: costs.get(int(image_id))})
+        for image_id in image_ids
+    ).apply_async()
+
+
+def waiting_duplicates(uploaded_image):
+    """
+    Uploads of the same batch with identical content and parameters that were not
+    optimized themselves and wait for this upload's result.
+    """
+    if uploaded_image.batch_id is None or not uploaded_image.content_hash:
+        return UploadedImage.objects.none()
+    return UploadedImage.objects.filter(
+        batch_id=uploaded_image.batch_id,
+        content_hash=uploaded_image.content_hash,
+        status='pending',
+        **{field: getattr(uploaded_image, field) for field in UploadedImage.PROCESSING_PARAMS},
+    ).exclude(pk=uploaded_image.pk)
+
+
+def share_with_duplicates(uploaded_image):
+    """
+    Give the uploads waiting on an optimized upload its optimized image and renditions.
+    """
+    for duplicate in waiting_duplicates(uploaded_image):
+        for field in UploadedImage.PROCESSED_FIELDS:
+            setattr(duplicate, field, getattr(uploaded_image, field))
+        duplicate.optimized_image = uploaded_image.optimized_image.name
+        duplicate.status = 'completed'
+        duplicate.save()
+        share_renditions(uploaded_image, duplicate)
+
 
-def convert_gps_to_decimal(degrees, minutes, seconds, direction):
+def fail_optimization(image_id):
+    UploadedImage.objects.filter(id=image_id).update(status='failed')
+    uploaded_image = UploadedImage.objects.filter(id=image_id).first()
+    if uploaded_image is not None:
+        waiting_duplicates(uploaded_image).update(status='failed')
+
+
+def decode_size_for(uploaded_image):
+    """
+    Bounding box the original must be decoded at to serve the optimized image and
+    every requested rendition from a single decode.
+    """
+    rendition_widths = uploaded_image.rendition_widths or []
+    if rendition_widths:
+        # Renditions are bounded by width only, whichever way up the image ends up
+        return (
+            max([MAX_OPTIMIZED_SIZE] + rendition_widths),
+            max(uploaded_image.width, uploaded_image.height)
+        )
+    return (MAX_OPTIMIZED_SIZE, MAX_OPTIMIZED_SIZE)
+
+
+def plan_for(uploaded_image, orientation):
+    """
+    Fold the upload's operations list into a single plan, or None if it has none.
+    The output is capped at the decode size, so no second resample is needed.
+    """
+    if not uploaded_image.operations:
+        return None
+    return plan_operations(
+        uploaded_image.operations,
+        (uploaded_image.width, uploaded_image.height),
+        orientation=orientation,
+        bound=decode_size_for(uploaded_image),
+    )
+
+
+def frame_transform(uploaded_image, orientation, source_size):
+    """
+    Per-frame edit for animations: the operations plan, or a plain resize, down to
+    the optimized size in a single resample.
+    """
+    bound = (MAX_OPTIMIZED_SIZE, MAX_OPTIMIZED_SIZE)
+    if uploaded_image.operations:
+        plan = plan_operations(uploaded_image.operations, source_size, orientation=orientation, bound=bound)
+        return lambda frame: execute_plan(frame, plan, source_size)
+    size = fit_within(*source_size, bound)
+    resize = get_resize_engine()
+    return lambda frame: resize(frame, size) if frame.size != size else frame
+
+
+def finish_optimization(uploaded_image, img, output_format, strip_metadata=False, animation=None):
+    """
+    Produce renditions and the optimized image from a decoded (already reduced)
+    image, then persist the results on the model.
+    animation is the (data, frame_count) of an already encoded animated WEBP,
+    used as the optimized image instead of encoding img.
     """
-    Convert GPS coordinates to decimal degrees.
+    apply_metadata_policy(img, strip=strip_metadata)
+    uploaded_image.perceptual_hash = perceptual_hash(img)
+
+    resize = get_resize_engine()
+    if uploaded_image.rendition_widths:
+        save_renditions(uploaded_image, img, uploaded_image.rendition_widths, uploaded_image.rendition_formats, resize)
+
+    # Optimize image: resize to max 1024px while preserving aspect ratio
+    size = fit_within(img.width, img.height, (MAX_OPTIMIZED_SIZE, MAX_OPTIMIZED_SIZE))
+    if size != img.size:
+        img = resize(img, size)
+    # Placeholders for first paint, derived from the pixels already in memory
+    for field, value in make_placeholders(img).items():
+        setattr(uploaded_image, field, value)
+    png_report = {}
+    uploaded_image.frame_count = 1
+    if animation is not None:
+        # WEBP is the only output format that keeps the animation
+        optimized_image_data, uploaded_image.frame_count = animation
+        quality, score = DEFAULT_QUALITY, None
+        if output_format == 'AUTO':
+            uploaded_image.candidate_sizes = {'WEBP': len(optimized_image_data)}
+        output_format = 'WEBP'
+    elif output_format == 'AUTO':
+        # Encode every candidate format and keep the smallest that looks right
+        output_format, optimized_image_data, quality, score, sizes = encode_best_format(
+            img,
+            max_bytes=uploaded_image.target_max_bytes,
+            min_similarity=uploaded_image.target_min_similarity,
+            png_report=png_report,
+        )
+        uploaded_image.candidate_sizes = sizes
+    else:
+        optimized_image_data, quality, score = encode_output(
+            img,
+            output_format,
+            max_bytes=uploaded_image.target_max_bytes,
+            min_similarity=uploaded_image.target_min_similarity,
+            png_report=png_report,
+        )
+    if output_format == 'PNG':
+        uploaded_image.png_report = png_report
+        record_png_report(png_report)
+    optimized_image_name = f"optimized_{uploaded_image.id}.{output_format.lower()}"
+    uploaded_image.optimized_format = output_format
+    uploaded_image.encode_quality = quality
+    uploaded_image.similarity_score = score
+    uploaded_image.optimized_size = len(optimized_image_data)
+
+    # Save optimized image to model
+    uploaded_image.optimized_image.save(
+        optimized_image_name,
+        ContentFile(optimized_image_data)
+    )
+
+    # Save updated model fields
+    uploaded_image.status = 'completed'
+    uploaded_image.save()
+    share_with_duplicates(uploaded_image)
+    img.close()
+
+
+def save_renditions(uploaded_image, img, widths, formats, resize=None):
     """
-    decimal = degrees + (minutes / 60.0) + (seconds / 3600.0)
-    if direction in ['S', 'W']:
-        decimal = -decimal
-    return decimal
+    Encode every (width, format) pair from an already-decoded image.
+    Sizes are produced largest first, each derived from the next larger one.
+    """
+    formats = formats or ['WEBP', 'JPEG']
+    for width, rendition in progressive_renditions(img, widths, resize):
+        for rendition_format in formats:
+            data = encode_image(rendition, rendition_format)
+            record, _ = ImageRendition.objects.update_or_create(
+                image=uploaded_image,
+                width=width,
+                format=rendition_format,
+                defaults={'height': rendition.height, 'file_size': len(data)},
+            )
+            if record.file:
+                record.file.delete(save=False)
+            record.file.save(
+                f"rendition_{uploaded_image.id}_{width}.{rendition_format.lower()}",
+                ContentFile(data)
+            )
+
 
+def delete_if_unreferenced(field_file, references):
+    """
+    Delete a stored file unless another row still references it.
+    Identical uploads share blobs, so the number of referencing rows is the file's
+    reference count; the file goes only when the last reference is removed.
+    """
+    if field_file and not references.exists():
+        field_file.delete(save=False)
 
 
 @shared_task
 def cleanup_old_images():
     """
     Deletes images older than 30 days from the database and filesystem.
+    Files shared with newer identical uploads are kept until nothing references them.
     """
     try:
         threshold_date = now() - timedelta(days=30)
@@ -111,11 +379,22 @@ def cleanup_old_images():
         deleted_count = 0  # ✅ Counter for deleted images
 
         for image in old_images:
+            others = UploadedImage.objects.exclude(pk=image.pk)
+
             # Delete the image files from the filesystem
-            if image.original_image:
-                image.original_image.delete(save=False)
-            if image.optimized_image:
-                image.optimized_image.delete(save=False)
+            delete_if_unreferenced(
+                image.original_image,
+                others.filter(original_image=image.original_image.name)
+            )
+            delete_if_unreferenced(
+                image.optimized_image,
+                others.filter(optimized_image=image.optimized_image.name)
+            )
+            for rendition in image.renditions.all():
+                delete_if_unreferenced(
+                    rendition.file,
+                    ImageRendition.objects.filter(file=rendition.file.name).exclude(image=image)
+                )
 
             # Delete the image record from the database
             image.delete()
@@ -1,3 +1,828 @@
-from django.test import TestCase
+import os
+import json
+import base64
+import hashlib
+import struct
+import tempfile
+import zlib
+import time
+import multiprocessing
+from unittest import mock
+import fakeredis
+import numpy as np
+from PIL import Image, ImageFilter
+from io import BytesIO
+from datetime import timedelta
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from .tiled import PNG_SIGNATURE, read_png_header, tiled_shrink
+from .utils import peak_rss_mb
 
-# Create your tests here.
+
+def write_synthetic_png(path, width, height, rows_per_chunk=256):
+    """
+    Stream a greyscale gradient PNG to disk without ever holding the bitmap in memory.
+    """
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    compressor = zlib.compressobj(1)
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        for top in range(0, height, rows_per_chunk):
+            rows = b''.join(
+                b'\x00' + bytes([(y + x) % 256 for x in range(256)]) * (width // 256)
+                + bytes(width % 256)
+                for y in range(top, min(top + rows_per_chunk, height))
+            )
+            f.write(chunk(b'IDAT', compressor.compress(rows)))
+        f.write(chunk(b'IDAT', compressor.flush()))
+        f.write(chunk(b'IEND', b''))
+
+
+def image_bytes(size=(64, 48), color='red', image_format='JPEG', **params):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=image_format, **params)
+    return buffer.getvalue()
+
+
+class UploadTestCase(APITestCase):
+    """
+    API tests against a scratch MEDIA_ROOT and an in-memory cache (for throttling),
+    with the fair-share queue stubbed out.
+    """
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(
+            MEDIA_ROOT=media.name,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        cache.clear()
+        patcher = mock.patch('base.views.submit')
+        self.submit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data=None, name='photo.jpg', **fields):
+        upload = ContentFile(data or image_bytes(), name=name)
+        return self.client.post(reverse('trigger-task'), {'original_image': upload, **fields}, format='multipart')
+
+    def upload_batch(self, files, **fields):
+        uploads = [ContentFile(data, name=f'photo_{n}.jpg') for n, data in enumerate(files)]
+        return self.client.post(
+            reverse('image-batch-upload'), {'original_images': uploads, **fields}, format='multipart'
+        )
+
+
+def tiled_shrink_peak(path, band_bytes):
+    """
+    Run a tiled shrink in a fresh process; return (output size, peak RSS in MB).
+    """
+    img = tiled_shrink(path, (1024, 1024), band_bytes)
+    return img.size, peak_rss_mb()
+
+
+class TiledResizeTests(SimpleTestCase):
+    def test_peak_memory_bounded_on_400_megapixel_png(self):
+        width = height = 20000
+        band_bytes = 16 * 1024 * 1024
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'huge.png')
+            write_synthetic_png(path, width, height)
+            self.assertEqual(read_png_header(path)[:2], (width, height))
+
+            # A fresh process, so the peak reflects only the decode
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                size, peak = pool.apply(tiled_shrink_peak, (path, band_bytes))
+
+        decoded_mb = width * height / (1024 * 1024)
+        # Reduced by 9 (leaving 2x headroom over 1024), not yet resampled
+        self.assertEqual(size, (2223, 2223))
+        # Interpreter baseline plus a handful of band copies, far below the 381 MB bitmap
+        self.assertLess(peak, 160)
+        self.assertLess(peak, decoded_mb / 2)
+
+
+class ShrinkOnLoadTests(SimpleTestCase):
+    def test_jpeg_and_mpo_decode_at_reduced_dct_scale(self):
+        from .utils import shrink_on_load
+
+        photo = Image.new('RGB', (4000, 3000), 'gray')
+        jpeg = BytesIO()
+        photo.save(jpeg, 'JPEG')
+        # Phone cameras write MPO: a JPEG primary image followed by more pictures
+        mpo = BytesIO()
+        photo.save(mpo, 'MPO', save_all=True, append_images=[photo.copy()])
+
+        for source, image_format in ((jpeg, 'JPEG'), (mpo, 'MPO')):
+            with self.subTest(format=image_format), Image.open(source) as img:
+                self.assertEqual(img.format, image_format)
+                decoded = shrink_on_load(img, (500, 500))
+                # 1/4 scale still keeps 2x headroom over 500x375; the full 4000x3000 is never decoded
+                self.assertEqual(decoded.size, (1000, 750))
+
+
+class PerceptualHashIndexTests(SimpleTestCase):
+    def test_hamming_scan_over_5m_hashes(self):
+        # Imported here: the spawned worker of the tiled test imports this module before Django is set up
+        from .phash import PerceptualHashIndex
+
+        count = 5_000_000
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(-2**63, 2**63 - 1, count, dtype=np.int64)
+        target = int(hashes[123])
+        # Plant copies of the target with 1 and 3 bits flipped
+        hashes[456] = target ^ 1
+        hashes[789] = target ^ 0b10101
+        index = PerceptualHashIndex(np.arange(count), hashes)
+
+        start = time.perf_counter()
+        matches = index.query(target, 3, exclude_id=123)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(matches, [(456, 1), (789, 3)])
+        self.assertLess(elapsed, 0.1)
+
+
+class OperationPlanTests(SimpleTestCase):
+    def test_fused_plan_matches_sequential_edits_for_every_orientation(self):
+        from .operations import ORIENTATION_TRANSPOSE, validate_operations, plan_operations, execute_plan
+
+        gradient = np.add.outer(np.linspace(0, 255, 300), np.linspace(0, 255, 400)) / 2
+        source = Image.fromarray(np.stack([gradient, np.roll(gradient, 100, axis=1), 255 - gradient], -1).astype(np.uint8))
+        operations = validate_operations([
+            {'op': 'auto_orient'},
+            {'op': 'crop', 'box': [20, 10, 220, 210]},
+            {'op': 'resize', 'width': 100},
+            {'op': 'crop', 'box': [10, 20, 90, 80]},
+            {'op': 'sharpen'},
+        ])
+        for orientation in range(1, 9):
+            with self.subTest(orientation=orientation):
+                plan = plan_operations(operations, source.size, orientation)
+                fused = execute_plan(source, plan, source.size)
+
+                expected = source.transpose(ORIENTATION_TRANSPOSE[orientation]) if orientation > 1 else source
+                expected = (
+                    expected.crop((20, 10, 220, 210))
+                    .resize((100, 100), Image.LANCZOS)
+                    .crop((10, 20, 90, 80))
+                    .filter(ImageFilter.UnsharpMask())
+                )
+                self.assertEqual(fused.size, expected.size)
+                difference = np.abs(np.asarray(fused, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+                self.assertLessEqual(difference.mean(), 1)
+
+    def test_fused_resize_runs_on_the_configured_engine(self):
+        from .operations import validate_operations, plan_operations, execute_plan
+        from .resize import RESIZE_ENGINES
+
+        gradient = np.add.outer(np.linspace(0, 255, 300), np.linspace(0, 255, 400)) / 2
+        source = Image.fromarray(np.stack([gradient, 255 - gradient, gradient], -1).astype(np.uint8))
+        plan = plan_operations(validate_operations([
+            {'op': 'crop', 'box': [40, 30, 360, 270]},
+            {'op': 'resize', 'width': 160},
+        ]), source.size)
+        expected = source.crop((40, 30, 360, 270)).resize((160, 120), Image.LANCZOS)
+        for name, engine in RESIZE_ENGINES.items():
+            with self.subTest(engine=name), override_settings(IMAGE_RESIZE_ENGINE=name), \
+                    mock.patch.dict(RESIZE_ENGINES, {name: mock.Mock(wraps=engine)}):
+                result = execute_plan(source, plan, source.size)
+                RESIZE_ENGINES[name].assert_called_once_with(source, (160, 120), box=(40.0, 30.0, 360.0, 270.0))
+                self.assertEqual(result.size, (160, 120))
+                difference = np.abs(np.asarray(result, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+                self.assertLessEqual(difference.mean(), 1)
+
+
+class ResizeEngineTests(SimpleTestCase):
+    def test_engines_agree_on_size_mode_and_pixels(self):
+        from .resize import RESIZE_ENGINES
+
+        rng = np.random.default_rng(7)
+        gradient = np.add.outer(np.linspace(0, 255, 600), np.linspace(0, 255, 800)) / 2
+        pixels = np.stack([gradient, 255 - gradient, np.roll(gradient, 200, axis=1)], -1)
+        photo = Image.fromarray(np.clip(pixels + rng.normal(0, 8, pixels.shape), 0, 255).astype(np.uint8))
+        alpha = Image.fromarray(np.where(gradient > 96, 255, 0).astype(np.uint8))
+        sources = {
+            'RGB': photo,
+            'L': photo.convert('L'),
+            'RGBA': Image.merge('RGBA', (*photo.split(), alpha)),
+        }
+        for mode, source in sources.items():
+            reference = np.asarray(source.convert('RGBA').resize((200, 150), Image.LANCZOS), dtype=np.int16)
+            for name, engine in RESIZE_ENGINES.items():
+                with self.subTest(mode=mode, engine=name):
+                    result = engine(source, (200, 150))
+                    self.assertEqual(result.size, (200, 150))
+                    self.assertEqual(result.mode, mode)
+                    difference = np.abs(np.asarray(result.convert('RGBA'), dtype=np.int16) - reference)
+                    self.assertLessEqual(difference.mean(), 2)
+
+    def test_opencv_keeps_transparent_colour_out_of_edges(self):
+        from .resize import opencv_area
+
+        # Opaque white on the left, fully transparent red on the right
+        pixels = np.zeros((64, 64, 4), dtype=np.uint8)
+        pixels[:, :31] = (255, 255, 255, 255)
+        pixels[:, 31:] = (255, 0, 0, 0)
+        result = np.asarray(opencv_area(Image.fromarray(pixels, 'RGBA'), (16, 16)))
+        # Three opaque source columns and one transparent one
+        edge = result[:, 7]
+        self.assertTrue((edge[:, 3] < 255).all() and (edge[:, 3] > 0).all())
+        # No red bleeds into the visible edge pixels
+        self.assertTrue((np.abs(edge[:, 1].astype(int) - edge[:, 0]) <= 2).all())
+
+
+class OperationsUploadTests(UploadTestCase):
+    def test_crop_outside_the_image_is_rejected_at_upload(self):
+        from .models import UploadedImage
+
+        response = self.upload(image_bytes((64, 48)), operations=json.dumps([{'op': 'crop', 'box': [70, 0, 90, 10]}]))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('outside the 64x48 image', str(response.data['operations']))
+
+        # Upright, the photo is 48 wide
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        rotated = image_bytes((64, 48), exif=exif)
+        operations = [{'op': 'auto_orient'}, {'op': 'crop', 'box': [50, 0, 60, 10]}]
+        response = self.upload(rotated, operations=json.dumps(operations))
+        self.assertEqual(response.status_code, 400)
+        response = self.upload(rotated, operations=json.dumps(operations[1:]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(UploadedImage.objects.count(), 1)
+
+
+class PngOptimizeTests(SimpleTestCase):
+    def test_chosen_encoding_decodes_to_the_source_pixels(self):
+        from .png import optimize_png
+
+        ramp = np.add.outer(np.arange(48), np.arange(64))
+        palette = Image.fromarray((ramp % 16).astype(np.uint8), 'L').convert('P')
+        palette.putpalette([channel for index in range(16) for channel in (index * 16, 255 - index * 16, 40)])
+        palette.info['transparency'] = 3
+        grey_alpha = Image.merge('LA', (
+            Image.fromarray((ramp * 2).astype(np.uint8)),
+            Image.fromarray(np.where(ramp % 7 == 0, 0, 200).astype(np.uint8)),
+        ))
+        deep = Image.fromarray((ramp * 593).astype('<u2'), 'I;16')
+
+        for source in (palette, grey_alpha, deep):
+            with self.subTest(mode=source.mode):
+                report = {}
+                data = optimize_png(source, report)
+                with Image.open(BytesIO(data)) as decoded:
+                    self.assertTrue(np.array_equal(np.asarray(decoded.convert('RGBA')), np.asarray(source.convert('RGBA'))))
+                    if source.mode == 'I;16':
+                        # All 16 bits survive, not just what RGBA shows
+                        self.assertTrue(np.array_equal(np.asarray(decoded), np.asarray(source)))
+                self.assertEqual(report['output_bytes'], len(data))
+                self.assertLessEqual(len(data), report['baseline_bytes'])
+
+
+class PngReportTests(UploadTestCase):
+    def test_png_report_is_saved_on_the_image(self):
+        from .models import UploadedImage
+        from .tasks import optimize_image
+
+        redis = fakeredis.FakeStrictRedis()
+        for target in ('base.png', 'MetaSqueeze.admission', 'MetaSqueeze.fairshare'):
+            patcher = mock.patch(f'{target}.get_redis_connection', return_value=redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        graphic = BytesIO()
+        Image.new('RGB', (64, 48), 'white').save(graphic, 'PNG')
+        response = self.upload(graphic.getvalue(), name='graphic.png', output_format='PNG')
+        self.assertEqual(response.status_code, 201)
+
+        self.assertTrue(optimize_image(response.data['data']['id']))
+        uploaded_image = UploadedImage.objects.get()
+        self.assertEqual(uploaded_image.optimized_format, 'PNG')
+        self.assertEqual(uploaded_image.png_report['output_bytes'], uploaded_image.optimized_size)
+        self.assertEqual(set(uploaded_image.png_report), {'baseline_bytes', 'output_bytes', 'strategy', 'saved'})
+
+
+class PlaceholderTests(SimpleTestCase):
+    def test_blurhash_matches_the_reference_encoder(self):
+        from .placeholder import blurhash
+
+        # References from the C encoder of blurhash-python (4x3 and 3x4 components)
+        y, x = np.mgrid[0:48, 0:64]
+        landscape = Image.fromarray(np.stack([x * 4, y * 5, (x + y) * 2], -1).astype(np.uint8))
+        self.assertEqual(blurhash(landscape), 'L#HLF-2R$7SdmAa$jtf8gKfjfQfj')
+        y, x = np.mgrid[0:64, 0:48]
+        portrait = Image.fromarray(np.stack([x * 5, y * 4, (x + y) * 2], -1).astype(np.uint8))
+        self.assertEqual(blurhash(portrait), 'T#G9Z$6]wyhia$jtgefjfQi{a}jt')
+
+    def test_lqip_stays_within_its_byte_limit(self):
+        from .placeholder import LQIP_MAX_BYTES, LQIP_SIZE, lqip_data_uri, make_placeholders
+
+        rng = np.random.default_rng(0)
+        for mode in ('RGB', 'RGBA'):
+            with self.subTest(mode=mode):
+                # Noise at placeholder scale, so the thumbnail keeps all of it
+                noise = rng.integers(0, 256, (12, 16, len(mode)), dtype=np.uint8)
+                img = Image.fromarray(noise, mode).resize((1600, 1200), Image.NEAREST)
+                placeholders = make_placeholders(img)
+                self.assertLessEqual(len(placeholders['lqip']), LQIP_MAX_BYTES)
+                with Image.open(BytesIO(base64.b64decode(placeholders['lqip'].split(',', 1)[1]))) as lqip:
+                    self.assertEqual((lqip.format, max(lqip.size)), ('WEBP', LQIP_SIZE))
+
+        with mock.patch('base.placeholder.LQIP_MAX_BYTES', 100):
+            self.assertIsNone(lqip_data_uri(img))
+
+
+class RenditionTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        redis = fakeredis.FakeStrictRedis()
+        for target in ('MetaSqueeze.admission', 'MetaSqueeze.fairshare'):
+            patcher = mock.patch(f'{target}.get_redis_connection', return_value=redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def optimized_upload(self, **fields):
+        from . import tasks
+
+        response = self.upload(image_bytes((1200, 900)), **fields)
+        self.assertEqual(response.status_code, 201)
+        image_id = response.data['data']['id']
+        with mock.patch.object(tasks, 'shrink_on_load', wraps=tasks.shrink_on_load) as decode:
+            self.assertTrue(tasks.optimize_image(image_id))
+        self.assertEqual(decode.call_count, 1)
+        return image_id
+
+    def test_every_width_and_format_from_a_single_decode(self):
+        from .models import ImageRendition
+
+        image_id = self.optimized_upload(rendition_widths=[320, 640, 1024, 2048], rendition_formats=['WEBP', 'JPEG'])
+
+        renditions = ImageRendition.objects.filter(image_id=image_id)
+        # 2048 is wider than the 1200px original and is not upscaled
+        self.assertEqual(
+            sorted((rendition.width, rendition.format) for rendition in renditions),
+            [(width, rendition_format) for width in (320, 640, 1024) for rendition_format in ('JPEG', 'WEBP')],
+        )
+        for rendition in renditions:
+            with Image.open(rendition.file.path) as img:
+                self.assertEqual(img.format, rendition.format)
+                self.assertEqual(img.size, (rendition.width, rendition.height))
+                self.assertEqual(rendition.height, rendition.width * 3 // 4)
+
+    def test_width_query_serves_the_smallest_rendition_at_least_that_wide(self):
+        image_id = self.optimized_upload(rendition_widths=[320, 640, 1024], rendition_formats=['WEBP', 'JPEG'])
+        url = reverse('image-list', args=[image_id])
+
+        for query, filename in (
+            ('width=500', f'optimized_{image_id}_640w.webp'),
+            ('width=640', f'optimized_{image_id}_640w.webp'),
+            ('width=1', f'optimized_{image_id}_320w.webp'),
+            ('width=300&format=jpeg', f'optimized_{image_id}_320w.jpeg'),
+            # Nothing that wide: the widest there is
+            ('width=4000', f'optimized_{image_id}_1024w.webp'),
+        ):
+            with self.subTest(query=query):
+                # More requests than the 5/minute IP throttle allows
+                cache.clear()
+                response = self.client.get(f'{url}?{query}')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(filename, response['Content-Disposition'])
+                response.close()
+
+        cache.clear()
+        response = self.client.get(f'{url}?width=500&format=png')
+        self.assertEqual(response.status_code, 404)
+
+
+class TargetQualityTests(SimpleTestCase):
+    def test_budget_search_after_similarity_search(self):
+        from .utils import encode_image, encode_to_target
+
+        rng = np.random.default_rng(0)
+        img = Image.fromarray(rng.integers(0, 255, (100, 150, 3), dtype=np.uint8)).resize((300, 200), Image.BILINEAR)
+        sizes = {quality: len(encode_image(img, 'WEBP', quality=quality)) for quality in range(30, 96)}
+
+        # The similarity floor is out of reach, so the budget decides: the highest quality that fits
+        budget = sizes[60]
+        data, quality, _ = encode_to_target(img, 'WEBP', max_bytes=budget, min_similarity=0.999)
+        self.assertLessEqual(len(data), budget)
+        self.assertEqual(quality, max(q for q, size in sizes.items() if size <= budget))
+
+        # Nothing fits: the smallest output there is
+        data, quality, _ = encode_to_target(img, 'WEBP', max_bytes=1000, min_similarity=0.999)
+        self.assertEqual(len(data), min(sizes.values()))
+
+
+class BestFormatTests(SimpleTestCase):
+    def test_png_candidate_only_for_few_colour_images(self):
+        from .utils import encode_best_format
+
+        rng = np.random.default_rng(0)
+        photo = Image.fromarray(rng.integers(0, 255, (60, 80, 3), dtype=np.uint8)).resize((320, 240), Image.BILINEAR)
+        self.assertNotIn('PNG', encode_best_format(photo)[4])
+
+        graphic = Image.new('RGB', (320, 240), 'white')
+        graphic.paste((200, 60, 60), (40, 40, 200, 160))
+        output_format, _, _, _, sizes = encode_best_format(graphic)
+        self.assertIn('PNG', sizes)
+        self.assertEqual(output_format, 'PNG')
+
+
+class OptimizeCostTests(SimpleTestCase):
+    def test_multi_encode_modes_take_the_heavy_lane(self):
+        from .tasks import optimize_cost
+        from MetaSqueeze.celery import lane_for, HEAVY_QUEUE, LIGHT_QUEUE
+
+        photo = (1600, 1200, 500_000)
+        self.assertEqual(lane_for(optimize_cost(*photo)), LIGHT_QUEUE)
+        self.assertEqual(lane_for(optimize_cost(*photo, output_format='AUTO', source_format='JPEG')), LIGHT_QUEUE)
+        for options in (
+            {'output_format': 'AUTO', 'source_format': 'PNG'},
+            {'output_format': 'PNG'},
+            {'max_bytes': 50_000, 'min_similarity': 0.95},
+            {'output_format': 'AUTO', 'source_format': 'JPEG', 'max_bytes': 50_000},
+        ):
+            with self.subTest(**options):
+                self.assertEqual(lane_for(optimize_cost(*photo, **options)), HEAVY_QUEUE)
+
+
+class UploadCostTests(UploadTestCase):
+    def test_cost_is_estimated_at_upload_and_published_with_the_task(self):
+        from .models import UploadedImage
+        from .tasks import optimize_cost, start_optimizations
+        from MetaSqueeze.celery import COST_HEADER
+
+        data = image_bytes((64, 48))
+        response = self.upload(data, output_format='PNG', rendition_widths=[320])
+        self.assertEqual(response.status_code, 201)
+        uploaded_image = UploadedImage.objects.get()
+        expected = optimize_cost(64, 48, len(data), 2, output_format='PNG', source_format='JPEG')
+        self.assertEqual(uploaded_image.estimated_cpu_seconds, round(expected, 2))
+
+        with mock.patch('base.tasks.group') as group:
+            start_optimizations([str(uploaded_image.id)])
+        signature, = group.call_args.args[0]
+        self.assertEqual(signature.options['headers'], {COST_HEADER: uploaded_image.estimated_cpu_seconds})
+
+
+class DerivativeDecodeTests(SimpleTestCase):
+    @override_settings(IMAGE_TILED_RESIZE_THRESHOLD=1024 * 1024, IMAGE_TILED_BAND_BYTES=256 * 1024,
+                       DERIVATIVE_MAX_DECODE_BYTES=100 * 1024 * 1024)
+    def test_oversize_originals_are_tiled_or_refused(self):
+        from .derivatives import build_derivative, DerivativeTooLarge
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Over the tiling threshold: decoded band by band
+            path = os.path.join(tmp, 'large.png')
+            write_synthetic_png(path, 3000, 3000)
+            with Image.open(BytesIO(build_derivative(path, 200, 'PNG'))) as derivative:
+                self.assertEqual(derivative.size, (200, 200))
+
+            # 16-bit PNGs cannot be decoded in bands
+            deep = os.path.join(tmp, 'deep.png')
+            Image.new('I;16', (8000, 8000)).save(deep)
+            with self.assertRaises(DerivativeTooLarge):
+                build_derivative(deep, 200, 'PNG')
+
+            # JPEGs decode at 1/8 scale, within the cap
+            photo = os.path.join(tmp, 'photo.jpg')
+            Image.new('RGB', (8000, 8000), 'gray').save(photo)
+            with Image.open(BytesIO(build_derivative(photo, 200, 'JPEG'))) as derivative:
+                self.assertEqual(derivative.size, (200, 200))
+
+
+class DerivativeCacheTests(SimpleTestCase):
+    def setUp(self):
+        from . import derivatives
+
+        self.derivatives = derivatives
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        overrides = override_settings(DERIVATIVE_CACHE_ROOT=os.path.join(root.name, 'cache'))
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.original = os.path.join(root.name, 'original.jpg')
+        Image.new('RGB', (800, 600), 'gray').save(self.original)
+        self.redis = fakeredis.FakeStrictRedis()
+        for target in ('base.derivatives', 'MetaSqueeze.admission'):
+            patcher = mock.patch(f'{target}.get_redis_connection', return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_least_recently_used_derivatives_are_evicted_first(self):
+        sizes = {
+            width: len(self.derivatives.build_derivative(self.original, width, 'WEBP'))
+            for width in (100, 200, 300)
+        }
+        clock = iter(range(1000))
+        with override_settings(DERIVATIVE_CACHE_MAX_BYTES=sizes[100] + sizes[300]), \
+                mock.patch.object(self.derivatives.time, 'time', side_effect=lambda: next(clock)):
+            paths = {width: self.derivatives.get_derivative(1, self.original, width, 'WEBP') for width in (100, 200)}
+            # A hit makes w100 the most recently used, so w200 goes first
+            self.derivatives.get_derivative(1, self.original, 100, 'WEBP')
+            paths[300] = self.derivatives.get_derivative(1, self.original, 300, 'WEBP')
+            stats = self.derivatives.cache_stats()
+
+        self.assertFalse(os.path.exists(paths[200]))
+        self.assertTrue(os.path.exists(paths[100]))
+        self.assertTrue(os.path.exists(paths[300]))
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 3, 1))
+        self.assertEqual((stats['entries'], stats['bytes']), (2, sizes[100] + sizes[300]))
+
+    def test_concurrent_misses_build_the_derivative_once(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        build = self.derivatives.build_derivative
+        builds = []
+
+        def slow_build(*args):
+            builds.append(args)
+            time.sleep(0.3)
+            return build(*args)
+
+        with mock.patch.object(self.derivatives, 'build_derivative', side_effect=slow_build):
+            with ThreadPoolExecutor(4) as pool:
+                paths = list(pool.map(
+                    lambda _: self.derivatives.get_derivative(1, self.original, 200, 'WEBP'), range(4)
+                ))
+
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(len(set(paths)), 1)
+        stats = self.derivatives.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+
+
+class DerivativeViewTests(UploadTestCase):
+    def test_derivative_still_locked_is_a_503(self):
+        from redis.exceptions import LockError
+        from .models import UploadedImage
+
+        uploaded_image = UploadedImage.objects.create(original_image='originals/photo.jpg')
+        with mock.patch('base.views.get_derivative', side_effect=LockError('Unable to acquire lock')):
+            response = self.client.get(reverse('image-derivative', args=[uploaded_image.id, 'w_200,f_webp']))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('retry', response.data['error'])
+
+
+class PerceptualHashRefreshTests(TestCase):
+    def test_stale_pending_image_does_not_pin_refreshes(self):
+        from .models import UploadedImage
+        from .phash import PerceptualHashIndex
+
+        lost = UploadedImage.objects.create(original_image='images/lost.png', status='pending')
+        UploadedImage.objects.filter(id=lost.id).update(uploaded_at=timezone.now() - timedelta(hours=2))
+        hashed = [
+            UploadedImage.objects.create(original_image=f'images/{n}.png', status='completed', perceptual_hash=n)
+            for n in range(3)
+        ]
+        index = PerceptualHashIndex()
+        index.refresh(force=True)
+        self.assertEqual(index.unsettled_from, hashed[-1].id + 1)
+
+        # A recent upload still waiting for its hash does hold refreshes back
+        waiting = UploadedImage.objects.create(original_image='images/waiting.png', status='pending')
+        index.refreshed_at = 0
+        index.refresh()
+        self.assertEqual(index.unsettled_from, waiting.id)
+        self.assertEqual(list(index.entries[0]), [image.id for image in hashed])
+
+
+class AnimatedWebpTests(SimpleTestCase):
+    def test_gif_round_trip_keeps_frames_durations_and_loop(self):
+        from .animated import encode_animation
+
+        durations = [80, 120, 200, 40]
+        frames = [Image.new('RGB', (64, 48), color) for color in ('red', 'green', 'blue', 'white')]
+        gif = BytesIO()
+        frames[0].save(gif, format='GIF', save_all=True, append_images=frames[1:], duration=durations, loop=3)
+
+        with Image.open(gif) as img:
+            data, frame_count = encode_animation(img, lambda frame: frame.resize((32, 24)))
+
+        self.assertEqual(frame_count, len(durations))
+        with Image.open(BytesIO(data)) as webp:
+            self.assertEqual(webp.format, 'WEBP')
+            self.assertEqual(webp.n_frames, len(durations))
+            self.assertEqual(webp.info['loop'], 3)
+            self.assertEqual(webp.size, (32, 24))
+            decoded = []
+            for index in range(webp.n_frames):
+                webp.seek(index)
+                # The WEBP plugin sets a frame's duration when it decodes it
+                webp.load()
+                decoded.append(webp.info['duration'])
+        self.assertEqual(decoded, durations)
+
+    def test_near_identical_frames_are_dropped_and_their_time_merged(self):
+        from .animated import DUPLICATE_FRAME_TOLERANCE, encode_animation
+
+        noise = np.random.default_rng(0).integers(-DUPLICATE_FRAME_TOLERANCE, DUPLICATE_FRAME_TOLERANCE + 1, (48, 64, 3))
+        grey = np.full((48, 64, 3), 128)
+        frames = [
+            Image.fromarray(np.uint8(pixels)) for pixels in
+            (grey, grey + noise, grey - noise, np.full((48, 64, 3), 20), np.full((48, 64, 3), 230))
+        ]
+        webp = BytesIO()
+        # Lossless, so the near-duplicates reach the encoder exactly as they differ
+        frames[0].save(webp, format='WEBP', save_all=True, append_images=frames[1:],
+                       duration=[100, 50, 70, 200, 30], loop=0, lossless=True)
+
+        with Image.open(webp) as img:
+            self.assertEqual(img.n_frames, 5)
+            data, frame_count = encode_animation(img, lambda frame: frame, drop_duplicates=True)
+
+        self.assertEqual(frame_count, 3)
+        with Image.open(BytesIO(data)) as output:
+            durations = []
+            for index in range(output.n_frames):
+                output.seek(index)
+                output.load()
+                durations.append(output.info['duration'])
+        self.assertEqual(durations, [100 + 50 + 70, 200, 30])
+
+
+class UploadMetadataTests(UploadTestCase):
+    def test_exif_and_gps_are_in_the_upload_response(self):
+        from PIL import ExifTags
+
+        exif = Image.Exif()
+        exif[ExifTags.Base.Make] = 'Canon'
+        exif[ExifTags.Base.Model] = 'EOS R5'
+        exif[ExifTags.IFD.Exif] = {ExifTags.Base.DateTimeOriginal: '2024:05:01 12:30:00'}
+        exif[ExifTags.IFD.GPSInfo] = {
+            ExifTags.GPS.GPSLatitudeRef: 'S', ExifTags.GPS.GPSLatitude: (33.0, 52.0, 4.8),
+            ExifTags.GPS.GPSLongitudeRef: 'E', ExifTags.GPS.GPSLongitude: (151.0, 12.0, 36.0),
+        }
+        response = self.upload(image_bytes((64, 48), exif=exif))
+
+        self.assertEqual(response.status_code, 201)
+        data = response.data['data']
+        self.assertEqual((data['width'], data['height'], data['format']), (64, 48, 'JPEG'))
+        self.assertEqual((data['camera_make'], data['camera_model']), ('Canon', 'EOS R5'))
+        self.assertTrue(data['taken_at'].startswith('2024-05-01T12:30:00'))
+        self.assertAlmostEqual(data['gps_latitude'], -33.868)
+        self.assertAlmostEqual(data['gps_longitude'], 151.21)
+
+    def test_upload_over_the_pixel_limit_is_rejected_and_logged(self):
+        from rest_framework.exceptions import ValidationError
+        from .serializers import ImageSerializer
+
+        # Called directly: the image field's own Pillow check normally refuses these first
+        upload = ContentFile(image_bytes((64, 48)), name='huge.jpg')
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000), self.assertLogs('base.serializers', 'WARNING') as logs:
+            with self.assertRaises(ValidationError) as raised:
+                ImageSerializer().read_metadata(upload)
+        self.assertIn('too many pixels', str(raised.exception.detail['original_image']))
+        self.assertIn('huge.jpg', logs.output[0])
+        self.assertEqual(upload.tell(), 0)
+
+
+class BatchUploadTests(UploadTestCase):
+    def test_empty_and_oversize_batches_are_rejected(self):
+        from .models import UploadedImage
+        from .views import MAX_BATCH_SIZE
+
+        response = self.client.post(reverse('image-batch-upload'), {}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        response = self.upload_batch([image_bytes()] * (MAX_BATCH_SIZE + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(MAX_BATCH_SIZE), response.data['error'])
+        self.assertFalse(UploadedImage.objects.exists())
+        self.submit.assert_not_called()
+
+    def test_status_is_aggregated_in_one_query(self):
+        from .models import UploadedImage
+
+        response = self.upload_batch([image_bytes(color=color) for color in ('red', 'green', 'blue', 'white')])
+        self.assertEqual(response.status_code, 201)
+        batch_id = response.data['batch_id']
+        first, second, *_ = UploadedImage.objects.filter(batch_id=batch_id).order_by('id')
+        UploadedImage.objects.filter(pk=first.pk).update(status='completed', optimized_image='optimized/a.webp')
+        UploadedImage.objects.filter(pk=second.pk).update(status='failed')
+
+        url = reverse('image-batch-status', args=[batch_id])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {key: response.data[key] for key in ('total', 'pending', 'completed', 'failed', 'progress', 'done')},
+            {'total': 4, 'pending': 2, 'completed': 1, 'failed': 1, 'progress': 0.5, 'done': False},
+        )
+        self.assertEqual([item['id'] for item in response.data['items']][:2], [first.pk, second.pk])
+        self.assertTrue(response.data['items'][0]['optimized_image'].endswith('optimized/a.webp'))
+
+    def test_unknown_batch_is_a_404(self):
+        response = self.client.get(reverse('image-batch-status', args=['00000000-0000-0000-0000-000000000000']))
+        self.assertEqual(response.status_code, 404)
+
+
+class ImageDeduplicationTests(UploadTestCase):
+    def test_upload_is_hashed_while_it_streams_in(self):
+        from .models import UploadedImage
+        data = image_bytes()
+        with mock.patch('base.serializers.hash_uploaded_file') as second_pass:
+            response = self.upload(data)
+        self.assertEqual(response.status_code, 201)
+        second_pass.assert_not_called()
+        self.assertEqual(UploadedImage.objects.get().content_hash, hashlib.sha256(data).hexdigest())
+
+    def test_identical_optimized_upload_is_reused_without_a_task(self):
+        from .models import UploadedImage
+        first = self.upload().data['data']
+        self.submit.assert_called_once()
+        optimized = UploadedImage.objects.get(id=first['id'])
+        optimized.optimized_image.save('optimized.webp', ContentFile(b'webp'), save=False)
+        optimized.status = 'completed'
+        optimized.save()
+
+        self.submit.reset_mock()
+        response = self.upload()
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.data['data']['optimized_image'])
+        self.assertEqual(response.data['data']['status'], 'completed')
+        self.submit.assert_not_called()
+        reused = UploadedImage.objects.get(id=response.data['data']['id'])
+        self.assertEqual(reused.original_image.name, optimized.original_image.name)
+        self.assertEqual(reused.optimized_image.name, optimized.optimized_image.name)
+
+    def test_repeats_within_a_batch_are_optimized_once(self):
+        from .models import UploadedImage, ImageRendition
+        from .tasks import share_with_duplicates, fail_optimization
+
+        photo, other = image_bytes(), image_bytes(color='blue')
+        response = self.upload_batch([photo, other, photo, photo])
+        self.assertEqual(response.status_code, 201)
+        ids = [item['id'] for item in response.data['data']]
+        (_, _, pending_ids), _ = self.submit.call_args
+        self.assertEqual(pending_ids, ids[:2])
+        images = [UploadedImage.objects.get(id=image_id) for image_id in ids]
+        self.assertEqual(len({images[n].original_image.name for n in (0, 2, 3)}), 1)
+        self.assertEqual(len(os.listdir(os.path.dirname(images[0].original_image.path))), 2)
+
+        leader = images[0]
+        leader.optimized_image.save('optimized.webp', ContentFile(b'webp'), save=False)
+        leader.status, leader.width = 'completed', 64
+        leader.save()
+        ImageRendition.objects.create(image=leader, width=320, height=240, format='WEBP',
+                                      file='renditions/r.webp', file_size=10)
+        share_with_duplicates(leader)
+        for image_id in ids[2:]:
+            repeat = UploadedImage.objects.get(id=image_id)
+            self.assertEqual((repeat.status, repeat.width), ('completed', 64))
+            self.assertEqual(repeat.optimized_image.name, leader.optimized_image.name)
+            self.assertEqual(repeat.renditions.get().file.name, 'renditions/r.webp')
+        self.assertEqual(UploadedImage.objects.get(id=ids[1]).status, 'pending')
+
+        response = self.upload_batch([other, other])
+        first, repeat = [item['id'] for item in response.data['data']]
+        fail_optimization(first)
+        self.assertEqual(UploadedImage.objects.get(id=repeat).status, 'failed')
+
+
+class SharedBlobCleanupTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def age(self, image):
+        from .models import UploadedImage
+        UploadedImage.objects.filter(id=image.id).update(uploaded_at=timezone.now() - timedelta(days=31))
+
+    def test_shared_blob_outlives_all_but_its_last_row(self):
+        from .models import UploadedImage, ImageRendition
+        from .tasks import cleanup_old_images
+
+        first = UploadedImage(status='completed')
+        first.original_image.save('photo.jpg', ContentFile(image_bytes()), save=False)
+        first.optimized_image.save('photo.webp', ContentFile(b'webp'), save=False)
+        first.save()
+        rendition = ImageRendition(image=first, width=320, height=240, format='WEBP', file_size=4)
+        rendition.file.save('photo_320.webp', ContentFile(b'webp'))
+        second = UploadedImage.objects.create(
+            original_image=first.original_image.name, optimized_image=first.optimized_image.name,
+            status='completed',
+        )
+        ImageRendition.objects.create(image=second, width=320, height=240, format='WEBP',
+                                      file=rendition.file.name, file_size=4)
+        paths = [first.original_image.path, first.optimized_image.path, rendition.file.path]
+
+        self.age(first)
+        cleanup_old_images()
+        self.assertFalse(UploadedImage.objects.filter(id=first.id).exists())
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        self.age(second)
+        cleanup_old_images()
+        self.assertFalse(UploadedImage.objects.exists())
+        self.assertFalse(any(os.path.exists(path) for path in paths))
@@ -0,0 +1,223 @@
+import math
+import struct
+import zlib
+import logging
+from PIL import Image
+from .png import PNG_SIGNATURE, png_chunk
+from .utils import fit_within, REDUCING_GAP
+
+logger = logging.getLogger(__name__)
+
+# Samples per pixel for the 8-bit, non-interlaced PNG colour types that can be decoded band by band
+BAND_DECODABLE_CHANNELS = {
+    0: 1,  # greyscale
+    2: 3,  # RGB
+    3: 1,  # palette
+    4: 2,  # greyscale + alpha
+    6: 4,  # RGBA
+}
+
+# Largest slice inflated at once, so appending to the pending band never doubles it
+INFLATE_STEP = 1024 * 1024
+
+# Ancillary chunks every band needs to decode the same way as the full image
+CARRIED_CHUNKS = (b'PLTE', b'tRNS')
+
+
+
+
+def _iter_chunks(f):
+    """
+    Yield (chunk_type, data) for each chunk of an open PNG file, stopping after IEND.
+    """
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        data = f.read(length)
+        f.read(4)  # CRC
+        yield chunk_type, data
+        if chunk_type == b'IEND':
+            return
+
+
+class _SegmentReader:
+    """
+    Read-only, seekable file object over a list of byte strings, so a band PNG can
+    be handed to Pillow without first concatenating its pieces into one buffer.
+    """
+
+    def __init__(self, segments):
+        self.segments = [segment for segment in segments if segment]
+        self.size = sum(len(segment) for segment in self.segments)
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        base = {0: 0, 1: self.position, 2: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        parts = []
+        start = 0
+        for segment in self.segments:
+            end = start + len(segment)
+            if size > 0 and end > self.position:
+                offset = self.position - start
+                part = segment[offset:offset + size]
+                parts.append(part)
+                self.position += len(part)
+                size -= len(part)
+            start = end
+        return b''.join(parts)
+
+
+def read_png_header(path):
+    """
+    Return the IHDR fields (width, height, bit_depth, color_type, interlace) of a PNG,
+    or None if the file is not a PNG. Only the first 33 bytes are read.
+    """
+    with open(path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        length, chunk_type = struct.unpack('>I4s', f.read(8))
+        if chunk_type != b'IHDR':
+            return None
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', f.read(13))
+    return width, height, bit_depth, color_type, interlace
+
+
+def band_decodable(header):
+    """
+    True if the PNG described by header can be decoded band by band.
+    """
+    if header is None:
+        return False
+    _, _, bit_depth, color_type, interlace = header
+    return bit_depth == 8 and interlace == 0 and color_type in BAND_DECODABLE_CHANNELS
+
+
+def decoded_png_bytes(header):
+    """
+    Size in bytes of the fully decoded bitmap Pillow would allocate for this PNG.
+    """
+    width, height, _, color_type, _ = header
+    return width * height * BAND_DECODABLE_CHANNELS.get(color_type, 4)
+
+
+def iter_png_bands(path, band_rows):
+    """
+    Yield (top, image, skip) for consecutive bands of up to band_rows scanlines of a PNG.
+    The zlib stream is inflated incrementally and each band is handed to Pillow as
+    a small PNG of its own. The previous band's last row is prepended unfiltered,
+    so Up/Average/Paeth filters in the band's first row still resolve; skip is 1
+    when the image starts with that repeated row. Memory is bounded by a few
+    copies of one band.
+    """
+    header = read_png_header(path)
+    if not band_decodable(header):
+        raise ValueError(f"PNG cannot be decoded in bands: {path}")
+    width, height, bit_depth, color_type, _ = header
+    stride = width * BAND_DECODABLE_CHANNELS[color_type] + 1  # filter byte + samples
+    band_bytes = band_rows * stride
+
+    carried = []
+    decompressor = zlib.decompressobj()
+    pending = bytearray()
+    previous_row = None
+    top = 0
+
+    def decode_band(filtered):
+        nonlocal previous_row, top
+        rows = len(filtered) // stride
+        skip = 0 if previous_row is None else 1
+
+        # Stored (level 0) deflate: Pillow only has to copy the rows back out
+        compressor = zlib.compressobj(0)
+        compressed = [
+            compressor.compress(b'\x00' + previous_row) if skip else b'',
+            compressor.compress(filtered),
+            compressor.flush(),
+        ]
+        crc = zlib.crc32(b'IDAT')
+        for piece in compressed:
+            crc = zlib.crc32(piece, crc)
+        band_png = _SegmentReader([
+            PNG_SIGNATURE,
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, rows + skip, bit_depth, color_type, 0, 0, 0)),
+            *carried,
+            struct.pack('>I', sum(len(piece) for piece in compressed)) + b'IDAT',
+            *compressed,
+            struct.pack('>I', crc),
+            png_chunk(b'IEND', b''),
+        ])
+        del compressed
+
+        band = Image.open(band_png)
+        band.load()
+        del band_png
+        previous_row = band.crop((0, rows + skip - 1, width, rows + skip)).tobytes()
+        result = (top, band, skip)
+        top += rows
+        return result
+
+    with open(path, 'rb') as f:
+        f.read(8)
+        for chunk_type, data in _iter_chunks(f):
+            if chunk_type in CARRIED_CHUNKS:
+                carried.append(png_chunk(chunk_type, data))
+            elif chunk_type == b'IDAT':
+                while data:
+                    # Never inflate more than the current band still needs
+                    pending += decompressor.decompress(data, min(band_bytes - len(pending), INFLATE_STEP))
+                    data = decompressor.unconsumed_tail
+                    if len(pending) >= band_bytes:
+                        with memoryview(pending) as view:
+                            yield decode_band(view[:band_bytes])
+                        del pending[:band_bytes]
+            elif chunk_type == b'IEND':
+                break
+
+    pending += decompressor.flush()
+    remaining = min(len(pending) // stride, height - top)
+    if remaining:
+        with memoryview(pending) as view:
+            yield decode_band(view[:remaining * stride])
+
+
+def tiled_shrink(path, max_size, band_bytes, reducing_gap=REDUCING_GAP):
+    """
+    Shrink-on-load for PNGs too large to decode whole.
+    Each band is box-reduced by the same integer factor and pasted onto a canvas
+    that keeps reducing_gap headroom over the final size, so peak memory is one
+    band plus the reduced canvas regardless of the source dimensions.
+    The final high-quality resample is left to the caller.
+    """
+    width, height, _, color_type, _ = read_png_header(path)
+    final_width, final_height = fit_within(width, height, max_size)
+    target = (int(final_width * reducing_gap), int(final_height * reducing_gap))
+    factor = max(1, min(width // target[0], height // target[1]))
+
+    stride = width * BAND_DECODABLE_CHANNELS[color_type] + 1
+    # Bands must be a whole number of reduce blocks tall so the pieces line up
+    band_rows = max(factor, band_bytes // stride // factor * factor)
+
+    canvas = None
+    for top, band, skip in iter_png_bands(path, band_rows):
+        if band.mode == 'P':
+            band = band.convert('RGBA' if 'transparency' in band.info else 'RGB')
+        # Leave out the row repeated from the previous band without copying the band
+        reduced = band.reduce(factor, box=(0, skip, width, band.height))
+        if canvas is None:
+            canvas = Image.new(reduced.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+        canvas.paste(reduced, (0, top // factor))
+        # Drop this band before the generator decodes the next one
+        del band, reduced
+    logger.info(f"Tiled decode of {width}x{height} PNG reduced by {factor} in bands of {band_rows} rows")
+    return canvas
@@ -0,0 +1,37 @@
+import hashlib
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadHandlerMixin:
+    """
+    Hash every uploaded file while it streams in, so deduplication needs no
+    second pass over the stored bytes. The digest ends up in the uploaded
+    file's content_hash attribute.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Before the handler's own new_file, which may end the chain with StopFutureHandlers
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.content_hash = self.digest.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    def receive_data_chunk(self, raw_data, start):
+        # Files too large to keep in memory pass on to (and are hashed by) the temporary file handler
+        if not self.activated:
+            return raw_data
+        return super().receive_data_chunk(raw_data, start)
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
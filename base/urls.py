@@ -3,5 +3,9 @@ from . import views
 
 urlpatterns = [
     path('image_upload/', views.image_upload_view, name='trigger-task'),
-    path('image_list/<int:image_id>/', views.image_list_view, name='image-list')
+    path('image_list/<int:image_id>/', views.image_list_view, name='image-list'),
+    path('image_batch_upload/', views.image_batch_upload_view, name='image-batch-upload'),
+    path('image_batch/<uuid:batch_id>/', views.image_batch_status_view, name='image-batch-status'),
+    path('image_similar/<int:image_id>/', views.image_similar_view, name='image-similar'),
+    path('image/<int:image_id>/<str:transform>/', views.image_derivative_view, name='image-derivative'),
 ]
@@ -0,0 +1,385 @@
+import hashlib
+import logging
+import resource
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from io import BytesIO
+from PIL import Image, ExifTags
+from datetime import datetime
+from .png import optimize_png
+
+logger = logging.getLogger(__name__)
+
+# Keep at least this much headroom over the final size before the high-quality
+# resample, so the shrink-on-load step never visibly degrades the output.
+REDUCING_GAP = 2.0
+
+# JPEG-coded formats Pillow can decode at a reduced DCT scale (draft mode);
+# MPO is the multi-picture JPEG most phone cameras write
+DRAFT_FORMATS = ('JPEG', 'MPO')
+
+# Modes Pillow's box reduce does not support.
+UNREDUCIBLE_MODES = ('1', 'P')
+
+# Quality used when no target is requested, and the formats a quality applies to
+DEFAULT_QUALITY = 85
+LOSSY_FORMATS = ('WEBP', 'JPEG')
+
+# Candidates tried for output_format AUTO, and the SSIM a lossy candidate must reach to win
+AUTO_CANDIDATE_FORMATS = ('WEBP', 'JPEG', 'PNG')
+AUTO_MIN_SIMILARITY = 0.9
+# Distinct colours above which an image is continuous-tone (a photo): lossless PNG
+# never beats the lossy candidates there, so AUTO skips its strategy search
+AUTO_PNG_MAX_COLORS = 8192
+
+# Upper bound on in-memory encodes per target-quality search; 66 quality steps need 7
+MAX_QUALITY_TRIALS = 8
+
+# Image.info entries that describe the camera, capture or location rather than the pixels
+PRIVATE_METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp')
+
+
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB.
+    Prefers VmHWM, which is reset on exec; ru_maxrss carries over the parent's high-water mark.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def hash_uploaded_file(uploaded_file):
+    """
+    Return the SHA-256 hex digest of an uploaded file, read chunk by chunk.
+    """
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def convert_gps_to_decimal(degrees, minutes, seconds, direction):
+    """
+    Convert GPS coordinates to decimal degrees.
+    """
+    decimal = float(degrees) + (float(minutes) / 60.0) + (float(seconds) / 3600.0)
+    if direction in ['S', 'W']:
+        decimal = -decimal
+    return decimal
+
+
+def extract_metadata(fp):
+    """
+    Read dimensions, format and EXIF fields from an image file without decoding pixels.
+    Pillow only parses the header and EXIF block on open, so this costs milliseconds
+    even for very large images. Returns a dict of UploadedImage field values.
+    """
+    with Image.open(fp) as img:
+        metadata = {'format': img.format, 'width': img.width, 'height': img.height}
+        exif = img.getexif()
+        exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+        gps_ifd = exif.get_ifd(ExifTags.IFD.GPSInfo)
+
+    if exif.get(ExifTags.Base.Make):
+        metadata['camera_make'] = str(exif[ExifTags.Base.Make]).strip('\x00 ')
+    if exif.get(ExifTags.Base.Model):
+        metadata['camera_model'] = str(exif[ExifTags.Base.Model]).strip('\x00 ')
+
+    taken_at = exif_ifd.get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTime)
+    if taken_at:
+        try:
+            metadata['taken_at'] = datetime.strptime(str(taken_at).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+        except ValueError:
+            logger.warning(f"Invalid EXIF DateTime: {taken_at}")
+
+    for field, value_tag, ref_tag, default_ref in (
+        ('gps_latitude', ExifTags.GPS.GPSLatitude, ExifTags.GPS.GPSLatitudeRef, 'N'),
+        ('gps_longitude', ExifTags.GPS.GPSLongitude, ExifTags.GPS.GPSLongitudeRef, 'E'),
+    ):
+        value = gps_ifd.get(value_tag)
+        if isinstance(value, tuple) and len(value) == 3:
+            try:
+                metadata[field] = convert_gps_to_decimal(*value, gps_ifd.get(ref_tag, default_ref))
+            except (TypeError, ValueError, ZeroDivisionError):
+                logger.warning(f"Invalid EXIF GPS value: {value}")
+    return metadata
+
+
+def fit_within(width, height, max_size):
+    """
+    Return (width, height) scaled down to fit inside max_size, preserving aspect ratio.
+    """
+    max_width, max_height = max_size
+    if width <= max_width and height <= max_height:
+        return width, height
+    ratio = min(max_width / width, max_height / height)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def shrink_on_load(img, max_size, reducing_gap=REDUCING_GAP):
+    """
+    Decode an opened image at the smallest scale that still leaves reducing_gap
+    headroom over the final size.
+    - JPEGs (and MPOs) are scaled in the DCT domain via draft mode, so the
+      full-resolution bitmap is never materialised.
+    - Other formats are decoded once and shrunk with an integer box reduce.
+    Returns the (possibly new) decoded image; the final resample is left to the caller.
+    """
+    final_width, final_height = fit_within(img.width, img.height, max_size)
+    target = (int(final_width * reducing_gap), int(final_height * reducing_gap))
+
+    if img.format in DRAFT_FORMATS:
+        # draft() picks the largest DCT scale (1/2, 1/4, 1/8) that stays >= target
+        img.draft(None, target)
+        img.load()
+        return img
+
+    factor = min(img.width // target[0], img.height // target[1])
+    img.load()
+    if factor > 1 and img.mode not in UNREDUCIBLE_MODES:
+        return img.reduce(factor)
+    return img
+
+
+def has_alpha(img):
+    """
+    Return True if the image carries transparency that JPEG would discard.
+    """
+    return img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or (
+        img.mode == 'P' and 'transparency' in img.info
+    )
+
+
+def apply_metadata_policy(img, strip=False):
+    """
+    Decide what metadata the encoded output carries, in img.info.
+    EXIF and XMP (camera, capture time, location) are always dropped: what is useful
+    is already stored on the model. The ICC colour profile is kept so colours
+    render as in the original, unless strip asks for the smallest possible output.
+    """
+    for key in PRIVATE_METADATA_KEYS:
+        img.info.pop(key, None)
+    if strip:
+        img.info.pop('icc_profile', None)
+    return img
+
+
+def encode_image(img, output_format, quality=DEFAULT_QUALITY, progressive=False):
+    """
+    Encode a decoded image to bytes in the given output format (WEBP, JPEG, PNG).
+    The ICC profile in img.info, if any, is embedded.
+    Raises ValueError for unsupported formats.
+    """
+    buffer = BytesIO()
+    icc_profile = img.info.get('icc_profile')
+    if output_format == 'WEBP':
+        img.save(buffer, format='WEBP', quality=quality, icc_profile=icc_profile)
+    elif output_format == 'JPEG':
+        # Convert to RGB if necessary (JPEG doesn't support transparency or palettes)
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        img.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=progressive,
+                 icc_profile=icc_profile)
+    elif output_format == 'PNG':
+        img.save(buffer, format='PNG', optimize=True)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    return buffer.getvalue()
+
+
+def progressive_renditions(img, widths, resize=None):
+    """
+    Yield (width, image) for each requested width, largest first.
+    Every rendition is resampled from the next larger one rather than from the
+    source, so each step only touches a few times its own pixel count.
+    Widths wider than the source are skipped rather than upscaled.
+    resize(image, size) overrides the default Lanczos resample.
+    """
+    current = img
+    for width in sorted(set(widths), reverse=True):
+        if width > img.width:
+            continue
+        height = max(1, round(img.height * width / img.width))
+        if current.size != (width, height):
+            if resize:
+                current = resize(current, (width, height))
+            else:
+                current = current.resize((width, height), Image.LANCZOS)
+        yield width, current
+
+
+# SSIM stabilising constants for 8-bit data (Wang et al. 2004)
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_WINDOW = 7
+
+
+def luma_array(img):
+    """
+    Return the image's luma channel as a float64 NumPy array.
+    """
+    return np.asarray(img.convert('L'), dtype=np.float64)
+
+
+def _window_means(x, size):
+    """
+    Mean of every size x size window of a 2-D array, via a summed-area table.
+    """
+    table = np.pad(x.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    sums = table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+    return sums / (size * size)
+
+
+def structural_similarity(reference, candidate):
+    """
+    Mean SSIM of two same-shaped luma arrays, using uniform square windows.
+    Fully vectorized: five window-mean passes over summed-area tables.
+    """
+    size = min(SSIM_WINDOW, *reference.shape)
+    mu_x = _window_means(reference, size)
+    mu_y = _window_means(candidate, size)
+    var_x = _window_means(reference * reference, size) - mu_x * mu_x
+    var_y = _window_means(candidate * candidate, size) - mu_y * mu_y
+    cov_xy = _window_means(reference * candidate, size) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + SSIM_C1) * (2 * cov_xy + SSIM_C2)) / (
+        (mu_x * mu_x + mu_y * mu_y + SSIM_C1) * (var_x + var_y + SSIM_C2)
+    )
+    return float(ssim_map.mean())
+
+
+def encode_to_target(img, output_format, max_bytes=None, min_similarity=None,
+                     quality_range=(30, 95), max_trials=MAX_QUALITY_TRIALS,
+                     progressive=False, reference=None):
+    """
+    Binary-search the encoder quality for a lossy format against a target.
+    - max_bytes: the highest quality whose output fits the byte budget.
+    - min_similarity: the lowest quality whose SSIM against img reaches the floor.
+    - both: the similarity answer, unless it breaks the budget, in which case the budget wins.
+    Every trial is an in-memory encode; each search stops after max_trials new encodes.
+    When no quality fits the budget, the smallest output made wins.
+    Returns (data, quality, similarity).
+    """
+    if reference is None:
+        reference = luma_array(img)
+    trials = {}
+
+    def trial(quality):
+        if quality not in trials:
+            data = encode_image(img, output_format, quality=quality, progressive=progressive)
+            trials[quality] = [data, None]
+        return trials[quality]
+
+    def similarity(quality):
+        result = trial(quality)
+        if result[1] is None:
+            with Image.open(BytesIO(result[0])) as decoded:
+                result[1] = structural_similarity(reference, luma_array(decoded))
+        return result[1]
+
+    def search(predicate, want_highest):
+        # Each search gets its own allowance; qualities already encoded are free
+        low, high = quality_range
+        found = None
+        made = 0
+        while low <= high and (made < max_trials or (low + high) // 2 in trials):
+            quality = (low + high) // 2
+            made += quality not in trials
+            if predicate(quality):
+                found = quality
+                low, high = (quality + 1, high) if want_highest else (low, quality - 1)
+            else:
+                low, high = (low, quality - 1) if want_highest else (quality + 1, high)
+        return found
+
+    def fits_budget(quality):
+        return len(trial(quality)[0]) <= max_bytes
+
+    chosen = None
+    if min_similarity is not None:
+        chosen = search(lambda quality: similarity(quality) >= min_similarity, want_highest=False)
+        if chosen is None:
+            # Nothing reached the floor: keep the best-looking trial
+            chosen = max(trials)
+    if max_bytes is not None and (chosen is None or not fits_budget(chosen)):
+        chosen = search(fits_budget, want_highest=True)
+        if chosen is None:
+            # Nothing fits: the lowest quality is the likeliest smallest, but keep
+            # whichever output we made is smallest
+            trial(quality_range[0])
+            chosen = min(trials, key=lambda quality: len(trials[quality][0]))
+    return trial(chosen)[0], chosen, similarity(chosen)
+
+
+def encode_output(img, output_format, max_bytes=None, min_similarity=None, progressive=False,
+                  reference=None, png_report=None):
+    """
+    Encode img in one format, searching the quality only when a target is set.
+    PNG goes through the lossless strategy search, which fills png_report if given.
+    Returns (data, quality, similarity); quality is None for lossless formats and
+    similarity is None when it was not needed.
+    """
+    if output_format == 'PNG':
+        return optimize_png(img, png_report), None, None
+    if output_format not in LOSSY_FORMATS:
+        return encode_image(img, output_format), None, None
+    if max_bytes or min_similarity:
+        return encode_to_target(
+            img, output_format, max_bytes=max_bytes, min_similarity=min_similarity,
+            progressive=progressive, reference=reference,
+        )
+    return encode_image(img, output_format, progressive=progressive), DEFAULT_QUALITY, None
+
+
+def is_photo(img):
+    """
+    Return True if the image has more than AUTO_PNG_MAX_COLORS distinct colours.
+    Pillow stops counting as soon as the limit is passed, so photos answer fast.
+    """
+    return img.getcolors(AUTO_PNG_MAX_COLORS) is None
+
+
+def encode_best_format(img, max_bytes=None, min_similarity=None, floor=AUTO_MIN_SIMILARITY, png_report=None):
+    """
+    Encode img as WEBP, JPEG (optimized, progressive) and PNG concurrently and keep
+    the smallest result whose SSIM clears the floor. Pillow releases the GIL inside
+    its encoders, so the candidates genuinely run in parallel.
+    JPEG is skipped for images with transparency, PNG for photos (see is_photo).
+    Returns (format, data, quality, similarity, sizes); sizes maps every candidate
+    format to its encoded byte count.
+    """
+    formats = [f for f in AUTO_CANDIDATE_FORMATS if f != 'JPEG' or not has_alpha(img)]
+    if is_photo(img):
+        formats.remove('PNG')
+    reference = luma_array(img)
+
+    def run(output_format):
+        # Image.save keeps its parameters on the image while it encodes, so
+        # concurrent encodes of one image would clash: every candidate gets a copy
+        data, quality, score = encode_output(
+            img.copy(), output_format, max_bytes=max_bytes, min_similarity=min_similarity,
+            progressive=output_format == 'JPEG', reference=reference, png_report=png_report,
+        )
+        if output_format not in LOSSY_FORMATS:
+            score = 1.0
+        elif score is None:
+            with Image.open(BytesIO(data)) as decoded:
+                score = structural_similarity(reference, luma_array(decoded))
+        return output_format, data, quality, score
+
+    with ThreadPoolExecutor(max_workers=len(formats)) as executor:
+        results = list(executor.map(run, formats))
+
+    sizes = {output_format: len(data) for output_format, data, _, _ in results}
+    passing = [result for result in results if result[3] >= floor] or results
+    output_format, data, quality, score = min(passing, key=lambda result: len(result[1]))
+    return output_format, data, quality, score, sizes
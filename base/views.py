@@ -1,10 +1,49 @@
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, throttle_classes
+from accounts.throttles import DerivativeThrottle
 from .serializers import ImageSerializer
-from base.tasks import optimize_image
+from base.derivatives import get_derivative, CONTENT_TYPES, DerivativeTooLarge, DerivativeBusy
+from base.phash import find_similar
+from redis.exceptions import LockError
+from MetaSqueeze.fairshare import submit, tenant_for
+from collections import Counter
+import uuid
+from django.conf import settings
 from django.http import FileResponse
-from .models import UploadedImage
+from django.core.files.storage import default_storage
+from .models import UploadedImage, ImageRendition
+
+# Upper bound on files accepted by a single batch upload request
+MAX_BATCH_SIZE = 50
+
+# Hamming distance (in bits of the 64-bit perceptual hash) for near-duplicate queries
+DEFAULT_SIMILAR_DISTANCE = 8
+MAX_SIMILAR_DISTANCE = 24
+MAX_SIMILAR_RESULTS = 100
+
+# Widest on-demand derivative, and the format names accepted in derivative URLs
+MAX_DERIVATIVE_WIDTH = 4096
+DERIVATIVE_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG'}
+
+
+def parse_transform(transform):
+    """
+    Parse a derivative spec such as 'w_640,f_webp' into (width, format).
+    Returns None if the spec is malformed.
+    """
+    params = {}
+    for part in transform.lower().split(','):
+        name, _, value = part.partition('_')
+        if not value or name in params:
+            return None
+        params[name] = value
+    if set(params) - {'w', 'f'} or not params.get('w', '').isdigit():
+        return None
+    output_format = DERIVATIVE_FORMATS.get(params.get('f', 'webp'))
+    if output_format is None:
+        return None
+    return int(params['w']), output_format
 
 
 
@@ -14,14 +53,26 @@ from .models import UploadedImage
 def image_upload_view(request):
     """
     Handle image uploads and trigger asynchronous optimization.
-    Accepts 'original_image' and optional 'output_format' (WEBP, JPEG, PNG).
+    Accepts 'original_image' and optional 'output_format' (WEBP, JPEG, PNG, or AUTO
+    to keep the smallest acceptable encoding).
+    Optional 'rendition_widths' (320, 640, 1024, 2048) and 'rendition_formats'
+    generate every width/format pair from a single decode of the original.
+    Optional 'target_max_bytes' and/or 'target_min_similarity' (SSIM, 0-1) pick the
+    WEBP/JPEG quality by search instead of the fixed default.
     """
     serializer = ImageSerializer(data=request.data)
     serializer.is_valid(raise_exception=True)
-    uploaded_image = serializer.save()
+    uploaded_image = serializer.save(uploaded_by=request.user if request.user.is_authenticated else None)
+
+    # Identical content with identical parameters reuses the existing optimized image
+    if uploaded_image.optimized_image:
+        return Response({
+            'message': 'Image uploaded successfully! Reused an identical optimized image.',
+            'data': serializer.data
+        }, status=status.HTTP_201_CREATED)
 
-    # Call Celery task to optimize the image in the background
-    optimize_image.delay(uploaded_image.id)
+    # Queue the optimization behind the user's earlier jobs; users are served in turn
+    submit(tenant_for(request), 'image', [uploaded_image.id])
 
     return Response({
         'message': 'Image uploaded successfully! Optimization in progress.',
@@ -35,16 +86,114 @@ def image_upload_view(request):
 
 
 
+@api_view(['POST'])
+def image_batch_upload_view(request):
+    """
+    Handle many image uploads in one request and queue their optimization for the uploading user.
+    Optimizations released by the fair-share dispatcher together go out as one Celery group.
+    Accepts 'original_images' (repeated) plus optional 'output_format',
+    'rendition_widths' and 'rendition_formats' applied to every file.
+    Returns a batch id to poll with image_batch_status_view.
+    """
+    files = request.FILES.getlist('original_images')
+    if not files:
+        return Response(
+            {'error': 'No files provided in original_images.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if len(files) > MAX_BATCH_SIZE:
+        return Response(
+            {'error': f'Too many files (max {MAX_BATCH_SIZE} per batch).'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    shared_options = {}
+    if 'output_format' in request.data:
+        shared_options['output_format'] = request.data['output_format']
+    # Multipart only: the list options arrive as repeated form fields
+    for key in ('rendition_widths', 'rendition_formats'):
+        if key in request.data:
+            shared_options[key] = request.data.getlist(key)
+
+    # Validate every file in one pass and insert all rows with a single bulk_create
+    serializer = ImageSerializer(
+        data=[{'original_image': f, **shared_options} for f in files],
+        many=True
+    )
+    serializer.is_valid(raise_exception=True)
+    batch_id = uuid.uuid4()
+    uploaded_images = serializer.save(
+        batch_id=batch_id, uploaded_by=request.user if request.user.is_authenticated else None
+    )
+
+    # Identical content already optimized with the same parameters needs no task, nor
+    # do repeats of a file within the batch, which take their first copy's result
+    pending_ids = [
+        image.id for image in uploaded_images
+        if not image.optimized_image and not hasattr(image, 'duplicate_of')
+    ]
+    if pending_ids:
+        submit(tenant_for(request), 'image', pending_ids)
+
+    return Response({
+        'message': f'{len(uploaded_images)} images uploaded successfully! Optimization in progress.',
+        'batch_id': str(batch_id),
+        'data': serializer.data
+    }, status=status.HTTP_201_CREATED)
+
+
+
+@api_view(['GET'])
+def image_batch_status_view(request, batch_id):
+    """
+    Report per-image and aggregate optimization progress for a batch upload.
+    Everything is derived from a single query over the batch's rows.
+    """
+    items = list(
+        UploadedImage.objects.filter(batch_id=batch_id)
+        .order_by('id')
+        .values('id', 'status', 'optimized_image')
+    )
+    if not items:
+        return Response(
+            {'error': 'Batch not found.'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    counts = Counter(item['status'] for item in items)
+    finished = counts['completed'] + counts['failed']
+    return Response({
+        'batch_id': str(batch_id),
+        'total': len(items),
+        'pending': counts['pending'] + counts['processing'],
+        'completed': counts['completed'],
+        'failed': counts['failed'],
+        'progress': round(finished / len(items), 4),
+        'done': finished == len(items),
+        'items': [
+            {
+                'id': item['id'],
+                'status': item['status'],
+                'optimized_image': default_storage.url(item['optimized_image']) if item['optimized_image'] else None,
+            }
+            for item in items
+        ],
+    }, status=status.HTTP_200_OK)
+
+
+
 @api_view(['GET'])
 def image_list_view(request, image_id):
     """
     Retrieve and serve the optimized image for download by its ID.
+    With '?width=<n>' (and optional '&format=WEBP|JPEG|PNG') the smallest rendition
+    at least that wide is served instead, falling back to the widest available.
     Returns the image file if optimized, or a status if pending/not found.
     """
     try:
         # Fetch only necessary fields to optimize query
         uploaded_image = UploadedImage.objects.only(
-            'optimized_image', 'output_format'
+            'optimized_image', 'output_format', 'optimized_format', 'status'
         ).get(pk=image_id)
     except UploadedImage.DoesNotExist:
         return Response(
@@ -52,6 +201,12 @@ def image_list_view(request, image_id):
             status=status.HTTP_404_NOT_FOUND
         )
 
+    if uploaded_image.status == 'failed':
+        return Response(
+            {'status': 'failed', 'message': 'Image optimization failed.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
     # Check if optimization is complete
     if not uploaded_image.optimized_image:
         return Response(
@@ -59,12 +214,132 @@ def image_list_view(request, image_id):
             status=status.HTTP_202_ACCEPTED
         )
 
+    width = request.query_params.get('width')
+    if width is not None:
+        if not width.isdigit():
+            return Response(
+                {'error': 'width must be a positive integer.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        rendition_format = request.query_params.get('format', uploaded_image.optimized_format or 'WEBP').upper()
+        renditions = ImageRendition.objects.filter(image_id=image_id, format=rendition_format)
+        rendition = (
+            renditions.filter(width__gte=int(width)).order_by('width').first()
+            or renditions.order_by('-width').first()
+        )
+        if rendition is None:
+            return Response(
+                {'error': f'No {rendition_format} renditions exist for this image.'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return FileResponse(
+            open(rendition.file.path, 'rb'),
+            as_attachment=True,
+            filename=f"optimized_{image_id}_{rendition.width}w.{rendition.format.lower()}"
+        )
+
     # Serve the optimized image as a downloadable file
     file_path = uploaded_image.optimized_image.path
-    file_name = f"optimized_{image_id}.{uploaded_image.output_format.lower()}"
+    optimized_format = uploaded_image.optimized_format or uploaded_image.output_format
+    file_name = f"optimized_{image_id}.{optimized_format.lower()}"
     response = FileResponse(
         open(file_path, 'rb'),
         as_attachment=True,
         filename=file_name
     )
-    return response
\ No newline at end of file
+    return response
+
+
+
+@api_view(['GET'])
+@throttle_classes([DerivativeThrottle])
+def image_derivative_view(request, image_id, transform):
+    """
+    Serve a derivative of the original image built on demand, e.g.
+    /image/42/w_640,f_webp/. Derivatives live in a disk cache with LRU eviction,
+    so repeated CDN requests are served without decoding the original again.
+    """
+    parsed = parse_transform(transform)
+    if parsed is None or not 0 < parsed[0] <= MAX_DERIVATIVE_WIDTH:
+        return Response(
+            {'error': f'Invalid transform. Use w_<1-{MAX_DERIVATIVE_WIDTH}> and optional f_<webp|jpeg|png>.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    width, output_format = parsed
+
+    try:
+        uploaded_image = UploadedImage.objects.only('original_image').get(pk=image_id)
+    except UploadedImage.DoesNotExist:
+        return Response(
+            {'error': 'Image not found.'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    try:
+        path = get_derivative(image_id, uploaded_image.original_image.path, width, output_format)
+    except LockError:
+        return Response(
+            {'error': 'Derivative is still being built, retry shortly.'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    except DerivativeTooLarge:
+        return Response(
+            {'error': 'The original is too large to resize on demand; use its renditions instead.'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    except DerivativeBusy:
+        return Response(
+            {'error': 'The server is busy, retry shortly.'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': str(settings.ADMISSION_RETRY_DELAY)}
+        )
+
+    response = FileResponse(open(path, 'rb'), content_type=CONTENT_TYPES[output_format])
+    # Originals never change, so a derivative URL always maps to the same bytes
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+
+@api_view(['GET'])
+def image_similar_view(request, image_id):
+    """
+    List images that look near-identical to the given one (re-saved, resized or
+    slightly cropped copies): images whose perceptual hash is within
+    '?distance=<k>' bits, nearest first, at most MAX_SIMILAR_RESULTS of them.
+    """
+    distance = request.query_params.get('distance', str(DEFAULT_SIMILAR_DISTANCE))
+    if not distance.isdigit() or int(distance) > MAX_SIMILAR_DISTANCE:
+        return Response(
+            {'error': f'distance must be an integer between 0 and {MAX_SIMILAR_DISTANCE}.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        uploaded_image = UploadedImage.objects.only('perceptual_hash').get(pk=image_id)
+    except UploadedImage.DoesNotExist:
+        return Response(
+            {'error': 'Image not found.'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    if uploaded_image.perceptual_hash is None:
+        return Response(
+            {'status': 'pending', 'message': 'Image optimization is still in progress.'},
+            status=status.HTTP_202_ACCEPTED
+        )
+
+    matches = find_similar(uploaded_image, int(distance))[:MAX_SIMILAR_RESULTS]
+    # The index lags deletions until its next rebuild, so only report rows that still exist
+    existing = set(
+        UploadedImage.objects.filter(id__in=[match_id for match_id, _ in matches]).values_list('id', flat=True)
+    )
+    return Response({
+        'image_id': image_id,
+        'distance': int(distance),
+        'matches': [
+            {'id': match_id, 'distance': match_distance}
+            for match_id, match_distance in matches
+            if match_id in existing
+        ],
+    }, status=status.HTTP_200_OK)
@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html
 from .models import DocumentFile
-from .tasks import document_convert
+from MetaSqueeze.fairshare import submit, tenant_for, user_tenant
 
 class DocumentFileAdmin(admin.ModelAdmin):
     list_display = (
@@ -10,6 +10,7 @@ class DocumentFileAdmin(admin.ModelAdmin):
         'get_original_filename',
         'conversion_type',
         'status',
+        'uploaded_by',
         'uploaded_at',
         'get_converted_filename',
         'original_size',
@@ -27,6 +28,14 @@ class DocumentFileAdmin(admin.ModelAdmin):
         'error_message',
         'original_size',
         'converted_size',
+        'content_hash',
+        'converter_version',
+        'page_count',
+        'encrypted',
+        'text_coverage',
+        'image_ratio',
+        'converter',
+        'estimated_cpu_seconds',
     )
     actions = ['retry_failed_conversions']
 
@@ -47,14 +56,21 @@ class DocumentFileAdmin(admin.ModelAdmin):
     get_converted_filename.short_description = 'Converted File'
 
     def retry_failed_conversions(self, request, queryset):
-        """Retry conversion for failed documents."""
-        failed_docs = queryset.filter(status='failed')
+        """
+        Retry conversion for failed documents, queued behind their uploaders' other
+        jobs like a new upload (the admin's own for anonymous uploads).
+        """
+        failed_docs = list(queryset.filter(status='failed'))
+        by_tenant = {}
         for doc in failed_docs:
             doc.status = 'pending'
             doc.error_message = None
             doc.save()
-            document_convert.delay(str(doc.id))
-        self.message_user(request, f"Retried {failed_docs.count()} failed conversions.")
+            tenant = user_tenant(doc.uploaded_by_id) if doc.uploaded_by_id else tenant_for(request)
+            by_tenant.setdefault(tenant, []).append(doc.id)
+        for tenant, document_ids in by_tenant.items():
+            submit(tenant, 'document', document_ids)
+        self.message_user(request, f"Retried {len(failed_docs)} failed conversions.")
     retry_failed_conversions.short_description = "Retry failed conversions"
 
 admin.site.register(DocumentFile, DocumentFileAdmin)
\ No newline at end of file
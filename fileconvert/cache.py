@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import functools
+import subprocess
+from importlib.metadata import version, PackageNotFoundError
+from django.conf import settings
+from django_redis import get_redis_connection
+from .models import DocumentFile
+from .text import TEXT_ENGINES, WORD_TEXT_ENGINES
+
+logger = logging.getLogger(__name__)
+
+# Redis hash of hit/miss counters per conversion type
+STATS_KEY = 'conversion_cache:stats'
+
+# Libraries whose version decides each conversion's output
+CONVERTER_PACKAGES = {
+    'pdf_to_word': ['pdf2docx', 'PyMuPDF'],
+}
+# Text conversions: the setting naming the default extractor, and every extractor
+TEXT_CONVERSIONS = {
+    'pdf_to_text': ('PDF_TEXT_ENGINE', TEXT_ENGINES),
+    'word_to_text': ('WORD_TEXT_ENGINE', WORD_TEXT_ENGINES),
+}
+TEXT_ENGINE_PACKAGES = {
+    'pymupdf': ['PyMuPDF', 'pdfminer.six'],
+    'pdfminer': ['pdfminer.six'],
+    'stream': ['lxml', 'mammoth'],
+    'mammoth': ['mammoth'],
+}
+
+
+def file_hash(path):
+    """
+    Return the SHA-256 hex digest of a stored file, read chunk by chunk.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _package_version(name):
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return 'missing'
+
+
+@functools.lru_cache(maxsize=None)
+def _office_version():
+    """
+    Installed LibreOffice version, read once per process.
+    """
+    try:
+        result = subprocess.run([settings.OFFICE_BINARY, '--version'], capture_output=True, text=True, timeout=60)
+        return result.stdout.split()[1] if result.returncode == 0 else 'missing'
+    except (OSError, IndexError, subprocess.TimeoutExpired):
+        return 'missing'
+
+
+def converter_version(conversion_type, engine=None):
+    """
+    Identify everything that decides a conversion's output: the converter
+    libraries' versions and CONVERSION_CACHE_GENERATION. Upgrading a converter
+    changes it, so results of the old version are no longer reused.
+    Text conversions also name their extractor: the given engine, which should
+    be the one that wrote the text, or by default the configured one.
+    """
+    if conversion_type == 'word_to_pdf':
+        parts = [f"libreoffice-{_office_version()}"]
+    elif conversion_type in TEXT_CONVERSIONS:
+        engine = engine or getattr(settings, TEXT_CONVERSIONS[conversion_type][0])
+        parts = [engine] + [f"{name}-{_package_version(name)}" for name in TEXT_ENGINE_PACKAGES.get(engine, [])]
+    else:
+        parts = [f"{name}-{_package_version(name)}" for name in CONVERTER_PACKAGES.get(conversion_type, [])]
+    return '/'.join([f"g{settings.CONVERSION_CACHE_GENERATION}"] + parts)[:100]
+
+
+def record_lookup(conversion_type, hit):
+    try:
+        get_redis_connection('default').hincrby(STATS_KEY, f"{conversion_type}:{'hits' if hit else 'misses'}", 1)
+    except Exception as e:
+        logger.warning(f"Could not record conversion cache lookup: {e}")
+
+
+def reuse_conversion(doc, original_path, engine=None):
+    """
+    Look up an earlier conversion of identical content with the same conversion
+    type and converter version, for text conversions made by the given engine
+    (the one about to run). On a hit, point doc at its converted file and mark
+    doc completed (not saved); no converter needs to run.
+    Sets doc.content_hash and doc.converter_version either way; a text conversion
+    whose extractor falls back records the version of the one that wrote the
+    text instead (see convert_pdf_to_text). Returns True on a hit.
+    """
+    doc.content_hash = file_hash(original_path)
+    doc.converter_version = converter_version(doc.conversion_type, engine)
+    if not settings.CONVERSION_CACHE_ENABLED:
+        return False
+    source = (
+        DocumentFile.objects.filter(
+            content_hash=doc.content_hash,
+            conversion_type=doc.conversion_type,
+            converter_version=doc.converter_version,
+            status='completed',
+        )
+        .exclude(id=doc.id)
+        .exclude(converted_file='').exclude(converted_file__isnull=True)
+        .order_by('uploaded_at')
+        .first()
+    )
+    record_lookup(doc.conversion_type, source is not None)
+    if source is None:
+        return False
+    doc.converted_file = source.converted_file.name
+    doc.converted_size = source.converted_size
+    doc.status = 'completed'
+    logger.info(f"Reused conversion of document {source.id} for document {doc.id}")
+    return True
+
+
+def invalidate(conversion_types=None, stale_only=False):
+    """
+    Stop reusing stored conversions: those of the given conversion types (all if
+    None), or with stale_only just those made by an older converter version.
+    Documents keep their converted files. Returns the number of entries invalidated.
+    """
+    entries = DocumentFile.objects.filter(content_hash__isnull=False)
+    if conversion_types:
+        entries = entries.filter(conversion_type__in=conversion_types)
+    count = 0
+    for conversion_type in conversion_types or dict(DocumentFile.CONVERSION_CHOICES):
+        of_type = entries.filter(conversion_type=conversion_type)
+        if stale_only:
+            engines = TEXT_CONVERSIONS[conversion_type][1] if conversion_type in TEXT_CONVERSIONS else [None]
+            of_type = of_type.exclude(
+                converter_version__in=[converter_version(conversion_type, engine) for engine in engines]
+            )
+        count += of_type.update(content_hash=None)
+    return count
+
+
+def conversion_cache_stats():
+    """
+    Hits, misses and hit rate per conversion type, plus the current converter versions.
+    """
+    counters = {k.decode(): int(v) for k, v in get_redis_connection('default').hgetall(STATS_KEY).items()}
+    summary = {}
+    for conversion_type, _ in DocumentFile.CONVERSION_CHOICES:
+        hits = counters.get(f"{conversion_type}:hits", 0)
+        misses = counters.get(f"{conversion_type}:misses", 0)
+        summary[conversion_type] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+            'converter_version': converter_version(conversion_type),
+        }
+    hits = sum(stats['hits'] for stats in summary.values())
+    lookups = hits + sum(stats['misses'] for stats in summary.values())
+    return {
+        'hits': hits,
+        'misses': lookups - hits,
+        'hit_rate': round(hits / lookups, 4) if lookups else None,
+        'conversion_types': summary,
+    }
@@ -0,0 +1,84 @@
+import os
+import time
+import tempfile
+import multiprocessing
+import fitz
+from django.core.management.base import BaseCommand
+from base.utils import peak_rss_mb
+from fileconvert.text import TEXT_ENGINES
+
+
+def _run_one(path, engine, output_path):
+    """
+    Extract a PDF's text with one engine in a fresh process; return (seconds, pages,
+    peak RSS growth in MB over the process after imports).
+    """
+    import django
+    django.setup()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    with open(output_path, 'w', encoding='utf-8') as output:
+        TEXT_ENGINES[engine](path, output)
+    elapsed = time.perf_counter() - start
+    with fitz.open(path) as pdf:
+        pages = pdf.page_count
+    return elapsed, pages, peak_rss_mb() - baseline
+
+
+def _synthetic_corpus(directory, pages):
+    """
+    Write a text-heavy report of the given page count: a heading and two columns of body text per page.
+    """
+    path = os.path.join(directory, f"synthetic_{pages}_pages.pdf")
+    body = "The quick brown fox jumps over the lazy dog while the report sums up quarterly figures. " * 25
+    with fitz.open() as pdf:
+        for number in range(pages):
+            page = pdf.new_page()
+            page.insert_text((72, 60), f"Chapter {number // 10 + 1}, page {number + 1}", fontsize=16)
+            for column in range(2):
+                page.insert_textbox(fitz.Rect(72 + column * 240, 90, 300 + column * 240, 780), body, fontsize=9)
+        pdf.save(path)
+    return path
+
+
+class Command(BaseCommand):
+    help = "Benchmark PDF text extraction engines: pages/second and peak memory growth."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="PDF files or directories to benchmark.")
+        parser.add_argument('--synthetic-pages', type=int, default=500,
+                            help="Page count of the synthetic PDF used when no paths are given.")
+
+    def handle(self, *args, **options):
+        # maxtasksperchild=1 gives every measurement a fresh process so the peak RSS is per run.
+        ctx = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as tmp, ctx.Pool(1, maxtasksperchild=1) as pool:
+            paths = self._collect(options['paths']) or [_synthetic_corpus(tmp, options['synthetic_pages'])]
+            output_path = os.path.join(tmp, 'output.txt')
+
+            self.stdout.write(f"{'pdf':<32}{'engine':<10}{'pages':>7}{'pages/s':>10}{'peak +MB':>10}{'text KB':>10}")
+            totals = {engine: [0.0, 0, 0.0] for engine in TEXT_ENGINES}
+            for path in paths:
+                for engine in TEXT_ENGINES:
+                    elapsed, pages, peak = pool.apply(_run_one, (path, engine, output_path))
+                    totals[engine][0] += elapsed
+                    totals[engine][1] += pages
+                    totals[engine][2] = max(totals[engine][2], peak)
+                    self.stdout.write(
+                        f"{os.path.basename(path)[:30]:<32}{engine:<10}{pages:>7}{pages / elapsed:>10.1f}"
+                        f"{peak:>10.1f}{os.path.getsize(output_path) / 1024:>10.0f}"
+                    )
+
+            for engine, (elapsed, pages, peak) in totals.items():
+                self.stdout.write(f"{engine}: {pages / elapsed:.1f} pages/s, max peak RSS growth {peak:.1f} MB")
+
+    def _collect(self, entries):
+        paths = []
+        for entry in entries:
+            if os.path.isdir(entry):
+                paths += sorted(
+                    os.path.join(entry, name) for name in os.listdir(entry) if name.lower().endswith('.pdf')
+                )
+            else:
+                paths.append(entry)
+        return paths
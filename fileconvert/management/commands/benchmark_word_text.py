@@ -0,0 +1,120 @@
+import os
+import time
+import tempfile
+import zipfile
+import multiprocessing
+from django.core.management.base import BaseCommand
+from base.utils import peak_rss_mb
+from fileconvert.text import WORD_TEXT_ENGINES
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+PACKAGE_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+
+
+def _run_one(path, engine, output_path):
+    """
+    Extract a DOCX's text with one engine in a fresh process; return (seconds,
+    peak RSS growth in MB over the process after imports).
+    """
+    import django
+    django.setup()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    with open(output_path, 'w', encoding='utf-8') as output:
+        WORD_TEXT_ENGINES[engine](path, output)
+    return time.perf_counter() - start, peak_rss_mb() - baseline
+
+
+def _synthetic_corpus(directory, paragraphs):
+    """
+    Write a long report of the given paragraph count, with a small table every 50
+    paragraphs. The document part is streamed into the zip, so large corpora are cheap to make.
+    """
+    path = os.path.join(directory, f"synthetic_{paragraphs}_paragraphs.docx")
+    body = "The quick brown fox jumps over the lazy dog while the report sums up quarterly figures. " * 4
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml', CONTENT_TYPES)
+        docx.writestr('_rels/.rels', PACKAGE_RELS)
+        with docx.open('word/document.xml', 'w') as part:
+            part.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            )
+            for number in range(paragraphs):
+                part.write(
+                    f'<w:p><w:r><w:t xml:space="preserve">{number + 1}.</w:t><w:tab/>'
+                    f'<w:t>{body}</w:t></w:r></w:p>'.encode()
+                )
+                if number % 50 == 49:
+                    cells = ''.join(
+                        f'<w:tc><w:p><w:r><w:t>Q{quarter} {number}</w:t></w:r></w:p></w:tc>' for quarter in range(1, 5)
+                    )
+                    part.write(f'<w:tbl><w:tr>{cells}</w:tr><w:tr>{cells}</w:tr></w:tbl>'.encode())
+            part.write(b'</w:body></w:document>')
+    return path
+
+
+class Command(BaseCommand):
+    help = "Benchmark Word text extraction engines: time, peak memory growth and whether the outputs agree."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="DOCX files or directories to benchmark.")
+        parser.add_argument('--synthetic-paragraphs', type=int, default=100000,
+                            help="Paragraph count of the synthetic DOCX used when no paths are given.")
+
+    def handle(self, *args, **options):
+        # maxtasksperchild=1 gives every measurement a fresh process so the peak RSS is per run.
+        ctx = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as tmp, ctx.Pool(1, maxtasksperchild=1) as pool:
+            paths = self._collect(options['paths']) or [_synthetic_corpus(tmp, options['synthetic_paragraphs'])]
+
+            self.stdout.write(f"{'docx':<32}{'engine':<10}{'MB':>7}{'seconds':>10}{'peak +MB':>10}{'text KB':>10}")
+            totals = {engine: [0.0, 0.0] for engine in WORD_TEXT_ENGINES}
+            mismatches = []
+            for path in paths:
+                texts = {}
+                for engine in WORD_TEXT_ENGINES:
+                    output_path = os.path.join(tmp, f'{engine}.txt')
+                    elapsed, peak = pool.apply(_run_one, (path, engine, output_path))
+                    totals[engine][0] += elapsed
+                    totals[engine][1] = max(totals[engine][1], peak)
+                    with open(output_path, encoding='utf-8') as f:
+                        texts[engine] = f.read()
+                    self.stdout.write(
+                        f"{os.path.basename(path)[:30]:<32}{engine:<10}{os.path.getsize(path) / 2 ** 20:>7.1f}"
+                        f"{elapsed:>10.2f}{peak:>10.1f}{os.path.getsize(output_path) / 1024:>10.0f}"
+                    )
+                if len(set(texts.values())) > 1:
+                    mismatches.append(os.path.basename(path))
+
+            for engine, (elapsed, peak) in totals.items():
+                self.stdout.write(f"{engine}: {elapsed:.2f}s in total, max peak RSS growth {peak:.1f} MB")
+            if mismatches:
+                self.stdout.write(self.style.WARNING(f"Engines disagree on: {', '.join(mismatches)}"))
+            else:
+                self.stdout.write(self.style.SUCCESS("All engines produced identical text."))
+
+    def _collect(self, entries):
+        paths = []
+        for entry in entries:
+            if os.path.isdir(entry):
+                paths += sorted(
+                    os.path.join(entry, name) for name in os.listdir(entry) if name.lower().endswith('.docx')
+                )
+            else:
+                paths.append(entry)
+        return paths
@@ -0,0 +1,110 @@
+import os
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from docx import Document
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from fileconvert.office import OfficePool, office_unavailable_reason
+from fileconvert.utils import convert_word_to_pdf_subprocess
+
+
+def _synthetic_corpus(directory, count):
+    """
+    Write DOCX files of a few pages each: headings, body paragraphs and a table.
+    """
+    paths = []
+    for i in range(count):
+        document = Document()
+        for section in range(5):
+            document.add_heading(f"Section {section + 1}", level=1)
+            for paragraph in range(6):
+                document.add_paragraph(
+                    f"Document {i}, paragraph {paragraph}. " + "The quick brown fox jumps over the lazy dog. " * 12
+                )
+        table = document.add_table(rows=10, cols=4)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = str(i)
+        path = os.path.join(directory, f"synthetic_{i}.docx")
+        document.save(path)
+        paths.append(path)
+    return paths
+
+
+class Command(BaseCommand):
+    help = "Benchmark Word to PDF throughput (docs/minute): a LibreOffice process per call vs the office pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="DOCX files or directories to benchmark. "
+                                                     "Defaults to a synthetic corpus.")
+        parser.add_argument('--synthetic', type=int, default=20,
+                            help="Number of synthetic documents when no paths are given.")
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help="Documents converted at once (and office pool size).")
+
+    def handle(self, *args, **options):
+        if shutil.which(settings.OFFICE_BINARY) is None:
+            raise CommandError(f"{settings.OFFICE_BINARY} is not on PATH.")
+        concurrency = options['concurrency']
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = self._collect(options['paths']) or _synthetic_corpus(directory, options['synthetic'])
+            self.stdout.write(f"{len(paths)} documents, concurrency {concurrency}")
+            self.stdout.write(f"{'path':<12}{'docs/min':>10}{'mean s':>9}{'failed':>8}{'startup s':>11}")
+
+            self._report('subprocess', *self._run(paths, directory, convert_word_to_pdf_subprocess, concurrency), 0.0)
+
+            reason = office_unavailable_reason()
+            if reason:
+                self.stdout.write(f"pool: skipped, {reason}")
+                return
+            pool = OfficePool(concurrency)
+            start = time.perf_counter()
+            pool.start()
+            startup = time.perf_counter() - start
+            try:
+                self._report('pool', *self._run(paths, directory, pool.convert, concurrency), startup)
+            finally:
+                pool.stop()
+
+    def _run(self, paths, directory, convert, concurrency):
+        """
+        Convert every path; return (wall seconds, per-document seconds, failures).
+        """
+        def one(index, path):
+            output_path = os.path.join(directory, f"out_{index}.pdf")
+            start = time.perf_counter()
+            try:
+                convert(path, output_path)
+                ok = os.path.exists(output_path)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            if ok:
+                os.remove(output_path)
+            return elapsed, ok
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(one, range(len(paths)), paths))
+        return time.perf_counter() - start, [elapsed for elapsed, _ in results], sum(not ok for _, ok in results)
+
+    def _report(self, label, wall, timings, failed, startup):
+        converted = len(timings) - failed
+        self.stdout.write(
+            f"{label:<12}{converted / wall * 60:>10.1f}{sum(timings) / len(timings):>9.2f}"
+            f"{failed:>8}{startup:>11.1f}"
+        )
+
+    def _collect(self, entries):
+        paths = []
+        for entry in entries:
+            if os.path.isdir(entry):
+                paths += sorted(
+                    os.path.join(entry, name) for name in os.listdir(entry) if name.lower().endswith('.docx')
+                )
+            else:
+                paths.append(entry)
+        return paths
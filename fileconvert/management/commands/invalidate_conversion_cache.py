@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from fileconvert.cache import converter_version, invalidate
+from fileconvert.models import DocumentFile
+
+
+class Command(BaseCommand):
+    help = "Stop reusing stored document conversions, e.g. after upgrading a converter."
+
+    def add_arguments(self, parser):
+        parser.add_argument('conversion_types', nargs='*',
+                            help="Conversion types to invalidate. Defaults to all.")
+        parser.add_argument('--stale-only', action='store_true',
+                            help="Only invalidate conversions made by a converter version other than the current one.")
+
+    def handle(self, *args, **options):
+        conversion_types = options['conversion_types'] or None
+        unknown = set(conversion_types or []) - set(dict(DocumentFile.CONVERSION_CHOICES))
+        if unknown:
+            raise CommandError(f"Unknown conversion types: {', '.join(sorted(unknown))}")
+        count = invalidate(conversion_types, stale_only=options['stale_only'])
+        for conversion_type in conversion_types or dict(DocumentFile.CONVERSION_CHOICES):
+            self.stdout.write(f"{conversion_type}: current converter version {converter_version(conversion_type)}")
+        self.stdout.write(f"Invalidated {count} cached conversions.")
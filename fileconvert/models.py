@@ -1,4 +1,5 @@
 from django.db import models
+from django.conf import settings
 from django.core.validators import FileExtensionValidator
 import os
 import uuid
@@ -38,6 +39,10 @@ class DocumentFile(models.Model):
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Uploading user (None for anonymous uploads); jobs are scheduled fairly between users
+    uploaded_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='documents'
+    )
     original_file = models.FileField(
         upload_to=upload_to_original,
         validators=[FileExtensionValidator(allowed_extensions=['pdf', 'docx', 'txt'])]
@@ -52,6 +57,21 @@ class DocumentFile(models.Model):
     error_message = models.CharField(max_length=255, blank=True, null=True)
     original_size = models.BigIntegerField(null=True, blank=True)
     converted_size = models.BigIntegerField(null=True, blank=True)
+    # Conversion progress of page-based conversions (pdf_to_word)
+    pages_total = models.PositiveIntegerField(null=True, blank=True)
+    pages_done = models.PositiveIntegerField(null=True, blank=True)
+    # Conversion cache key, with conversion_type: identical content converted by the
+    # same converter version reuses the earlier converted file (see fileconvert.cache)
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    converter_version = models.CharField(max_length=100, null=True, blank=True)
+    # Pre-flight analysis of PDF inputs, made at upload (see fileconvert.preflight)
+    page_count = models.PositiveIntegerField(null=True, blank=True)
+    encrypted = models.BooleanField(null=True, blank=True)
+    text_coverage = models.FloatField(null=True, blank=True)
+    image_ratio = models.FloatField(null=True, blank=True)
+    # Converter chosen by the pre-flight and its expected cost in CPU-seconds
+    converter = models.CharField(max_length=30, null=True, blank=True)
+    estimated_cpu_seconds = models.FloatField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.get_conversion_type_display()} ({self.id})"
@@ -0,0 +1,337 @@
+import os
+import atexit
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+import time
+from celery.signals import worker_process_init, worker_process_shutdown, worker_ready
+from django.conf import settings
+from MetaSqueeze.celery import HEAVY_QUEUE, worker_consumes
+
+logger = logging.getLogger(__name__)
+
+# LibreOffice export filter for Writer documents to PDF
+PDF_EXPORT_FILTER = 'writer_pdf_Export'
+
+# Seconds between connection attempts while a process starts, and the limit on a health check
+CONNECT_RETRY_DELAY = 0.25
+HEALTH_CHECK_TIMEOUT = 10
+
+
+def _uno():
+    """
+    Import LibreOffice's Python-UNO bridge. It ships with LibreOffice (python3-uno)
+    rather than on PyPI, so it is only importable where LibreOffice is installed.
+    Raises RuntimeError when it is missing.
+    """
+    try:
+        import uno
+    except ImportError:
+        raise RuntimeError("LibreOffice Python-UNO bindings (python3-uno) are not installed.")
+    return uno
+
+
+def office_unavailable_reason():
+    """
+    Why documents cannot be converted through the office pool, or None if they can.
+    """
+    try:
+        _uno()
+    except RuntimeError as e:
+        return str(e)
+    if shutil.which(settings.OFFICE_BINARY) is None:
+        return f"{settings.OFFICE_BINARY} is not on PATH."
+    return None
+
+
+def office_available():
+    """
+    True if documents can be converted through the office pool.
+    """
+    return office_unavailable_reason() is None
+
+
+def _properties(**values):
+    uno = _uno()
+    result = []
+    for name, value in values.items():
+        prop = uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+        prop.Name, prop.Value = name, value
+        result.append(prop)
+    return tuple(result)
+
+
+class OfficeProcess:
+    """
+    One long-lived headless LibreOffice with its own user profile, driven over a
+    named UNO pipe. Separate profiles let processes run side by side without
+    fighting over the profile lock. Not thread safe: the pool lends it to one
+    caller at a time.
+    """
+
+    def __init__(self, name):
+        # Pipe name and profile directory; unique on the host
+        self.name = name
+        self.profile_dir = os.path.join(settings.OFFICE_PROFILE_ROOT, name)
+        self.process = None
+        self.desktop = None
+        self.conversions = 0
+
+    def start(self):
+        """
+        Launch the process and connect to it. Raises RuntimeError if it exits or
+        does not accept connections within OFFICE_STARTUP_TIMEOUT.
+        """
+        uno = _uno()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.process = subprocess.Popen(
+            [
+                settings.OFFICE_BINARY, '--headless', '--invisible', '--nologo', '--nodefault',
+                '--norestore', '--nolockcheck',
+                f'-env:UserInstallation={uno.systemPathToFileUrl(self.profile_dir)}',
+                f'--accept=pipe,name={self.name};urp;StarOffice.ComponentContext',
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context
+        )
+        deadline = time.monotonic() + settings.OFFICE_STARTUP_TIMEOUT
+        while True:
+            if self.process.poll() is not None:
+                code = self.process.returncode
+                self.process = None
+                raise RuntimeError(f"LibreOffice {self.name} exited during startup (code {code}).")
+            try:
+                context = resolver.resolve(f'uno:pipe,name={self.name};urp;StarOffice.ComponentContext')
+                break
+            except Exception:
+                # NoConnectException until the pipe is listening
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(
+                        f"LibreOffice {self.name} did not start within {settings.OFFICE_STARTUP_TIMEOUT}s."
+                    )
+                time.sleep(CONNECT_RETRY_DELAY)
+
+        self.desktop = context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+        self.conversions = 0
+        logger.info(f"Started LibreOffice {self.name} (pid {self.process.pid})")
+
+    def stop(self):
+        """
+        Shut the process down, killing it if it does not exit promptly.
+        """
+        process, desktop = self.process, self.desktop
+        self.process, self.desktop = None, None
+        if process is None:
+            return
+        if desktop is not None and process.poll() is None:
+            try:
+                desktop.terminate()
+            except Exception:
+                pass
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        logger.info(f"Stopped LibreOffice {self.name} after {self.conversions} conversions")
+
+    def _kill(self):
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def _call(self, timeout, function, *args):
+        """
+        Run a UNO call, killing the process if it takes longer than timeout seconds
+        (a blocked call then fails instead of hanging the worker).
+        Returns (result, timed_out).
+        """
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            self._kill()
+
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.start()
+        try:
+            return function(*args), False
+        except Exception:
+            if expired.is_set():
+                return None, True
+            raise
+        finally:
+            watchdog.cancel()
+
+    def is_healthy(self):
+        """
+        True if the process is running and answers a UNO call.
+        """
+        if self.process is None or self.desktop is None or self.process.poll() is not None:
+            return False
+        try:
+            _, timed_out = self._call(HEALTH_CHECK_TIMEOUT, self.desktop.getComponents)
+        except Exception:
+            return False
+        return not timed_out
+
+    def ensure_ready(self):
+        """
+        Start, recycle or restart the process as needed before a conversion.
+        A process that stopped responding gets a fresh profile, since a crash can
+        leave the old one corrupt.
+        """
+        if self.process is not None and self.conversions >= settings.OFFICE_RECYCLE_AFTER:
+            logger.info(f"Recycling LibreOffice {self.name} after {self.conversions} conversions")
+            self.stop()
+        elif self.process is not None and not self.is_healthy():
+            logger.warning(f"LibreOffice {self.name} is not responding; restarting it")
+            self.stop()
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+        if self.process is None:
+            self.start()
+
+    def convert(self, input_path, output_path, filter_name=PDF_EXPORT_FILTER):
+        """
+        Open input_path hidden and read-only and export it to output_path.
+        Raises RuntimeError if the document cannot be opened or the conversion times out.
+        """
+        uno = _uno()
+
+        def convert():
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(os.path.abspath(input_path)), '_blank', 0,
+                _properties(Hidden=True, ReadOnly=True),
+            )
+            if document is None:
+                raise RuntimeError("LibreOffice could not open the document.")
+            try:
+                document.storeToURL(
+                    uno.systemPathToFileUrl(os.path.abspath(output_path)),
+                    _properties(FilterName=filter_name),
+                )
+            finally:
+                document.close(True)
+
+        _, timed_out = self._call(settings.OFFICE_CONVERSION_TIMEOUT, convert)
+        self.conversions += 1
+        if timed_out:
+            raise RuntimeError(f"LibreOffice conversion timed out after {settings.OFFICE_CONVERSION_TIMEOUT}s.")
+
+
+class OfficePool:
+    """
+    A fixed set of OfficeProcesses shared by the threads of one worker process.
+    Each conversion borrows an idle process, so up to `size` documents convert at once.
+    """
+
+    def __init__(self, size):
+        self.processes = [OfficeProcess(f'metasqueeze-office-{os.getpid()}-{i}') for i in range(size)]
+        # Last in, first out: the most recently used process is the warmest
+        self.idle = queue.LifoQueue()
+        for process in self.processes:
+            self.idle.put(process)
+
+    def start(self):
+        """
+        Start every idle process now rather than on first use.
+        """
+        borrowed = []
+        try:
+            while True:
+                borrowed.append(self.idle.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            for process in borrowed:
+                process.ensure_ready()
+        finally:
+            for process in borrowed:
+                self.idle.put(process)
+
+    def stop(self):
+        for process in self.processes:
+            process.stop()
+
+    def convert(self, input_path, output_path, filter_name=PDF_EXPORT_FILTER):
+        """
+        Convert one document on a pooled process.
+        If the process crashes mid-conversion it is restarted and the document is
+        tried once more; a timeout or a second failure is raised to the caller.
+        """
+        try:
+            process = self.idle.get(timeout=settings.OFFICE_CONVERSION_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("No LibreOffice process became free in time.")
+        try:
+            for attempt in range(2):
+                process.ensure_ready()
+                try:
+                    return process.convert(input_path, output_path, filter_name)
+                except RuntimeError:
+                    raise
+                except Exception as e:
+                    if attempt or process.is_healthy():
+                        raise
+                    logger.warning(f"LibreOffice {process.name} crashed converting {input_path}: {e}; retrying")
+        finally:
+            self.idle.put(process)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_office_pool():
+    """
+    The worker process's office pool, created (not started) on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OfficePool(settings.OFFICE_POOL_SIZE)
+            atexit.register(_pool.stop)
+        return _pool
+
+
+@worker_ready.connect
+def check_office_pool(**kwargs):
+    """
+    Say loudly, once per heavy-lane worker, when the office pool cannot run: Word
+    to PDF then starts a full LibreOffice for every document, which still works
+    but costs seconds of startup per conversion.
+    """
+    if not worker_consumes(HEAVY_QUEUE):
+        return
+    reason = office_unavailable_reason()
+    if reason:
+        logger.error(f"Office pool unavailable, Word to PDF falls back to one LibreOffice per document: {reason}")
+
+
+@worker_process_init.connect
+def warm_office_pool(**kwargs):
+    """
+    Start the pool as each Celery worker process boots, so the first job does
+    not pay for LibreOffice startup. Only workers on the heavy lane, where Word
+    to PDF jobs run, start one: each LibreOffice holds a few hundred MB.
+    """
+    if not settings.OFFICE_POOL_WARM or not worker_consumes(HEAVY_QUEUE) or not office_available():
+        return
+    try:
+        get_office_pool().start()
+    except RuntimeError as e:
+        logger.warning(f"Could not warm the office pool: {e}")
+
+
+@worker_process_shutdown.connect
+def stop_office_pool(**kwargs):
+    if _pool is not None:
+        _pool.stop()
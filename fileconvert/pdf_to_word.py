@@ -0,0 +1,146 @@
+import math
+import logging
+import billiard
+from concurrent.futures import ProcessPoolExecutor, FIRST_EXCEPTION, wait
+from pdf2docx import Converter
+from pdf2docx.converter import ConversionException
+
+logger = logging.getLogger(__name__)
+
+# pdf2docx options used for every conversion (on top of its defaults)
+CONVERT_OPTIONS = {
+    'layout_mode': 'loose',
+    'preserve_font_direction': True,
+    'preserve_image': True,
+    'preserve_table': True,
+}
+
+# Smallest page range one worker parses: header/footer detection compares the
+# pages of a range, so it needs a few of them. Ranges per worker balance uneven pages.
+MIN_CHUNK_PAGES = 8
+CHUNKS_PER_WORKER = 2
+
+# Seconds between progress reports while the workers run
+PROGRESS_INTERVAL = 1.0
+
+# Pages parsed so far by all workers (set in each worker by _init_worker)
+_pages_done = None
+
+
+def _settings(converter):
+    return {**converter.default_settings, **CONVERT_OPTIONS}
+
+
+def _parse_pages(converter, pages, settings, on_page):
+    """
+    Parse the given page indexes of an opened Converter, calling on_page() after each one.
+    Mirrors Converter.parse, which has no per-page hook.
+    """
+    converter.load_pages(pages=pages)
+    converter.parse_document(**settings)
+    for page in converter.pages:
+        if page.skip_parsing:
+            continue
+        try:
+            page.parse(**settings)
+        except Exception as e:
+            if settings['debug'] or not settings['ignore_page_error']:
+                raise ConversionException(f'Error when parsing page {page.id + 1}: {e}')
+            logger.error(f"Ignoring page {page.id + 1} after a parsing error: {e}")
+        on_page()
+
+
+def _init_worker(counter):
+    global _pages_done
+    _pages_done = counter
+
+
+def _count_page():
+    with _pages_done.get_lock():
+        _pages_done.value += 1
+
+
+def _parse_chunk(job):
+    """
+    Worker: parse one page range of the PDF and return pdf2docx's stored page data.
+    """
+    input_path, pages = job
+    converter = Converter(input_path)
+    try:
+        _parse_pages(converter, pages, _settings(converter), _count_page)
+        return converter.store()['pages']
+    finally:
+        converter.close()
+
+
+def page_chunks(page_count, workers):
+    """
+    Split pages 0..page_count-1 into contiguous ranges, in page order.
+    """
+    size = max(MIN_CHUNK_PAGES, math.ceil(page_count / (workers * CHUNKS_PER_WORKER)))
+    return [list(range(first, min(first + size, page_count))) for first in range(0, page_count, size)]
+
+
+def convert_pages_sequential(input_path, output_path, progress=None):
+    """
+    Convert a PDF to DOCX in this process, reporting progress(pages_done, page_count) after every page.
+    """
+    converter = Converter(input_path)
+    try:
+        page_count = len(converter.fitz_doc)
+        settings = _settings(converter)
+        done = 0
+
+        def on_page():
+            nonlocal done
+            done += 1
+            if progress:
+                progress(done, page_count)
+
+        _parse_pages(converter, None, settings, on_page)
+        converter.make_docx(output_path, **settings)
+    finally:
+        converter.close()
+
+
+def convert_pages_parallel(input_path, output_path, page_count, workers, progress=None):
+    """
+    Convert a PDF to DOCX with page ranges parsed in parallel by `workers` processes.
+    Each worker opens the PDF itself (PyMuPDF documents cannot be shared) and
+    returns its parsed pages; they are restored into one Converter by page id,
+    so the DOCX has the same page order as the PDF, and the DOCX is written once.
+    progress(pages_done, page_count) is called as pages finish, at most every PROGRESS_INTERVAL.
+    """
+    chunks = page_chunks(page_count, workers)
+    # billiard's processes, unlike multiprocessing's, may be started from a Celery worker process
+    context = billiard.get_context('fork')
+    counter = context.Value('i', 0)
+    logger.info(f"Parsing {page_count} pages in {len(chunks)} ranges on {workers} processes")
+
+    with ProcessPoolExecutor(min(workers, len(chunks)), mp_context=context,
+                             initializer=_init_worker, initargs=(counter,)) as executor:
+        futures = [executor.submit(_parse_chunk, (input_path, pages)) for pages in chunks]
+        reported = 0
+        pending = futures
+        while pending:
+            _, pending = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION)
+            failed = next((future for future in futures if future.done() and future.exception()), None)
+            if failed is not None:
+                executor.shutdown(cancel_futures=True)
+                raise failed.exception()
+            done = counter.value
+            if progress and done != reported:
+                progress(done, page_count)
+                reported = done
+        # In page order, whatever order the ranges finished in
+        parsed = [future.result() for future in futures]
+
+    converter = Converter(input_path)
+    try:
+        converter.load_pages()
+        converter.restore({'page_cnt': page_count, 'pages': [page for chunk in parsed for page in chunk]})
+        converter.make_docx(output_path, **_settings(converter))
+    finally:
+        converter.close()
+    if progress and reported != page_count:
+        progress(page_count, page_count)
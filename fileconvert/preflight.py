@@ -0,0 +1,179 @@
+import logging
+import zipfile
+import fitz
+from django.conf import settings
+from .pdf_to_word import page_chunks
+
+logger = logging.getLogger(__name__)
+
+# Pages inspected, spread evenly over the document; enough to tell a text
+# report from a scan without the analysis growing with the document
+SAMPLE_PAGES = 12
+
+# Characters of extracted text below which a page counts as having none (page numbers, stray marks)
+MIN_PAGE_TEXT = 20
+
+# CPU-seconds per page for a page of dense text and for a full-page image, measured
+# with the benchmark corpora on one core; a page costs in between by its content
+PAGE_COSTS = {
+    'pdf2docx': (0.78, 0.22),
+    'pdfminer': (0.066, 0.001),
+    'pymupdf': (0.0025, 0.0002),
+}
+# Fixed CPU-seconds per job (opening the document, writing the output), and per
+# page range parsed in its own process by the parallel pdf_to_word converter
+JOB_OVERHEAD = 0.05
+PARALLEL_RANGE_OVERHEAD = 0.2
+
+# CPU-seconds of Word jobs: a LibreOffice load and export, plus per MB of document
+# XML (uncompressed) for the export and for each text extractor (benchmark_word_text)
+WORD_TO_PDF_SECONDS = 3.0
+WORD_TO_PDF_SECONDS_PER_MB = 0.5
+WORD_TEXT_SECONDS_PER_MB = {
+    'stream': 0.04,
+    'mammoth': 0.6,
+}
+
+
+class PreflightError(Exception):
+    """
+    The PDF cannot be converted by any converter (unreadable, or password protected).
+    """
+
+
+def _sample(page_count):
+    if page_count <= SAMPLE_PAGES:
+        return list(range(page_count))
+    step = page_count / SAMPLE_PAGES
+    return [int(i * step) for i in range(SAMPLE_PAGES)]
+
+
+def analyze_pdf(input_path):
+    """
+    Inspect a PDF with PyMuPDF without converting it. Returns a dict with
+    - page_count
+    - encrypted: the PDF is encrypted (but opens without a password)
+    - text_coverage: share of sampled pages with a text layer (fonts in use)
+    - extracted_coverage: share of sampled pages PyMuPDF extracts text from
+    - image_ratio: mean share of the sampled page area covered by images
+    Raises PreflightError if the PDF cannot be opened or needs a password.
+    """
+    try:
+        pdf = fitz.open(input_path)
+    except Exception as e:
+        logger.warning(f"Preflight could not open {input_path}: {e}")
+        raise PreflightError("The file is not a readable PDF.")
+    with pdf:
+        if pdf.needs_pass:
+            raise PreflightError("The PDF is password protected.")
+        page_count = pdf.page_count
+        sampled = _sample(page_count)
+        text_pages = extracted_pages = 0
+        image_area = 0.0
+        for number in sampled:
+            page = pdf[number]
+            page_area = abs(page.rect) or 1
+            if page.get_fonts():
+                text_pages += 1
+            if len(page.get_text('text').strip()) >= MIN_PAGE_TEXT:
+                extracted_pages += 1
+            covered = sum(abs(fitz.Rect(image['bbox']) & page.rect) for image in page.get_image_info())
+            image_area += min(1.0, covered / page_area)
+        sample_count = len(sampled) or 1
+        return {
+            'page_count': page_count,
+            'encrypted': bool(pdf.is_encrypted or pdf.metadata.get('encryption')),
+            'text_coverage': text_pages / sample_count,
+            'extracted_coverage': extracted_pages / sample_count,
+            'image_ratio': image_area / sample_count,
+        }
+
+
+def choose_converter(conversion_type, analysis):
+    """
+    The cheapest converter expected to work for a PDF job:
+    - pdf_to_text: PyMuPDF when it extracts the text layer; pdfminer straight away
+      when there is a text layer PyMuPDF gets nothing from; PyMuPDF for pages with
+      no text layer at all (scans), where no extractor finds anything
+    - pdf_to_word: pdf2docx, in parallel page ranges for long documents
+    """
+    if conversion_type == 'pdf_to_text':
+        if settings.PDF_TEXT_ENGINE == 'pdfminer':
+            return 'pdfminer'
+        if analysis['text_coverage'] and not analysis['extracted_coverage']:
+            return 'pdfminer'
+        return 'pymupdf'
+    if conversion_type == 'pdf_to_word':
+        parallel = (
+            settings.PDF_TO_WORD_WORKERS > 1
+            and analysis['page_count'] >= settings.PDF_TO_WORD_PARALLEL_PAGES
+        )
+        return 'pdf2docx-parallel' if parallel else 'pdf2docx'
+    return None
+
+
+def estimate_cpu_seconds(converter, analysis):
+    """
+    Expected CPU-seconds of a conversion on the given converter, from the page
+    count and how much of the pages is text and image.
+    """
+    base = converter.split('-')[0]
+    text_cost, image_cost = PAGE_COSTS[base]
+    page_cost = text_cost * analysis['text_coverage'] + image_cost * analysis['image_ratio']
+    seconds = JOB_OVERHEAD + page_cost * analysis['page_count']
+    if converter == 'pdf2docx-parallel':
+        seconds += PARALLEL_RANGE_OVERHEAD * len(page_chunks(analysis['page_count'], settings.PDF_TO_WORD_WORKERS))
+    return round(seconds, 2)
+
+
+def docx_xml_bytes(input_path):
+    """
+    Uncompressed size of the document XML in a DOCX, read from the zip directory alone.
+    Raises PreflightError if the file is not a zip.
+    """
+    try:
+        with zipfile.ZipFile(input_path) as docx:
+            return sum(
+                info.file_size for info in docx.infolist()
+                if info.filename.startswith('word/') and info.filename.endswith('.xml')
+            )
+    except zipfile.BadZipFile:
+        raise PreflightError("The file is not a readable DOCX.")
+
+
+def preflight_word(doc):
+    """
+    Record the converter and the cost estimate of a Word document (without saving).
+    """
+    megabytes = docx_xml_bytes(doc.original_file.path) / 2**20
+    if doc.conversion_type == 'word_to_pdf':
+        doc.converter = 'libreoffice'
+        seconds = WORD_TO_PDF_SECONDS + megabytes * WORD_TO_PDF_SECONDS_PER_MB
+    else:
+        doc.converter = settings.WORD_TEXT_ENGINE
+        seconds = JOB_OVERHEAD + megabytes * WORD_TEXT_SECONDS_PER_MB.get(doc.converter, 0)
+    doc.estimated_cpu_seconds = round(seconds, 2)
+
+
+def preflight(doc):
+    """
+    Analyze a document before it is queued and record the analysis, the chosen
+    converter and the cost estimate on it (without saving). Word documents get
+    the converter and the estimate only.
+    Raises PreflightError if the document cannot be converted.
+    """
+    if doc.conversion_type.startswith('word_'):
+        preflight_word(doc)
+        return
+    analysis = analyze_pdf(doc.original_file.path)
+    converter = choose_converter(doc.conversion_type, analysis)
+    doc.page_count = analysis['page_count']
+    doc.encrypted = analysis['encrypted']
+    doc.text_coverage = round(analysis['text_coverage'], 3)
+    doc.image_ratio = round(analysis['image_ratio'], 3)
+    doc.converter = converter
+    doc.estimated_cpu_seconds = estimate_cpu_seconds(converter, analysis)
+    logger.info(
+        f"Preflight of document {doc.id}: {doc.page_count} pages, text {doc.text_coverage:.0%}, "
+        f"images {doc.image_ratio:.0%}, {converter}, ~{doc.estimated_cpu_seconds}s CPU"
+    )
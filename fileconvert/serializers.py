@@ -14,6 +14,14 @@ class DocumentFileSerializer(serializers.ModelSerializer):
             'error_message',
             'original_size',
             'converted_size',
+            'pages_total',
+            'pages_done',
+            'page_count',
+            'encrypted',
+            'text_coverage',
+            'image_ratio',
+            'converter',
+            'estimated_cpu_seconds',
         ]
         read_only_fields = [
             'id',
@@ -23,6 +31,14 @@ class DocumentFileSerializer(serializers.ModelSerializer):
             'error_message',
             'original_size',
             'converted_size',
+            'pages_total',
+            'pages_done',
+            'page_count',
+            'encrypted',
+            'text_coverage',
+            'image_ratio',
+            'converter',
+            'estimated_cpu_seconds',
         ]
 
     def validate_conversion_type(self, value):
@@ -1,19 +1,70 @@
 import os
+import time
+import uuid
 import logging
+import tempfile
 from celery import shared_task
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django_redis import get_redis_connection
 from .models import DocumentFile
+from .cache import converter_version, reuse_conversion
 from .utils import (
     convert_pdf_to_word,
     convert_word_to_pdf,
     convert_pdf_to_text,
-    convert_word_to_text
+    convert_word_to_text,
+    convert_words_to_pdf,
+    batch_pdf_path,
+    count_pdf_pages
 )
+from MetaSqueeze.admission import memory_admission
+from MetaSqueeze.celery import COST_HEADER
+from MetaSqueeze.fairshare import fair_share_job, job_finished, job_started
 
 logger = logging.getLogger(__name__)
 
-@shared_task
+# Memory estimates for admission control
+MB = 1024 * 1024
+PDF_PAGE_MEMORY = {
+    'pdf_to_word': 40 * MB,  # pdf2docx keeps a layout model of every page
+    'pdf_to_text': 2 * MB,
+}
+WORD_TO_PDF_MEMORY = 400 * MB  # a headless LibreOffice process
+DOCX_EXPANSION_FACTOR = 30  # in-memory document model vs the compressed DOCX
+
+# Redis list of word_to_pdf documents waiting for a batch, and the flag set while a flush is scheduled
+BATCH_PENDING_KEY = 'word_to_pdf:pending'
+BATCH_FLUSH_KEY = 'word_to_pdf:flush'
+# Documents of a running batch stay in a list of their own until their outcome is recorded;
+# the sorted set holds every such list by the time it counts as stale (its worker died)
+BATCH_PROCESSING_PREFIX = 'word_to_pdf:processing:'
+BATCH_RUNNING_KEY = 'word_to_pdf:batches'
+# Batches a document may be taken into before it is failed rather than re-queued again
+BATCH_ATTEMPTS_KEY = 'word_to_pdf:attempts'
+BATCH_MAX_ATTEMPTS = 3
+# Seconds past the heavy lane's hard time limit before a batch counts as stale
+BATCH_STALE_GRACE = 60
+
+
+def estimate_conversion_memory(document_id):
+    """
+    Expected peak memory of document_convert in bytes, from page count and file size.
+    """
+    doc = DocumentFile.objects.only('original_file', 'conversion_type', 'page_count').get(id=document_id)
+    original_path = doc.original_file.path
+    original_size = os.path.getsize(original_path)
+    if doc.conversion_type in PDF_PAGE_MEMORY:
+        page_count = doc.page_count if doc.page_count is not None else count_pdf_pages(original_path)
+        return original_size * 2 + page_count * PDF_PAGE_MEMORY[doc.conversion_type]
+    if doc.conversion_type == 'word_to_pdf':
+        return WORD_TO_PDF_MEMORY
+    return original_size * DOCX_EXPANSION_FACTOR
+
+
+@shared_task(bind=True)
+@fair_share_job('document')
+@memory_admission(estimate_conversion_memory)
 def document_convert(document_id):
     """
     Celery task to convert a document based on its conversion_type using utility functions.
@@ -48,6 +99,15 @@ def document_convert(document_id):
             logger.error(f"Invalid file format for document {document_id}: {original_path}")
             return
 
+        # Text conversions run the extractor the pre-flight chose (the configured one without it)
+        engine = doc.converter if doc.conversion_type in ('pdf_to_text', 'word_to_text') else None
+
+        # Identical content converted earlier by the same converter version: reuse it
+        if reuse_conversion(doc, original_path, engine):
+            doc.save()
+            logger.info(f"Completed conversion for document {document_id} from the conversion cache")
+            return
+
         # Determine output file extension and filename
         extension = {
             'pdf_to_word': 'docx',
@@ -79,8 +139,21 @@ def document_convert(document_id):
             logger.error(f"Unsupported conversion type for document {document_id}: {doc.conversion_type}")
             return
 
-        # Run the conversion utility function
-        conversion_func(original_path, output_path)
+        # Run the conversion utility function, on the converter the pre-flight chose if it ran
+        if doc.conversion_type == 'pdf_to_word':
+            conversion_func(
+                original_path, output_path,
+                progress=lambda done, total: report_page_progress(doc, done, total),
+                parallel=None if doc.converter is None else doc.converter == 'pdf2docx-parallel',
+            )
+        elif doc.conversion_type == 'pdf_to_text':
+            engine = conversion_func(original_path, output_path, engine=engine, fallback=doc.text_coverage != 0)
+        elif doc.conversion_type == 'word_to_text':
+            engine = conversion_func(original_path, output_path, engine=engine)
+        else:
+            conversion_func(original_path, output_path)
+        # Cached under the extractor that actually wrote the text, which a fallback may have changed
+        doc.converter_version = converter_version(doc.conversion_type, engine)
 
         # Ensure the output file was created
         if not os.path.exists(output_path):
@@ -134,3 +207,204 @@ def document_convert(document_id):
                 logger.info(f"Cleaned up temporary file after failure: {output_path}")
             except Exception as e:
                 logger.warning(f"Failed to clean up temporary file {output_path}: {str(e)}")
+        job_finished('document', document_id)
+
+
+
+def report_page_progress(doc, pages_done, pages_total):
+    """
+    Record how many pages of a document have been converted so far.
+    """
+    doc.pages_done, doc.pages_total = pages_done, pages_total
+    DocumentFile.objects.filter(id=doc.id).update(pages_done=pages_done, pages_total=pages_total)
+
+
+def start_conversions(document_ids):
+    """
+    Schedule the conversions of documents the fair-share dispatcher released.
+    """
+    for doc in DocumentFile.objects.filter(id__in=document_ids):
+        schedule_conversion(doc)
+
+
+def schedule_conversion(doc):
+    """
+    Queue a document's conversion. word_to_pdf documents are collected for a
+    micro-batch: a batch is flushed once WORD_TO_PDF_BATCH_SIZE documents are
+    waiting, or WORD_TO_PDF_BATCH_WINDOW_MS after the first one arrived.
+    Without Redis every document is converted on its own. A document converted on
+    its own carries the pre-flight's cost estimate, which picks its lane.
+    """
+    if doc.conversion_type != 'word_to_pdf' or settings.WORD_TO_PDF_BATCH_SIZE <= 1:
+        document_convert.apply_async((doc.id,), headers={COST_HEADER: doc.estimated_cpu_seconds})
+        return
+    window = settings.WORD_TO_PDF_BATCH_WINDOW_MS
+    try:
+        connection = get_redis_connection('default')
+        waiting = connection.rpush(BATCH_PENDING_KEY, str(doc.id))
+        if waiting >= settings.WORD_TO_PDF_BATCH_SIZE:
+            word_to_pdf_batch.delay()
+        elif connection.set(BATCH_FLUSH_KEY, 1, nx=True, px=window):
+            word_to_pdf_batch.apply_async(countdown=window / 1000)
+    except Exception as e:
+        logger.warning(f"Batching unavailable, converting document {doc.id} on its own: {e}")
+        document_convert.apply_async((doc.id,), headers={COST_HEADER: doc.estimated_cpu_seconds})
+
+
+def estimate_batch_memory():
+    """
+    Expected peak memory of word_to_pdf_batch: one LibreOffice, whatever the batch size.
+    """
+    return WORD_TO_PDF_MEMORY
+
+
+@shared_task(bind=True)
+@memory_admission(estimate_batch_memory)
+def word_to_pdf_batch():
+    """
+    Celery task to convert up to WORD_TO_PDF_BATCH_SIZE waiting word_to_pdf documents at once.
+    - Moves them to a processing list of the batch, so a worker killed mid-batch
+      (time limit, OOM, LibreOffice taking it down) loses none: requeue_stale_batches
+      puts them back.
+    - Converts them in one LibreOffice pass into a scratch directory.
+    - Maps each PDF back to its DocumentFile by the document id it was named after.
+    - Fails only the documents that produced no PDF; the rest of the batch completes.
+    - Renews a document's fair-share lease as it is taken, and frees its place
+      once its outcome is recorded.
+    """
+    connection = get_redis_connection('default')
+    # Cleared before taking documents: documents queued from now on schedule a new flush
+    connection.delete(BATCH_FLUSH_KEY)
+    processing_key = f"{BATCH_PROCESSING_PREFIX}{uuid.uuid4().hex}"
+    stale_at = time.time() + settings.TASK_LANES['heavy']['time_limit'] + BATCH_STALE_GRACE
+    connection.zadd(BATCH_RUNNING_KEY, {processing_key: stale_at})
+    ids = []
+    while len(ids) < settings.WORD_TO_PDF_BATCH_SIZE:
+        value = connection.lmove(BATCH_PENDING_KEY, processing_key, 'LEFT', 'RIGHT')
+        if value is None:
+            break
+        ids.append(value.decode())
+        connection.hincrby(BATCH_ATTEMPTS_KEY, ids[-1], 1)
+        job_started('document', ids[-1])
+    if connection.llen(BATCH_PENDING_KEY):
+        word_to_pdf_batch.delay()
+    try:
+        if ids:
+            _convert_batch(ids)
+    finally:
+        _settle_batch(connection, processing_key, ids)
+
+
+def _settle_batch(connection, processing_key, ids):
+    """
+    Drop the documents whose outcome is recorded (or that no longer exist) from a
+    batch's processing list and free their fair-share places. Documents left over
+    by an error part-way stay listed for requeue_stale_batches.
+    """
+    unsettled = {
+        str(document_id) for document_id in DocumentFile.objects.filter(id__in=ids)
+        .exclude(status__in=('completed', 'failed')).values_list('id', flat=True)
+    }
+    for document_id in ids:
+        if document_id not in unsettled:
+            connection.lrem(processing_key, 0, document_id)
+            connection.hdel(BATCH_ATTEMPTS_KEY, document_id)
+            job_finished('document', document_id)
+    if not unsettled:
+        connection.delete(processing_key)
+        connection.zrem(BATCH_RUNNING_KEY, processing_key)
+
+
+def requeue_stale_batches():
+    """
+    Put the documents of batches whose worker died back at the front of the pending
+    list and schedule a flush. A document already taken into BATCH_MAX_ATTEMPTS
+    batches is failed instead, so one that crashes LibreOffice cannot loop forever.
+    Returns the number of documents re-queued.
+    """
+    connection = get_redis_connection('default')
+    requeued = 0
+    for processing_key in connection.zrangebyscore(BATCH_RUNNING_KEY, 0, time.time()):
+        # Whoever removes the batch from the set owns its requeue
+        if not connection.zrem(BATCH_RUNNING_KEY, processing_key):
+            continue
+        # Last first, each moved to the front, so the batch keeps its order
+        while (value := connection.lindex(processing_key, -1)) is not None:
+            document_id = value.decode()
+            if int(connection.hget(BATCH_ATTEMPTS_KEY, document_id) or 0) < BATCH_MAX_ATTEMPTS:
+                DocumentFile.objects.filter(id=document_id, status='processing').update(status='pending')
+                connection.lmove(processing_key, BATCH_PENDING_KEY, 'RIGHT', 'LEFT')
+                requeued += 1
+                continue
+            doc = DocumentFile.objects.filter(id=document_id).first()
+            if doc is not None:
+                _fail_document(doc, "Conversion failed: the worker stopped while converting it.")
+            connection.rpop(processing_key)
+            connection.hdel(BATCH_ATTEMPTS_KEY, document_id)
+            job_finished('document', document_id)
+    if requeued:
+        logger.warning(f"Re-queued {requeued} word_to_pdf documents of stale batches")
+        word_to_pdf_batch.delay()
+    return requeued
+
+
+def _convert_batch(ids):
+    """
+    Convert the given word_to_pdf documents in one pass and record each outcome.
+    """
+    docs = list(DocumentFile.objects.filter(id__in=ids, conversion_type='word_to_pdf'))
+    DocumentFile.objects.filter(id__in=[doc.id for doc in docs]).update(status='processing')
+    logger.info(f"Starting word_to_pdf batch of {len(docs)} documents")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        input_dir = os.path.join(scratch, 'in')
+        output_dir = os.path.join(scratch, 'out')
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+
+        # Link every original under its document id, so outputs map back unambiguously
+        inputs = {}
+        for doc in docs:
+            try:
+                original_path = doc.original_file.path
+                doc.original_size = os.path.getsize(original_path)
+                if not original_path.lower().endswith('.docx'):
+                    raise ValueError("Invalid input file format for word_to_pdf. Expected: docx.")
+                if reuse_conversion(doc, original_path):
+                    doc.save()
+                    logger.info(f"Completed conversion for document {doc.id} from the conversion cache")
+                    continue
+                input_path = os.path.join(input_dir, f"{doc.id}.docx")
+                os.symlink(original_path, input_path)
+                inputs[doc.id] = input_path
+            except FileNotFoundError as e:
+                _fail_document(doc, f"File not found: {str(e)}")
+            except ValueError as e:
+                _fail_document(doc, str(e))
+
+        errors = convert_words_to_pdf(list(inputs.values()), output_dir) if inputs else {}
+
+        for doc in docs:
+            input_path = inputs.get(doc.id)
+            if input_path is None:
+                continue
+            output_path = batch_pdf_path(output_dir, input_path)
+            if input_path in errors or not os.path.exists(output_path):
+                _fail_document(doc, f"Conversion failed: {errors.get(input_path, 'Output file not created.')}")
+                continue
+            try:
+                with open(output_path, 'rb') as f:
+                    doc.converted_file.save(f"{doc.id}.pdf", ContentFile(f.read()), save=False)
+                doc.converted_size = os.path.getsize(output_path)
+                doc.status = 'completed'
+                doc.save()
+                logger.info(f"Completed conversion for document {doc.id}: {doc.converted_file.name}")
+            except Exception as e:
+                _fail_document(doc, f"Conversion failed: {str(e)}")
+
+
+def _fail_document(doc, message):
+    doc.status = 'failed'
+    doc.error_message = message[:255]
+    doc.save()
+    logger.error(f"Error converting document {doc.id}: {message}")
@@ -1,3 +1,337 @@
-from django.test import TestCase
+import io
+import os
+import time
+import tempfile
+import subprocess
+from unittest import mock
+import fakeredis
+import fitz
+from django.test import SimpleTestCase, TestCase, override_settings
+from . import office, tasks, utils
+from .cache import converter_version, reuse_conversion, STATS_KEY
+from .models import DocumentFile
+from .management.commands.benchmark_word_text import _synthetic_corpus
+from .pdf_to_word import page_chunks, convert_pages_sequential, convert_pages_parallel, MIN_CHUNK_PAGES
+from .preflight import choose_converter, estimate_cpu_seconds, JOB_OVERHEAD, PAGE_COSTS, PARALLEL_RANGE_OVERHEAD
+from .text import streaming_docx_text, mammoth_docx_text
 
-# Create your tests here.
+
+class WordTextTests(SimpleTestCase):
+    def test_streaming_text_matches_mammoth_with_tables(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Paragraphs with a two-row table every 50 of them
+            path = _synthetic_corpus(tmp, 120)
+            streamed, expected = io.StringIO(), io.StringIO()
+            paragraphs = streaming_docx_text(path, streamed)
+            mammoth_docx_text(path, expected)
+
+        self.assertEqual(streamed.getvalue(), expected.getvalue())
+        # 120 paragraphs and two tables of 2 rows x 4 cells
+        self.assertEqual(paragraphs, 120 + 2 * 8)
+
+
+class WordToPdfBatchTests(TestCase):
+    def setUp(self):
+        redis = fakeredis.FakeStrictRedis()
+        for target in ('fileconvert.tasks', 'MetaSqueeze.fairshare', 'MetaSqueeze.admission'):
+            patcher = mock.patch(f'{target}.get_redis_connection', return_value=redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks.word_to_pdf_batch, 'delay')
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis = redis
+        self.docs = [
+            DocumentFile.objects.create(original_file=f'documents/{number}.docx', conversion_type='word_to_pdf')
+            for number in range(3)
+        ]
+        for doc in self.docs:
+            redis.rpush(tasks.BATCH_PENDING_KEY, str(doc.id))
+
+    def ids(self, key):
+        return [value.decode() for value in self.redis.lrange(key, 0, -1)]
+
+    def test_documents_of_a_dead_worker_are_requeued(self):
+        def crash(ids):
+            # The first outcome is recorded, then the worker dies
+            DocumentFile.objects.filter(id=ids[0]).update(status='completed')
+            DocumentFile.objects.filter(id__in=ids[1:]).update(status='processing')
+            raise SystemExit
+
+        with mock.patch.object(tasks, '_convert_batch', side_effect=crash), self.assertRaises(SystemExit):
+            tasks.word_to_pdf_batch()
+
+        self.assertEqual(self.ids(tasks.BATCH_PENDING_KEY), [])
+        [processing_key] = self.redis.zrange(tasks.BATCH_RUNNING_KEY, 0, -1)
+        self.assertEqual(self.ids(processing_key), [str(doc.id) for doc in self.docs[1:]])
+
+        # Not stale yet
+        self.assertEqual(tasks.requeue_stale_batches(), 0)
+        with mock.patch.object(tasks.time, 'time', return_value=time.time() + 10**6):
+            self.assertEqual(tasks.requeue_stale_batches(), 2)
+        self.assertEqual(self.ids(tasks.BATCH_PENDING_KEY), [str(doc.id) for doc in self.docs[1:]])
+        self.assertFalse(self.redis.exists(processing_key))
+        self.assertEqual(DocumentFile.objects.get(id=self.docs[1].id).status, 'pending')
+        self.delay.assert_called()
+
+    def test_document_failed_after_max_attempts(self):
+        for doc in self.docs:
+            self.redis.hset(tasks.BATCH_ATTEMPTS_KEY, str(doc.id), tasks.BATCH_MAX_ATTEMPTS - 1)
+        with mock.patch.object(tasks, '_convert_batch', side_effect=SystemExit), self.assertRaises(SystemExit):
+            tasks.word_to_pdf_batch()
+        with mock.patch.object(tasks.time, 'time', return_value=time.time() + 10**6):
+            self.assertEqual(tasks.requeue_stale_batches(), 0)
+        self.assertEqual(self.ids(tasks.BATCH_PENDING_KEY), [])
+        self.assertEqual({doc.status for doc in DocumentFile.objects.all()}, {'failed'})
+
+    def test_finished_batch_leaves_nothing_behind(self):
+        def convert(ids):
+            DocumentFile.objects.filter(id__in=ids).update(status='completed')
+
+        with mock.patch.object(tasks, '_convert_batch', side_effect=convert):
+            tasks.word_to_pdf_batch()
+        self.assertEqual(self.redis.zcard(tasks.BATCH_RUNNING_KEY), 0)
+        self.assertEqual(self.redis.hlen(tasks.BATCH_ATTEMPTS_KEY), 0)
+        self.assertEqual(self.ids(tasks.BATCH_PENDING_KEY), [])
+
+
+class PdfToWordTests(SimpleTestCase):
+    def test_page_chunks_cover_every_page_in_order(self):
+        for page_count, workers in ((1, 4), (8, 4), (20, 2), (100, 4), (1001, 16)):
+            with self.subTest(page_count=page_count, workers=workers):
+                chunks = page_chunks(page_count, workers)
+                self.assertEqual([page for chunk in chunks for page in chunk], list(range(page_count)))
+                # Only the last range may be short of MIN_CHUNK_PAGES
+                self.assertTrue(all(len(chunk) >= MIN_CHUNK_PAGES for chunk in chunks[:-1]))
+        self.assertEqual(len(page_chunks(100, 4)), 8)
+        self.assertEqual(page_chunks(0, 4), [])
+
+    def test_parallel_conversion_matches_sequential(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, 'report.pdf')
+            with fitz.open() as pdf:
+                for number in range(20):
+                    page = pdf.new_page()
+                    page.insert_text((72, 72), f"Chapter {number + 1}", fontsize=18)
+                    page.insert_text((72, 120), f"Body text of page {number + 1}.")
+                pdf.save(input_path)
+
+            sequential, parallel = os.path.join(tmp, 'sequential.docx'), os.path.join(tmp, 'parallel.docx')
+            convert_pages_sequential(input_path, sequential)
+            progress = mock.Mock()
+            convert_pages_parallel(input_path, parallel, 20, 2, progress)
+
+            expected, actual = io.StringIO(), io.StringIO()
+            streaming_docx_text(sequential, expected)
+            streaming_docx_text(parallel, actual)
+
+        self.assertIn('Chapter 20', expected.getvalue())
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+        progress.assert_called_with(20, 20)
+
+
+class PreflightTests(SimpleTestCase):
+    def analysis(self, **values):
+        return {'page_count': 10, 'text_coverage': 1.0, 'extracted_coverage': 1.0, 'image_ratio': 0.0, **values}
+
+    @override_settings(PDF_TEXT_ENGINE='pymupdf')
+    def test_text_converter_follows_the_text_layer(self):
+        self.assertEqual(choose_converter('pdf_to_text', self.analysis()), 'pymupdf')
+        # A text layer PyMuPDF extracts nothing from
+        self.assertEqual(choose_converter('pdf_to_text', self.analysis(extracted_coverage=0.0)), 'pdfminer')
+        # A scan: nothing finds text, so the cheapest
+        scan = self.analysis(text_coverage=0.0, extracted_coverage=0.0, image_ratio=1.0)
+        self.assertEqual(choose_converter('pdf_to_text', scan), 'pymupdf')
+        with override_settings(PDF_TEXT_ENGINE='pdfminer'):
+            self.assertEqual(choose_converter('pdf_to_text', self.analysis()), 'pdfminer')
+
+    @override_settings(PDF_TO_WORD_WORKERS=4, PDF_TO_WORD_PARALLEL_PAGES=30)
+    def test_word_converter_goes_parallel_for_long_documents(self):
+        self.assertEqual(choose_converter('pdf_to_word', self.analysis(page_count=29)), 'pdf2docx')
+        self.assertEqual(choose_converter('pdf_to_word', self.analysis(page_count=30)), 'pdf2docx-parallel')
+        with override_settings(PDF_TO_WORD_WORKERS=1):
+            self.assertEqual(choose_converter('pdf_to_word', self.analysis(page_count=300)), 'pdf2docx')
+        self.assertIsNone(choose_converter('word_to_pdf', self.analysis()))
+
+    @override_settings(PDF_TO_WORD_WORKERS=4)
+    def test_cpu_estimate_from_page_content(self):
+        text_cost, image_cost = PAGE_COSTS['pdf2docx']
+        analysis = self.analysis(page_count=100, text_coverage=0.5, image_ratio=0.25)
+        sequential = JOB_OVERHEAD + (text_cost * 0.5 + image_cost * 0.25) * 100
+        self.assertEqual(estimate_cpu_seconds('pdf2docx', analysis), round(sequential, 2))
+        # Plus the overhead of each of the 8 page ranges
+        self.assertEqual(
+            estimate_cpu_seconds('pdf2docx-parallel', analysis), round(sequential + 8 * PARALLEL_RANGE_OVERHEAD, 2)
+        )
+        self.assertLess(estimate_cpu_seconds('pymupdf', analysis), estimate_cpu_seconds('pdfminer', analysis))
+
+
+@override_settings(CONVERSION_CACHE_ENABLED=True)
+class RetryFailedConversionsTests(TestCase):
+    def test_retries_are_queued_through_fair_share(self):
+        from django.contrib.admin.sites import site
+        from django.contrib.auth import get_user_model
+        from django.test import RequestFactory
+        from .admin import DocumentFileAdmin
+
+        User = get_user_model()
+        owner = User.objects.create_user('owner@example.com', 'Owner', 'User')
+        admin_user = User.objects.create_user('admin@example.com', 'Admin', 'User')
+        owned = DocumentFile.objects.create(
+            original_file='documents/a.pdf', conversion_type='pdf_to_text', status='failed', uploaded_by=owner,
+        )
+        anonymous = DocumentFile.objects.create(
+            original_file='documents/b.pdf', conversion_type='pdf_to_text', status='failed',
+        )
+        DocumentFile.objects.create(original_file='documents/c.pdf', conversion_type='pdf_to_text', status='completed')
+        request = RequestFactory().post('/')
+        request.user = admin_user
+
+        model_admin = DocumentFileAdmin(DocumentFile, site)
+        with mock.patch('fileconvert.admin.submit') as submit, mock.patch.object(model_admin, 'message_user') as message:
+            model_admin.retry_failed_conversions(request, DocumentFile.objects.all())
+
+        submit.assert_has_calls([
+            mock.call(f'user:{owner.pk}', 'document', [owned.id]),
+            mock.call(f'user:{admin_user.pk}', 'document', [anonymous.id]),
+        ], any_order=True)
+        self.assertEqual(submit.call_count, 2)
+        self.assertEqual(DocumentFile.objects.filter(status='pending').count(), 2)
+        self.assertEqual(message.call_args.args[1], "Retried 2 failed conversions.")
+
+
+class ConversionCacheTests(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        patcher = mock.patch('fileconvert.cache.get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'report.pdf')
+        with open(self.path, 'wb') as f:
+            f.write(b'%PDF-1.4 same content')
+
+    def earlier(self, **values):
+        doc = DocumentFile(original_file='documents/originals/earlier.pdf', conversion_type='pdf_to_text')
+        reuse_conversion(doc, self.path)
+        for name, value in {'status': 'completed', 'converted_file': 'documents/converted/earlier.txt',
+                            'converted_size': 42, **values}.items():
+            setattr(doc, name, value)
+        doc.save()
+        return doc
+
+    def test_identical_content_reuses_the_converted_file(self):
+        self.earlier()
+        doc = DocumentFile(original_file='documents/originals/new.pdf', conversion_type='pdf_to_text')
+        self.assertTrue(reuse_conversion(doc, self.path))
+        self.assertEqual(doc.status, 'completed')
+        self.assertEqual(doc.converted_file.name, 'documents/converted/earlier.txt')
+        self.assertEqual(doc.converted_size, 42)
+        self.assertEqual(self.redis.hget(STATS_KEY, 'pdf_to_text:hits'), b'1')
+
+    def test_no_reuse_across_types_versions_or_unfinished_conversions(self):
+        self.earlier(status='failed')
+        self.earlier(converter_version='g0/old')
+        other = DocumentFile(original_file='documents/originals/new.pdf', conversion_type='pdf_to_word')
+        self.assertFalse(reuse_conversion(other, self.path))
+
+        doc = DocumentFile(original_file='documents/originals/new.pdf', conversion_type='pdf_to_text')
+        self.assertFalse(reuse_conversion(doc, self.path))
+        self.assertEqual(doc.status, 'pending')
+        # Recorded either way, so the document can be reused in turn
+        self.assertEqual(len(doc.content_hash), 64)
+        self.assertTrue(doc.converter_version)
+        with override_settings(CONVERSION_CACHE_ENABLED=False):
+            self.earlier()
+            self.assertFalse(reuse_conversion(doc, self.path))
+
+    def test_entries_are_keyed_on_the_engine_that_wrote_the_text(self):
+        with fitz.open() as pdf:
+            # No text layer: PyMuPDF finds nothing and pdfminer gets a second try
+            pdf.new_page()
+            pdf.save(self.path)
+        output_path = os.path.join(os.path.dirname(self.path), 'report.txt')
+        self.assertEqual(utils.convert_pdf_to_text(self.path, output_path, engine='pymupdf'), 'pdfminer')
+        self.assertEqual(utils.convert_pdf_to_text(self.path, output_path, engine='pymupdf', fallback=False), 'pymupdf')
+
+        self.earlier(converter_version=converter_version('pdf_to_text', 'pdfminer'))
+        doc = DocumentFile(original_file='documents/originals/new.pdf', conversion_type='pdf_to_text')
+        self.assertFalse(reuse_conversion(doc, self.path, 'pymupdf'))
+        self.assertTrue(reuse_conversion(doc, self.path, 'pdfminer'))
+
+
+class WordsToPdfTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_dir = tmp.name
+        self.inputs = [os.path.join('/uploads', f'{name}.docx') for name in ('a', 'b', 'c')]
+        for target, value in (('office_available', False), ('convert_word_to_pdf_subprocess', None)):
+            patcher = mock.patch.object(utils, target, return_value=value)
+            setattr(self, target, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def libreoffice(self, creates, returncode=0, stderr=''):
+        """
+        A stubbed LibreOffice run that writes the PDFs of the given inputs.
+        """
+        def run(command, **kwargs):
+            for path in creates:
+                open(utils.batch_pdf_path(self.output_dir, path), 'wb').close()
+            return subprocess.CompletedProcess(command, returncode, '', stderr)
+        return mock.patch.object(utils.subprocess, 'run', side_effect=run)
+
+    def test_whole_batch_in_one_invocation(self):
+        with self.libreoffice(self.inputs) as run:
+            self.assertEqual(utils.convert_words_to_pdf(self.inputs, self.output_dir), {})
+        [call] = run.call_args_list
+        self.assertEqual(call.args[0][-3:], self.inputs)
+        self.convert_word_to_pdf_subprocess.assert_not_called()
+
+    def test_documents_left_by_the_batch_are_retried_alone(self):
+        self.convert_word_to_pdf_subprocess.side_effect = [None, RuntimeError("LibreOffice conversion failed: bad")]
+        with self.libreoffice(self.inputs[:1], returncode=1, stderr='crash'):
+            errors = utils.convert_words_to_pdf(self.inputs, self.output_dir)
+        self.assertEqual(errors, {self.inputs[2]: "LibreOffice conversion failed: bad"})
+        self.assertEqual(
+            [call.args[0] for call in self.convert_word_to_pdf_subprocess.call_args_list], self.inputs[1:]
+        )
+
+    def test_single_document_failure_is_reported_without_a_retry(self):
+        with self.libreoffice([], returncode=1, stderr='source file could not be loaded'):
+            errors = utils.convert_words_to_pdf(self.inputs[:1], self.output_dir)
+        self.assertEqual(errors, {self.inputs[0]: "LibreOffice conversion failed: source file could not be loaded"})
+
+        with self.libreoffice([]):
+            errors = utils.convert_words_to_pdf(self.inputs[:1], self.output_dir)
+        self.assertEqual(errors, {self.inputs[0]: "LibreOffice did not create the expected PDF file."})
+
+        timeout = subprocess.TimeoutExpired('libreoffice', 1)
+        with override_settings(OFFICE_CONVERSION_TIMEOUT=1), \
+                mock.patch.object(utils.subprocess, 'run', side_effect=timeout):
+            errors = utils.convert_words_to_pdf(self.inputs[:1], self.output_dir)
+        self.assertEqual(errors, {self.inputs[0]: "LibreOffice timed out after 1s."})
+        self.convert_word_to_pdf_subprocess.assert_not_called()
+
+
+@override_settings(OFFICE_POOL_WARM=True)
+class OfficePoolWarmTests(SimpleTestCase):
+    def test_only_heavy_lane_workers_start_libreoffice(self):
+        with mock.patch.object(office, 'office_available', return_value=True), \
+                mock.patch.object(office, 'get_office_pool') as get_office_pool:
+            for consumes, warmed in ((False, False), (True, True)):
+                with self.subTest(heavy=consumes), mock.patch.object(office, 'worker_consumes', return_value=consumes):
+                    get_office_pool.reset_mock()
+                    office.warm_office_pool()
+                    self.assertEqual(get_office_pool.return_value.start.called, warmed)
+
+    def test_heavy_lane_worker_reports_a_missing_office_pool(self):
+        with mock.patch.object(office, '_uno', side_effect=RuntimeError("python3-uno is not installed.")):
+            with mock.patch.object(office, 'worker_consumes', return_value=True), \
+                    self.assertLogs(office.logger, 'ERROR') as logs:
+                office.check_office_pool()
+            self.assertIn('python3-uno is not installed.', logs.output[0])
+            with mock.patch.object(office, 'worker_consumes', return_value=False), \
+                    self.assertNoLogs(office.logger, 'ERROR'):
+                office.check_office_pool()
@@ -0,0 +1,178 @@
+import logging
+import posixpath
+import zipfile
+import fitz
+import mammoth
+from lxml import etree
+from pdfminer.high_level import extract_text_to_fp
+from pdfminer.layout import LAParams
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# Written after every page, as pdfminer does
+PAGE_SEPARATOR = '\f'
+
+# Written after every paragraph (table cells hold paragraphs too), as mammoth does
+PARAGRAPH_SEPARATOR = '\n\n'
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC = '{http://schemas.openxmlformats.org/markup-compatibility/2006}'
+PACKAGE_RELATIONSHIPS = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+OFFICE_DOCUMENT_TYPE = '/officeDocument'
+
+
+def pymupdf_text(input_path, output):
+    """
+    PyMuPDF: walk the pages one at a time and write each page's text as soon as
+    it is extracted, so memory does not grow with the document. Text comes out in
+    content stream order, which is the reading order for nearly all generated PDFs
+    (sort=True re-sorts by position but is an order of magnitude slower).
+    Returns the number of characters of text found (ignoring surrounding whitespace).
+    """
+    characters = 0
+    with fitz.open(input_path) as pdf:
+        for page in pdf:
+            text = page.get_text('text')
+            output.write(text)
+            output.write(PAGE_SEPARATOR)
+            characters += len(text.strip())
+    return characters
+
+
+def pdfminer_text(input_path, output):
+    """
+    pdfminer: full layout analysis, slower, but it recovers text from some PDFs
+    PyMuPDF returns nothing for. Also streams page by page.
+    Returns None: the text is not counted.
+    """
+    with open(input_path, 'rb') as pdf:
+        extract_text_to_fp(pdf, output, laparams=LAParams(), output_type='text', codec=None)
+
+
+TEXT_ENGINES = {
+    'pymupdf': pymupdf_text,
+    'pdfminer': pdfminer_text,
+}
+
+
+def get_text_engine(name=None):
+    """
+    Return the text extractor configured by PDF_TEXT_ENGINE, or the named one.
+    Every engine takes (input PDF path, writable text file), writes the text page by
+    page and returns how many characters of text it found, or None if it does not count.
+    """
+    name = name or settings.PDF_TEXT_ENGINE
+    try:
+        return TEXT_ENGINES[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown PDF text engine {name!r}; choose one of {', '.join(TEXT_ENGINES)}"
+        )
+
+
+def _main_document_part(docx):
+    """
+    Name of the main document part in a DOCX zip (normally word/document.xml).
+    """
+    relationships = etree.fromstring(docx.read('_rels/.rels'), etree.XMLParser(resolve_entities=False))
+    for relationship in relationships.iter(PACKAGE_RELATIONSHIPS):
+        if relationship.get('Type', '').endswith(OFFICE_DOCUMENT_TYPE):
+            return posixpath.normpath(relationship.get('Target').lstrip('/'))
+    raise KeyError("No main document part in the DOCX package")
+
+
+def _drop_parsed(element):
+    """
+    Free an element that has been fully handled, along with its handled earlier siblings.
+    """
+    element.clear(keep_tail=True)
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def streaming_docx_text(input_path, output):
+    """
+    Stream the main document part out of the zip through lxml's iterparse and
+    write every paragraph (including those in table cells) as soon as it ends.
+    Handled elements are freed as parsing goes, so memory stays flat whatever
+    the document size. Output matches mammoth's raw text: each paragraph followed
+    by a blank line, run tabs as tabs, text-box paragraphs after the paragraph
+    holding them, and the fallback of alternate content.
+    Returns the number of paragraphs written.
+    """
+    paragraphs = 0
+    with zipfile.ZipFile(input_path) as docx, docx.open(_main_document_part(docx)) as part:
+        # (text, text of nested text-box paragraphs) of each paragraph being parsed
+        open_paragraphs = []
+        # Inside mc:Choice, whose content is repeated in mc:Fallback
+        skipped = 0
+        events = etree.iterparse(
+            part, events=('start', 'end'),
+            tag=(f'{W}p', f'{W}t', f'{W}tab', f'{W}tr', f'{MC}Choice'),
+            resolve_entities=False, huge_tree=True,
+        )
+        for event, element in events:
+            tag = element.tag
+            if tag == f'{MC}Choice':
+                skipped += 1 if event == 'start' else -1
+            elif tag == f'{W}p':
+                if event == 'start':
+                    open_paragraphs.append(([], []))
+                    continue
+                parts, nested = open_paragraphs.pop()
+                text = ''.join(parts) + PARAGRAPH_SEPARATOR + ''.join(nested)
+                if skipped:
+                    pass
+                elif open_paragraphs:
+                    open_paragraphs[-1][1].append(text)
+                else:
+                    output.write(text)
+                    paragraphs += 1
+                _drop_parsed(element)
+            elif tag == f'{W}tr':
+                # Rows end outside any paragraph: free each as it ends, not with its whole table
+                if event == 'end':
+                    _drop_parsed(element)
+            elif event == 'start' or skipped or not open_paragraphs:
+                continue
+            elif tag == f'{W}t':
+                open_paragraphs[-1][0].append(element.text or '')
+            elif tag == f'{W}tab':
+                # Tab characters in runs, not tab stop definitions in paragraph properties
+                if element.getparent().tag == f'{W}r':
+                    open_paragraphs[-1][0].append('\t')
+    return paragraphs
+
+
+def mammoth_docx_text(input_path, output):
+    """
+    mammoth: reads the whole document model into memory, then writes its raw text.
+    Handles packages the streaming extractor cannot.
+    Returns None: paragraphs are not counted.
+    """
+    with open(input_path, 'rb') as docx:
+        output.write(mammoth.extract_raw_text(docx).value)
+
+
+WORD_TEXT_ENGINES = {
+    'stream': streaming_docx_text,
+    'mammoth': mammoth_docx_text,
+}
+
+
+def get_word_text_engine(name=None):
+    """
+    Return the DOCX text extractor configured by WORD_TEXT_ENGINE, or the named one.
+    Every engine takes (input DOCX path, writable text file) and writes the text.
+    """
+    name = name or settings.WORD_TEXT_ENGINE
+    try:
+        return WORD_TEXT_ENGINES[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown Word text engine {name!r}; choose one of {', '.join(WORD_TEXT_ENGINES)}"
+        )
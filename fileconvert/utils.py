@@ -1,44 +1,69 @@
 import os
 import subprocess
-from pdf2docx import Converter
-import pdfminer.high_level
-import mammoth
+from pathlib import Path
+import fitz
 import logging
+from django.conf import settings
+from .office import office_available, get_office_pool
+from .pdf_to_word import convert_pages_sequential, convert_pages_parallel
+from .text import get_text_engine, pdfminer_text, get_word_text_engine, mammoth_docx_text
 
 logger = logging.getLogger(__name__)
 
 
+def count_pdf_pages(input_path):
+    """
+    Return the number of pages in a PDF without rendering any of them.
+    """
+    with fitz.open(input_path) as pdf:
+        return pdf.page_count
+
+
 
 
 
-def convert_pdf_to_word(input_path, output_path):
+def convert_pdf_to_word(input_path, output_path, progress=None, parallel=None):
     """
     Convert a PDF file to Word (DOCX) using pdf2docx.
+    With parallel=True (by default: PDFs of PDF_TO_WORD_PARALLEL_PAGES pages or more) the pages
+    are parsed in page ranges on PDF_TO_WORD_WORKERS processes.
+    progress(pages_done, page_count) is called as pages finish.
     """
     logger.info(f"Converting PDF to Word: {input_path} -> {output_path}")
-    cv = Converter(input_path)
     try:
-        cv.convert(
-            output_path,
-            start=0,
-            end=None,
-            layout_mode='loose',
-            preserve_font_direction=True,
-            preserve_image=True,
-            preserve_table=True
-        )
+        page_count = count_pdf_pages(input_path)
+        if parallel is None:
+            parallel = settings.PDF_TO_WORD_WORKERS > 1 and page_count >= settings.PDF_TO_WORD_PARALLEL_PAGES
+        if parallel:
+            convert_pages_parallel(input_path, output_path, page_count, settings.PDF_TO_WORD_WORKERS, progress)
+        else:
+            convert_pages_sequential(input_path, output_path, progress)
     except Exception as e:
         logger.error(f"PDF to Word conversion failed: {e}")
         raise
-    finally:
-        cv.close()
 
 
 
 
 def convert_word_to_pdf(input_path, output_path):
+    """
+    Convert a Word (DOCX) file to PDF on a warm LibreOffice from the worker's office pool.
+    Falls back to a one-off LibreOffice process where the UNO bindings are not installed.
+    """
+    if not office_available():
+        return convert_word_to_pdf_subprocess(input_path, output_path)
+    logger.info(f"Converting Word to PDF: {input_path} -> {output_path}")
+    try:
+        get_office_pool().convert(input_path, output_path)
+    except Exception as e:
+        logger.error(f"Failed to convert Word to PDF: {str(e)}")
+        raise
+
+
+def convert_word_to_pdf_subprocess(input_path, output_path):
     """
     Convert a Word (DOCX) file to PDF using LibreOffice via subprocess.
+    Starts a full LibreOffice for every document.
     """
     logger.info(f"Converting Word to PDF: {input_path} -> {output_path}")
     try:
@@ -76,21 +101,106 @@ def convert_word_to_pdf(input_path, output_path):
 
 
 
-def convert_pdf_to_text(input_path, output_path):
+def batch_pdf_path(output_dir, input_path):
+    """
+    Where convert_words_to_pdf writes the PDF for input_path (LibreOffice's own naming).
+    """
+    return os.path.join(output_dir, f"{os.path.splitext(os.path.basename(input_path))[0]}.pdf")
+
+
+def convert_words_to_pdf(input_paths, output_dir):
+    """
+    Convert several Word (DOCX) files to PDF in output_dir, paying for LibreOffice
+    startup once: on one pooled process, or else in a single `--convert-to pdf`
+    invocation. Input basenames must be unique.
+    Returns {input_path: error message} for the documents that failed; a document
+    that breaks the batch is retried on its own, so it cannot fail the others.
+    """
+    logger.info(f"Converting {len(input_paths)} Word documents to PDF in {output_dir}")
+    errors = {}
+    if office_available():
+        pool = get_office_pool()
+        for input_path in input_paths:
+            try:
+                pool.convert(input_path, batch_pdf_path(output_dir, input_path))
+            except Exception as e:
+                errors[input_path] = str(e)
+        return errors
+
+    # A profile per worker process, so concurrent batches do not share one
+    profile_dir = os.path.join(settings.OFFICE_PROFILE_ROOT, f'batch-{os.getpid()}')
+    command = [
+        'libreoffice',
+        '--headless',
+        f'-env:UserInstallation={Path(profile_dir).as_uri()}',
+        '--convert-to', 'pdf',
+        '--outdir', output_dir,
+        *input_paths,
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=settings.OFFICE_CONVERSION_TIMEOUT)
+        failure = (
+            f"LibreOffice conversion failed: {result.stderr.strip() or f'exit code {result.returncode}'}"
+            if result.returncode != 0 else "LibreOffice did not create the expected PDF file."
+        )
+    except subprocess.TimeoutExpired:
+        failure = f"LibreOffice timed out after {settings.OFFICE_CONVERSION_TIMEOUT}s."
+
+    missing = [path for path in input_paths if not os.path.exists(batch_pdf_path(output_dir, path))]
+    if len(missing) == 1 and len(input_paths) == 1:
+        errors[missing[0]] = failure
+        return errors
+    for input_path in missing:
+        # LibreOffice stops at a document it crashes or hangs on; the rest go one at a time
+        try:
+            convert_word_to_pdf_subprocess(input_path, batch_pdf_path(output_dir, input_path))
+        except Exception as e:
+            errors[input_path] = str(e)
+    return errors
+
+
+def convert_pdf_to_text(input_path, output_path, engine=None, fallback=True):
     """
-    Convert a PDF file to plain text using pdfminer.
+    Convert a PDF file to plain text with the named extractor (by default PDF_TEXT_ENGINE), streaming page by page.
+    If PyMuPDF fails or finds no text at all, pdfminer's layout analysis gets a second try.
+    fallback=False skips the retry for finding no text (a PDF without a text layer, where
+    pdfminer finds nothing either).
+    Returns the name of the extractor that wrote the text.
     """
+    engine = engine or settings.PDF_TEXT_ENGINE
+    extract = get_text_engine(engine)
     logger.info(f"Converting PDF to Text: {input_path} -> {output_path}")
+    try:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            found = extract(input_path, f)
+        if found or extract is pdfminer_text or not fallback:
+            return engine
+        logger.info(f"PyMuPDF found no text in {input_path}; retrying with pdfminer")
+    except Exception as e:
+        if extract is pdfminer_text:
+            raise
+        logger.warning(f"PyMuPDF text extraction failed for {input_path}: {e}; retrying with pdfminer")
     with open(output_path, 'w', encoding='utf-8') as f:
-        text = pdfminer.high_level.extract_text(input_path)
-        f.write(text)
+        pdfminer_text(input_path, f)
+    return 'pdfminer'
 
-def convert_word_to_text(input_path, output_path):
+def convert_word_to_text(input_path, output_path, engine=None):
     """
-    Convert a Word (DOCX) file to plain text using mammoth.
+    Convert a Word (DOCX) file to plain text with the named extractor (by default WORD_TEXT_ENGINE).
+    If the streaming extractor cannot read the package, mammoth gets a second try.
+    Returns the name of the extractor that wrote the text.
     """
+    engine = engine or settings.WORD_TEXT_ENGINE
+    extract = get_word_text_engine(engine)
     logger.info(f"Converting Word to Text: {input_path} -> {output_path}")
-    with open(input_path, "rb") as docx_file:
-        result = mammoth.extract_raw_text(docx_file).value
+    try:
         with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(result)
\ No newline at end of file
+            extract(input_path, f)
+        return engine
+    except Exception as e:
+        if extract is mammoth_docx_text:
+            raise
+        logger.warning(f"Streaming text extraction failed for {input_path}: {e}; retrying with mammoth")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        mammoth_docx_text(input_path, f)
+    return 'mammoth'
\ No newline at end of file
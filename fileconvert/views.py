@@ -2,7 +2,8 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view
 from .serializers import DocumentFileSerializer
-from .tasks import document_convert
+from .preflight import preflight, PreflightError
+from MetaSqueeze.fairshare import submit, tenant_for
 from django.http import FileResponse
 from .models import DocumentFile
 
@@ -14,13 +15,26 @@ def document_upload_view(request):
     """
     Handle document uploads and trigger asynchronous conversion.
     Accepts 'original_file' and optional 'output_format' (PDF, DOCX, TXT).
+    PDFs are analyzed first; one no converter can read fails here instead of in the queue.
     """
     serializer = DocumentFileSerializer(data=request.data)
     serializer.is_valid(raise_exception=True)
-    uploaded_file = serializer.save()
+    uploaded_file = serializer.save(uploaded_by=request.user if request.user.is_authenticated else None)
 
-    # Call Celery task to convert the document in the background
-    document_convert.delay(uploaded_file.id)
+    try:
+        preflight(uploaded_file)
+    except PreflightError as e:
+        uploaded_file.status = 'failed'
+        uploaded_file.error_message = str(e)[:255]
+        uploaded_file.save()
+        return Response({
+            'message': f'Document cannot be converted: {uploaded_file.error_message}',
+            'data': DocumentFileSerializer(uploaded_file).data
+        }, status=status.HTTP_400_BAD_REQUEST)
+    uploaded_file.save()
+
+    # Queue the conversion behind the user's earlier jobs; users are served in turn
+    submit(tenant_for(request), 'document', [uploaded_file.id])
 
     return Response({
         'message': 'Document uploaded successfully! Conversion in progress.',
@@ -37,7 +51,7 @@ def document_download_view(request, document_id):
     """
     try:
         document = DocumentFile.objects.only(
-            'converted_file', 'conversion_type', 'status'
+            'converted_file', 'conversion_type', 'status', 'pages_total', 'pages_done'
         ).get(id=document_id)
     except DocumentFile.DoesNotExist:
         return Response(
@@ -53,7 +67,12 @@ def document_download_view(request, document_id):
 
     if document.status in ('pending', 'processing') or not document.converted_file:
         return Response(
-            {'status': 'pending', 'message': 'Document conversion is still in progress.'},
+            {
+                'status': 'pending',
+                'message': 'Document conversion is still in progress.',
+                'pages_total': document.pages_total,
+                'pages_done': document.pages_done,
+            },
             status=status.HTTP_202_ACCEPTED
         )
 